@@ -0,0 +1,296 @@
+"""
+قياس أداء دوال قاعدة البيانات في SubscriptionManagementSystem
+
+يملأ قاعدة بيانات منفصلة بأحجام واقعية، ثم يقيس زمن كل دالة عدة مرات ويحفظ النتائج بصيغة JSON.
+عند تمرير نتائج سابقة (--baseline) أو حدود ثابتة (--thresholds) ينتهي بالرمز 1 إذا تراجع الأداء،
+فيمكن التحقق من أثر أي تغيير في الفهارس أو الإعدادات أو الذاكرة المؤقتة بالأرقام.
+
+أمثلة:
+    python benchmark_db.py                                   # 1M مشترك، 5M كود، 50 قناة
+    python benchmark_db.py --subscribers 100000 --codes 500000 --output before.json
+    python benchmark_db.py --subscribers 100000 --codes 500000 --baseline before.json --tolerance 0.2
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+ALPHABET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+CODE_SPACE = 36 ** 12
+# مضاعف أولي نسبياً مع 36، فيعطي أكواداً فريدة بمظهر عشوائي وقابلة للتكرار بين التشغيلات
+CODE_MULTIPLIER = 2654435761
+SEED_CHUNK = 50000
+BENCH_ADMIN_ID = 900000002
+
+def seed_code(index):
+    value = (index + 1) * CODE_MULTIPLIER % CODE_SPACE
+    chars = []
+    for _ in range(12):
+        value, digit = divmod(value, 36)
+        chars.append(ALPHABET[digit])
+    return "".join(chars)
+
+# =============================================
+# تعبئة البيانات
+# =============================================
+def seeded_counts(db_path):
+    if not os.path.exists(db_path):
+        return None
+    conn = sqlite3.connect(db_path)
+    try:
+        return {
+            "subscribers": conn.execute("SELECT COUNT(*) FROM subscribers").fetchone()[0],
+            "codes": conn.execute("SELECT COUNT(*) FROM codes").fetchone()[0],
+            "channels": conn.execute("SELECT COUNT(*) FROM additional_channels WHERE is_main_channel = FALSE").fetchone()[0],
+        }
+    except sqlite3.Error:
+        return None
+    finally:
+        conn.close()
+
+def insert_chunks(conn, sql, rows):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= SEED_CHUNK:
+            conn.executemany(sql, chunk)
+            chunk = []
+    if chunk:
+        conn.executemany(sql, chunk)
+
+def seed(system, args):
+    """تعبئة الأكواد والمشتركين والقنوات في معاملة واحدة"""
+    rng = random.Random(args.seed)
+    now = datetime.now()
+    conn = system.conn
+    conn.execute("PRAGMA synchronous=OFF")
+    started = time.perf_counter()
+
+    insert_chunks(conn, '''
+        INSERT OR IGNORE INTO additional_channels (channel_id, channel_username, channel_name, added_by, is_active)
+        VALUES (?, ?, ?, ?, TRUE)
+    ''', ((str(-1008000000000 - i), f"@bench_channel_{i}", f"قناة {i}", BENCH_ADMIN_ID) for i in range(args.channels)))
+
+    used_codes = int(args.codes * args.used_ratio)
+    def code_rows():
+        for i in range(args.codes):
+            created = now - timedelta(minutes=rng.randrange(0, 525600))
+            is_used = i < used_codes
+            yield (
+                seed_code(i), rng.choice((7, 30, 90, 365)), rng.choice((0.0, 5.0, 10.0, 25.0)),
+                is_used, 1000000 + i if is_used else None, BENCH_ADMIN_ID,
+                int(created.timestamp()), int((created + timedelta(days=rng.randrange(30, 400))).timestamp()),
+                f"BATCH_{i // 1000}", 1 if is_used else 0
+            )
+    insert_chunks(conn, '''
+        INSERT INTO codes (code, duration_days, price, is_used, used_by, created_by, created_at, expires_at, batch_id, current_uses)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', code_rows())
+    print(f"   🎫 {args.codes} كود ({time.perf_counter() - started:.1f}s)")
+
+    def subscriber_rows():
+        for i in range(args.subscribers):
+            roll = rng.random()
+            if roll < args.expired_ratio:
+                expires = now - timedelta(hours=rng.randrange(1, 720))
+            elif roll < args.expired_ratio + args.expiring_ratio:
+                expires = now + timedelta(minutes=rng.randrange(1, 7 * 1440))
+            else:
+                expires = now + timedelta(days=rng.randrange(8, 365))
+            subscribed = expires - timedelta(days=30)
+            yield (
+                1000000 + i, f"user{i}", f"مستخدم {i}", "", seed_code(i % max(used_codes, 1)),
+                int(subscribed.timestamp()), int(expires.timestamp()), rng.random() < 0.1
+            )
+    insert_chunks(conn, '''
+        INSERT OR IGNORE INTO subscribers (user_id, username, first_name, last_name, code_used, subscribed_at, expires_at, is_trial)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', subscriber_rows())
+    conn.commit()
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("ANALYZE")
+    print(f"   👥 {args.subscribers} مشترك ({time.perf_counter() - started:.1f}s)")
+
+# =============================================
+# القياسات
+# =============================================
+class Benchmarks:
+    """كل قياس دالة تنفذ العملية مرة واحدة، مع تهيئة وتنظيف خارج الوقت المقاس"""
+    def __init__(self, system, args):
+        self.system = system
+        self.args = args
+        self.rng = random.Random(args.seed + 1)
+        self.loop = asyncio.new_event_loop()
+        self.next_user = 9000000
+        # أكواد غير مستخدمة للتفعيل والبحث (تختار قبل القياس لأن التشغيلات السابقة تستهلك بعضها)
+        self.free_codes = [row[0] for row in system.conn.execute(
+            'SELECT code FROM codes WHERE is_used = FALSE AND is_active = TRUE LIMIT ?', (args.repeat + 1,)
+        ).fetchall()]
+
+    def cases(self):
+        system = self.system
+        wait = self.loop.run_until_complete
+        return [
+            ("get_system_stats", lambda: wait(system.get_system_stats()), None),
+            ("get_available_codes", lambda: wait(system.get_available_codes()), None),
+            ("get_all_subscribers", lambda: wait(system.get_all_subscribers()), None),
+            ("get_subscription_info", lambda: wait(system.get_subscription_info(
+                1000000 + self.rng.randrange(self.args.subscribers))), None),
+            ("find_code_in_text:hit", lambda: wait(system.find_code_in_text(
+                f"كودي هو {self.free_codes[-1]} شكراً")), None),
+            ("find_code_in_text:miss", lambda: wait(system.find_code_in_text(
+                "مرحبا أريد الاشتراك ABCDEFGHIJKL في القناة")), None),
+            ("use_code", self.use_code, None),
+            ("create_multiple_codes", lambda: wait(system.create_multiple_codes(
+                self.args.create_count, 30, 5.0, BENCH_ADMIN_ID)), None),
+            ("enqueue_expired_subscribers", lambda: wait(system.enqueue_expired_subscribers()), self.clear_task_queue),
+            ("send_expiry_notifications", lambda: wait(
+                system.send_expiry_notifications_async()), self.clear_notifications),
+        ]
+
+    def use_code(self):
+        code = self.free_codes.pop()
+        self.next_user += 1
+        return self.loop.run_until_complete(
+            self.system.use_code(code, self.next_user, "bench", "bench", "", None)
+        )
+
+    def clear_task_queue(self):
+        self.system.task_queue.conn.execute("DELETE FROM task_queue")
+
+    def clear_notifications(self):
+        self.system.conn.execute("DELETE FROM notification_log")
+        self.system.conn.commit()
+
+    def run(self, only=None):
+        results = {}
+        for name, func, cleanup in self.cases():
+            if only and name.split(":")[0] not in only:
+                continue
+            timings = []
+            for _ in range(self.args.repeat):
+                started = time.perf_counter()
+                func()
+                timings.append((time.perf_counter() - started) * 1000)
+                if cleanup:
+                    cleanup()
+            results[name] = {
+                "runs": len(timings),
+                "min_ms": round(min(timings), 3),
+                "p50_ms": round(statistics.median(timings), 3),
+                "max_ms": round(max(timings), 3),
+            }
+            print(f"   ⏱️ {name}: p50 {results[name]['p50_ms']}ms (min {results[name]['min_ms']}، max {results[name]['max_ms']})")
+        self.loop.close()
+        return results
+
+# =============================================
+# مقارنة النتائج
+# =============================================
+def find_regressions(results, baseline=None, thresholds=None, tolerance=0.25, noise_ms=1.0):
+    """التراجع: p50 أعلى من الأساس بأكثر من النسبة المسموحة (مع تجاهل فروق الضجيج)، أو أعلى من الحد الثابت"""
+    regressions = []
+    for name, result in results.items():
+        if baseline and name in baseline:
+            previous = baseline[name]["p50_ms"]
+            limit = max(previous * (1 + tolerance), previous + noise_ms)
+            if result["p50_ms"] > limit:
+                regressions.append({"name": name, "p50_ms": result["p50_ms"], "baseline_p50_ms": previous,
+                                    "limit_ms": round(limit, 3)})
+        if thresholds and name in thresholds and result["p50_ms"] > thresholds[name]:
+            regressions.append({"name": name, "p50_ms": result["p50_ms"], "threshold_ms": thresholds[name]})
+    return regressions
+
+def load_json(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="قياس أداء دوال قاعدة البيانات")
+    parser.add_argument("--db", default="benchmark_subscriptions.db", help="مسار قاعدة القياس (منفصلة عن قاعدة الإنتاج)")
+    parser.add_argument("--subscribers", type=int, default=1000000)
+    parser.add_argument("--codes", type=int, default=5000000)
+    parser.add_argument("--channels", type=int, default=50)
+    parser.add_argument("--used-ratio", type=float, default=0.2, help="نسبة الأكواد المستخدمة")
+    parser.add_argument("--expired-ratio", type=float, default=0.05, help="نسبة المشتركين المنتهين")
+    parser.add_argument("--expiring-ratio", type=float, default=0.05, help="نسبة المشتركين الذين ينتهون خلال أسبوع")
+    parser.add_argument("--create-count", type=int, default=100, help="عدد الأكواد في قياس create_multiple_codes")
+    parser.add_argument("--repeat", type=int, default=5, help="عدد مرات تنفيذ كل قياس")
+    parser.add_argument("--only", nargs="*", help="تشغيل قياسات محددة بالاسم")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--reseed", action="store_true", help="حذف قاعدة القياس وإعادة تعبئتها")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", help="نتائج سابقة للمقارنة")
+    parser.add_argument("--thresholds", help="ملف JSON بحد أقصى p50 بالمللي ثانية لكل قياس")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="نسبة التراجع المسموحة مقارنة بالأساس")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    db_path = os.path.abspath(args.db)
+    if args.reseed:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+
+    os.environ.update({
+        "DATABASE_PATH": db_path,
+        "LOG_LEVEL": os.environ.get("LOG_LEVEL", "WARNING"),
+        "LOG_FILE": os.environ.get("LOG_FILE", os.path.splitext(db_path)[0] + ".log"),
+    })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main as bot_main
+
+    counts = seeded_counts(db_path)
+    system = bot_main.SubscriptionManagementSystem(db_path, enable_scheduler=False)
+    if counts and counts["subscribers"] >= args.subscribers and counts["codes"] >= args.codes:
+        print(f"♻️ استخدام البيانات الموجودة في {db_path}: {counts}")
+    else:
+        if counts and (counts["subscribers"] or counts["codes"]):
+            print("❌ البيانات الموجودة أقل من الأحجام المطلوبة، استخدم --reseed")
+            system.close()
+            sys.exit(2)
+        print(f"🌱 تعبئة {db_path}...")
+        seed(system, args)
+
+    print(f"🚀 القياس ({args.repeat} مرات لكل دالة)...")
+    results = Benchmarks(system, args).run(set(args.only) if args.only else None)
+    final_counts = seeded_counts(db_path)
+    system.close()
+
+    baseline = load_json(args.baseline)["results"] if args.baseline else None
+    thresholds = load_json(args.thresholds) if args.thresholds else None
+    regressions = find_regressions(results, baseline, thresholds, args.tolerance)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "repeat": args.repeat,
+            "counts": final_counts,
+        },
+        "results": results,
+        "regressions": regressions,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"💾 تم حفظ النتائج في {args.output}")
+
+    if regressions:
+        print("❌ تراجع في الأداء:")
+        for regression in regressions:
+            print(f"   • {regression}")
+        sys.exit(1)
+    print("✅ لا يوجد تراجع في الأداء")
+
+if __name__ == "__main__":
+    main()
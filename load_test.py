@@ -0,0 +1,476 @@
+"""
+اختبار الحمل لبوت إدارة الاشتراكات
+
+يشغل خادم Bot API وهمياً محلياً (مع تأخير ورفض 429 قابلين للضبط)، ويرسل للبوت تحديثات
+مصطنعة عبر نفس مسار المعالجة الحقيقي، ثم يعرض الإنتاجية وزمن الاستجابة وزمن قاعدة البيانات.
+
+أمثلة:
+    python load_test.py --scenario interactions --users 500
+    python load_test.py --scenario redeem --users 2000 --latency-ms 80 --rate-429 0.02
+    python load_test.py --scenario sweep --subscribers 100000
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+BOT_USER_ID = 900000001
+ADMIN_USER_ID = 900000002
+FAKE_TOKEN = f"{BOT_USER_ID}:LOADTEST"
+
+# =============================================
+# خادم Bot API الوهمي
+# =============================================
+class FakeBotAPI:
+    """خادم aiohttp يحاكي Bot API: تأخير عشوائي، رفض 429 عشوائي، وحد طلبات في الثانية"""
+    def __init__(self, port, latency_ms=50, jitter_ms=20, rate_429=0.0, retry_after=1, api_rps=0):
+        self.port = port
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.api_rps = api_rps
+        self.requests = {}
+        self.rejected = 0
+        self.window = (0, 0)    # (الثانية الحالية، عدد الطلبات فيها)
+        self.message_id = 0
+        self.runner = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    async def start(self):
+        from aiohttp import web
+        app = web.Application(client_max_size=50 * 1024 * 1024)
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, '127.0.0.1', self.port).start()
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+    def throttled(self):
+        """حد الطلبات في الثانية مثل حدود Telegram الفعلية"""
+        if not self.api_rps:
+            return False
+        second = int(time.monotonic())
+        current, count = self.window
+        if second != current:
+            current, count = second, 0
+        self.window = (current, count + 1)
+        return count >= self.api_rps
+
+    async def handle(self, request):
+        from aiohttp import web
+        method = request.match_info['method']
+        self.requests[method] = self.requests.get(method, 0) + 1
+        form = await request.post()
+
+        await asyncio.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+        if self.throttled() or (self.rate_429 and random.random() < self.rate_429):
+            self.rejected += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after}
+            }, status=429)
+
+        return web.json_response({"ok": True, "result": self.result(method, form)})
+
+    def result(self, method, form):
+        """نتيجة مقبولة لكل دالة يستخدمها البوت"""
+        bot_user = {"id": BOT_USER_ID, "is_bot": True, "first_name": "LoadBot", "username": "load_test_bot"}
+        if method == "getMe":
+            return dict(bot_user, can_join_groups=True, can_read_all_group_messages=False,
+                        supports_inline_queries=False)
+        if method in ("sendMessage", "editMessageText", "sendDocument"):
+            self.message_id += 1
+            chat_id = form.get("chat_id", "0")
+            try:
+                chat_id = int(chat_id)
+            except ValueError:
+                chat_id = 0
+            return {
+                "message_id": self.message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": bot_user,
+                "text": form.get("text", "")
+            }
+        if method == "getChatMember":
+            user_id = int(form.get("user_id", "0"))
+            return {"status": "member", "user": {"id": user_id, "is_bot": False, "first_name": "user"}}
+        if method == "createChatInviteLink":
+            return {
+                "invite_link": f"https://t.me/+{random.getrandbits(64):016x}",
+                "creator": bot_user,
+                "creates_join_request": False,
+                "is_primary": False,
+                "is_revoked": False
+            }
+        return True
+
+# =============================================
+# التحديثات المصطنعة
+# =============================================
+def user_dict(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"}
+
+def message_update(update_id, user_id, text):
+    data = {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": user_dict(user_id),
+            "text": text
+        }
+    }
+    if text.startswith('/'):
+        command = text.split()[0]
+        data["message"]["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+    return data
+
+def callback_update(update_id, user_id, data):
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": user_dict(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": BOT_USER_ID, "is_bot": True, "first_name": "LoadBot"},
+                "text": "menu"
+            }
+        }
+    }
+
+# =============================================
+# التشغيل والقياس
+# =============================================
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+def db_snapshot(main):
+    """نسخة من مقاييس القاعدة لحساب الفرق بعد كل سيناريو"""
+    snapshot = {}
+    for metric in (main.DB_QUERY_SECONDS, main.DB_COMMIT_SECONDS):
+        with metric.lock:
+            for key, (counts, total, count) in metric.series.items():
+                # عدد العمليات الأبطأ من 100ms مؤشر على انتظار أقفال الكتابة
+                slow = sum(c for bound, c in zip(metric.buckets, counts) if bound > 0.1) \
+                    + (count - sum(counts))
+                entry = snapshot.setdefault(key[0], [0.0, 0, 0])
+                entry[0] += total
+                entry[1] += count
+                entry[2] += slow
+    return snapshot
+
+def db_report(before, after, wall):
+    methods = []
+    for method, (total, count, slow) in after.items():
+        prev_total, prev_count, prev_slow = before.get(method, (0.0, 0, 0))
+        if count - prev_count:
+            methods.append((method, total - prev_total, count - prev_count, slow - prev_slow))
+    methods.sort(key=lambda item: item[1], reverse=True)
+    db_total = sum(item[1] for item in methods)
+    return {
+        "db_seconds": round(db_total, 4),
+        "db_share_of_wall": round(db_total / wall, 4) if wall else 0.0,
+        "slow_operations": sum(item[3] for item in methods),
+        "top_methods": [
+            {"method": method, "seconds": round(total, 4), "calls": count, "slow": slow}
+            for method, total, count, slow in methods[:8]
+        ]
+    }
+
+class LoadTest:
+    """يبني البوت الحقيقي موجهاً للخادم الوهمي وينفذ السيناريوهات"""
+    def __init__(self, main, api, args):
+        self.main = main
+        self.api = api
+        self.args = args
+        self.update_id = 0
+        self.errors = 0
+
+    async def setup(self):
+        main = self.main
+        self.system = main.SubscriptionManagementSystem(enable_scheduler=False)
+        self.bot = main.TelegramSubscriptionBot(self.system)
+        self.application = self.bot.build_application()
+        self.application.add_error_handler(self.count_error)
+        self.seed_channels(self.args.channels)
+        await self.application.initialize()
+        self.system.bind_loop(asyncio.get_running_loop())
+        await self.system.open_store()
+        await self.bot.setup_dynamic_handlers(self.application)
+
+    async def teardown(self):
+        await self.application.shutdown()
+        self.system.close()
+
+    async def count_error(self, update, context):
+        self.errors += 1
+
+    def next_id(self):
+        self.update_id += 1
+        return self.update_id
+
+    async def process(self, data, latencies):
+        """تمرير التحديث عبر معالج التحديثات الفعلي كما يفعل Application"""
+        from telegram import Update
+        application = self.application
+        update = Update.de_json(data, application.bot)
+        started = time.perf_counter()
+        await application.update_processor.process_update(update, application.process_update(update))
+        latencies.append(time.perf_counter() - started)
+
+    async def drive(self, name, scripts):
+        """كل سكربت قائمة تحديثات لمستخدم واحد ترسل بالتتابع، والمستخدمون يعملون بالتوازي"""
+        latencies = []
+        api_before = dict(self.api.requests)
+        rejected_before = self.api.rejected
+        errors_before = self.errors
+        db_before = db_snapshot(self.main)
+        semaphore = asyncio.Semaphore(self.args.clients)
+
+        async def run_script(script):
+            async with semaphore:
+                for data in script:
+                    await self.process(data, latencies)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(run_script(script) for script in scripts))
+        wall = time.perf_counter() - started
+
+        api_calls = {
+            method: count - api_before.get(method, 0)
+            for method, count in self.api.requests.items()
+            if count - api_before.get(method, 0)
+        }
+        return {
+            "scenario": name,
+            "updates": len(latencies),
+            "wall_seconds": round(wall, 3),
+            "throughput_per_second": round(len(latencies) / wall, 2) if wall else 0.0,
+            "latency_p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+            "latency_p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+            "latency_max_ms": round(max(latencies, default=0.0) * 1000, 2),
+            "handler_errors": self.errors - errors_before,
+            "api_calls": api_calls,
+            "api_429": self.api.rejected - rejected_before,
+            "database": db_report(db_before, db_snapshot(self.main), wall),
+        }
+
+    async def scenario_interactions(self):
+        """تصفح القوائم: /start ثم أزرار المساعدة والاشتراك والرجوع"""
+        scripts = []
+        for i in range(self.args.users):
+            user_id = 1000000 + i
+            scripts.append([
+                message_update(self.next_id(), user_id, "/start"),
+                callback_update(self.next_id(), user_id, "main_help"),
+                callback_update(self.next_id(), user_id, "user_my_subscription"),
+                callback_update(self.next_id(), user_id, "main_back"),
+            ])
+        return await self.drive("interactions", scripts)
+
+    async def scenario_redeem(self):
+        """تفعيل جماعي: كل مستخدم يرسل /use بكود مختلف"""
+        _, codes, _ = await self.system.create_multiple_codes(self.args.users, 30, 0.0, ADMIN_USER_ID)
+        scripts = [
+            [message_update(self.next_id(), 2000000 + i, f"/use {code}")]
+            for i, code in enumerate(codes)
+        ]
+        return await self.drive("redeem", scripts)
+
+    async def scenario_flood(self):
+        """مستخدمون يغرقون البوت بنصوص تشبه الأكواد، بجانب مستخدمين عاديين يجب ألا يتأثروا"""
+        throttled_before = sum(self.main.INBOUND_THROTTLED.series.values())
+        scripts = [
+            [message_update(self.next_id(), 6000000 + i, f"FLOOD{n:06d}") for n in range(self.args.flood_messages)]
+            for i in range(self.args.flood_users)
+        ] + [
+            [message_update(self.next_id(), 7000000 + i, "/start")]
+            for i in range(self.args.users)
+        ]
+        result = await self.drive("flood", scripts)
+        result["throttled"] = sum(self.main.INBOUND_THROTTLED.series.values()) - throttled_before
+        return result
+
+    async def scenario_codegen(self):
+        """دفعات إنشاء أكواد من المشرف بالتوازي مع تفاعل المستخدمين"""
+        admin_script = [
+            message_update(self.next_id(), ADMIN_USER_ID, f"/createmultiple {self.args.batch_size} 30 5")
+            for _ in range(self.args.batches)
+        ]
+        scripts = [admin_script] + [
+            [message_update(self.next_id(), 3000000 + i, "/start")]
+            for i in range(self.args.users)
+        ]
+        return await self.drive("codegen", scripts)
+
+    def seed_channels(self, count):
+        """قنوات إضافية حتى تنشئ عمليات التفعيل روابط دعوة ويخرج الفحص المستخدمين منها"""
+        self.system.conn.executemany('''
+            INSERT OR IGNORE INTO additional_channels (channel_id, channel_username, channel_name, added_by, is_active)
+            VALUES (?, ?, ?, ?, TRUE)
+        ''', [(str(-1009000000000 - i), f"@load_channel_{i}", f"قناة {i}", ADMIN_USER_ID) for i in range(count)])
+        self.system.conn.commit()
+
+    async def seed_expired(self, count):
+        """إدخال مشتركين منتهين مباشرة في القاعدة"""
+        expired_at = self.main.epoch_now() - 86400
+        # روابط الدعوة تحدد القنوات التي يخرج منها المستخدم عند الانتهاء
+        invite_links = json.dumps([
+            {"channel_id": channel["id"], "channel_name": channel["name"],
+             "channel_username": channel["username"], "invite_link": "https://t.me/+seed"}
+            for channel in await self.system.get_additional_channels_only()
+        ])
+        rows = [
+            (4000000 + i, f"user{i}", "user", "", f"SEED{i:08d}", expired_at, invite_links)
+            for i in range(count)
+        ]
+        self.system.conn.executemany('''
+            INSERT OR IGNORE INTO subscribers (user_id, username, first_name, last_name, code_used, expires_at, invite_links, is_active)
+            VALUES (?, ?, ?, ?, ?, ?, ?, TRUE)
+        ''', rows)
+        self.system.conn.commit()
+
+    async def scenario_sweep(self):
+        """فحص الاشتراكات المنتهية على عدد كبير من المشتركين مع تفاعل المستخدمين أثناءه"""
+        await self.seed_expired(self.args.subscribers)
+        api_before = dict(self.api.requests)
+        db_before = db_snapshot(self.main)
+
+        started = time.perf_counter()
+        sweep = asyncio.get_running_loop().create_task(self.system.check_expired_subscriptions_async())
+        # قياس تأثير الفحص على زمن استجابة المستخدمين
+        interactive = await self.drive("sweep_interactive", [
+            [message_update(self.next_id(), 5000000 + i, "/start")]
+            for i in range(self.args.users)
+        ])
+        await sweep
+        wall = time.perf_counter() - started
+
+        stats = self.system.task_queue.stats()
+        return {
+            "scenario": "sweep",
+            "subscribers": self.args.subscribers,
+            "wall_seconds": round(wall, 3),
+            "subscribers_per_second": round(self.args.subscribers / wall, 2) if wall else 0.0,
+            "task_queue": stats,
+            "api_calls": {
+                method: count - api_before.get(method, 0)
+                for method, count in self.api.requests.items()
+                if count - api_before.get(method, 0)
+            },
+            "database": db_report(db_before, db_snapshot(self.main), wall),
+            "interactive_during_sweep": {
+                key: interactive[key]
+                for key in ("updates", "latency_p50_ms", "latency_p99_ms", "latency_max_ms")
+            },
+        }
+
+def print_result(result):
+    print(f"\n📊 السيناريو: {result['scenario']}")
+    for key, value in result.items():
+        if key in ("scenario", "database"):
+            continue
+        print(f"   {key}: {value}")
+    database = result["database"]
+    print(f"   🗄️ زمن القاعدة: {database['db_seconds']}s ({database['db_share_of_wall'] * 100:.1f}% من الوقت)، "
+          f"عمليات بطيئة: {database['slow_operations']}")
+    for entry in database["top_methods"]:
+        print(f"      • {entry['method']}: {entry['seconds']}s في {entry['calls']} عملية ({entry['slow']} بطيئة)")
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix="bot-load-")
+    os.environ.update({
+        "BOT_TOKEN": FAKE_TOKEN,
+        "ADMIN_IDS": str(ADMIN_USER_ID),
+        "DATABASE_PATH": os.path.join(workdir, "load_test.db"),
+        "LOG_FILE": os.path.join(workdir, "load_test.log"),
+        "LOG_LEVEL": args.log_level,
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{args.port}/bot",
+        "MAX_CONCURRENT_UPDATES": str(args.concurrency),
+        "BOT_RATE_LIMIT": str(args.bot_rate_limit),
+        "INBOUND_POLICY": args.inbound_policy,
+        "BOT_MODE": "polling",
+    })
+    # المسار النسبي لملف النتائج يبقى نسبياً لمجلد التشغيل وليس لمجلد الاختبار
+    if args.json:
+        args.json = os.path.abspath(args.json)
+    # الملفات المؤقتة التي ينشئها البوت (مثل ملفات الأكواد) تكتب في مجلد الاختبار
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+
+    api = FakeBotAPI(args.port, args.latency_ms, args.jitter_ms, args.rate_429, args.retry_after, args.api_rps)
+    await api.start()
+    test = LoadTest(main, api, args)
+    await test.setup()
+
+    scenarios = ["interactions", "redeem", "codegen", "sweep", "flood"] if args.scenario == "all" else [args.scenario]
+    results = []
+    try:
+        for name in scenarios:
+            print(f"🚀 تشغيل السيناريو {name}...")
+            result = await getattr(test, f"scenario_{name}")()
+            print_result(result)
+            results.append(result)
+    finally:
+        await test.teardown()
+        await api.stop()
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 تم حفظ النتائج في {args.json}")
+    print(f"📁 مجلد الاختبار: {workdir}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="اختبار حمل بوت الاشتراكات مع Bot API وهمي")
+    parser.add_argument("--scenario", choices=["interactions", "redeem", "codegen", "sweep", "flood", "all"], default="all")
+    parser.add_argument("--users", type=int, default=200, help="عدد المستخدمين المصطنعين")
+    parser.add_argument("--clients", type=int, default=100, help="عدد المستخدمين النشطين في نفس الوقت")
+    parser.add_argument("--concurrency", type=int, default=32, help="MAX_CONCURRENT_UPDATES للبوت")
+    parser.add_argument("--subscribers", type=int, default=1000, help="عدد المشتركين المنتهين في سيناريو sweep")
+    parser.add_argument("--channels", type=int, default=2, help="عدد القنوات الإضافية")
+    parser.add_argument("--flood-users", type=int, default=5, help="عدد المستخدمين المغرقين في سيناريو flood")
+    parser.add_argument("--flood-messages", type=int, default=200, help="عدد رسائل كل مستخدم مغرق")
+    parser.add_argument("--inbound-policy", default="reply_once", help="INBOUND_POLICY للبوت (drop | delay | reply_once)")
+    parser.add_argument("--batches", type=int, default=5, help="عدد دفعات /createmultiple")
+    parser.add_argument("--batch-size", type=int, default=200, help="عدد الأكواد في كل دفعة")
+    parser.add_argument("--latency-ms", type=float, default=50, help="متوسط تأخير Bot API الوهمي")
+    parser.add_argument("--jitter-ms", type=float, default=20, help="تفاوت التأخير")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="نسبة الطلبات المرفوضة عشوائياً بـ 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="قيمة retry_after في ردود 429")
+    parser.add_argument("--api-rps", type=int, default=0, help="حد الطلبات في الثانية قبل الرفض بـ 429 (0 بدون حد)")
+    parser.add_argument("--bot-rate-limit", type=float, default=0,
+                        help="حد الإرسال العام للبوت BOT_RATE_LIMIT (0 يعطله لقياس أقصى إنتاجية)")
+    parser.add_argument("--port", type=int, default=18081, help="منفذ الخادم الوهمي")
+    parser.add_argument("--log-level", default="CRITICAL", help="مستوى سجلات البوت أثناء الاختبار")
+    parser.add_argument("--json", help="مسار ملف JSON لحفظ النتائج")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
@@ -1,10 +1,16 @@
 import logging
+import logging.handlers
+import atexit
 import sqlite3
 import threading
 import time
-from datetime import datetime, timedelta
+# بداية قياس زمن التشغيل، قبل استيراد مكتبة Telegram (أثقل مرحلة في البدء)
+PROCESS_STARTED = time.perf_counter()
+from datetime import datetime, timedelta, timezone
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ChatInviteLink
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler, ConversationHandler
+from telegram.error import RetryAfter
+from telegram.request import HTTPXRequest
+from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler, ConversationHandler, BaseUpdateProcessor, BasePersistence, PersistenceInput, BaseRateLimiter, TypeHandler, ApplicationHandlerStop
 import secrets
 import string
 import sys
@@ -12,18 +18,44 @@ import asyncio
 import json
 import os
 import re
+import hashlib
+import hmac
+import base64
+import struct
+import gzip
+import shutil
+import signal
+import queue
+import multiprocessing
+import socket
+import contextvars
+import heapq
+import traceback
+import importlib.util
+from collections import OrderedDict
 from functools import wraps
 
-# محاولة استيراد المكتبات المطلوبة للمهام المجدولة
+# المكتبات الاختيارية يفحص وجودها فقط هنا، وتستورد عند أول استخدام حتى لا تؤخر بدء التشغيل
+def module_available(name):
+    return importlib.util.find_spec(name) is not None
+
+# المكتبات المطلوبة للمهام المجدولة (APScheduler يستورد في setup_scheduler)
 try:
     import pytz
-    from apscheduler.schedulers.background import BackgroundScheduler
-    from apscheduler.executors.pool import ThreadPoolExecutor
-    HAS_APSCHEDULER = True
+    HAS_APSCHEDULER = module_available("apscheduler")
 except ImportError:
     HAS_APSCHEDULER = False
+if not HAS_APSCHEDULER:
     print("⚠️ المكتبات المطلوبة للمهام المجدولة غير مثبتة. سيتم استخدام النظام بدون مهام مجدولة تلقائية.")
 
+# خادم HTTP غير المتزامن لوضع Webhook (يستورد في BotWebServer)
+HAS_AIOHTTP = module_available("aiohttp")
+if not HAS_AIOHTTP:
+    print("⚠️ مكتبة aiohttp غير مثبتة. سيتم استخدام وضع Polling بدون خادم HTTP.")
+
+# مشغل PostgreSQL غير المتزامن (اختياري عند تعيين DATABASE_URL، يستورد في PostgresStore)
+HAS_ASYNCPG = module_available("asyncpg")
+
 # =============================================
 # إعدادات النظام
 # =============================================
@@ -36,6 +68,99 @@ MAIN_ADMIN = os.getenv("MAIN_ADMIN", "@SPX_47")
 admin_ids_str = os.getenv("ADMIN_IDS", "7591454108")
 ADMIN_IDS = [int(id.strip()) for id in admin_ids_str.split(",")]
 
+# إعدادات وضع التشغيل (webhook أو polling)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", os.getenv("RENDER_EXTERNAL_URL", "")).rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+# الرمز السري للتحقق من أن الطلبات قادمة من Telegram، يشتق من التوكن إذا لم يحدد
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:32]
+BOT_MODE = os.getenv("BOT_MODE", "webhook" if WEBHOOK_URL else "polling").lower()
+PORT = int(os.getenv("PORT", "8080"))
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "32"))
+# عنوان Bot API بديل (خادم Bot API محلي أو الخادم الوهمي في load_test.py)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
+# عدد عمليات العمال في وضع webhook (أكثر من 1 يفعل التوزيع حسب المستخدم)
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+# معالجة التحديثات التي وصلت أثناء توقف البوت بدلاً من حذفها عند التشغيل
+CATCH_UP_UPDATES = os.getenv("CATCH_UP_UPDATES", "true").lower() in ("1", "true", "yes")
+# عدد آخر معرفات التحديثات المعالجة التي تحفظ لمنع معالجة التحديث مرتين
+UPDATE_DEDUP_WINDOW = int(os.getenv("UPDATE_DEDUP_WINDOW", "5000"))
+# حد الإرسال العام لطلبات Bot API الموجهة لمحادثات (طلب في الثانية، 0 يعطله)، يقسم على العمال
+BOT_RATE_LIMIT = float(os.getenv("BOT_RATE_LIMIT", "30"))
+# عدد مرات إعادة الطلب بعد رد 429 قبل إرجاع الخطأ للمعالج
+RATE_LIMIT_MAX_RETRIES = int(os.getenv("RATE_LIMIT_MAX_RETRIES", "2"))
+# حد التحديثات الواردة لكل مستخدم: معدل ثابت مع دفعة قصيرة، وحد أقصى في نافذة منزلقة (0 يعطل الحد)
+INBOUND_RATE = float(os.getenv("INBOUND_RATE", "1"))
+INBOUND_BURST = float(os.getenv("INBOUND_BURST", "5"))
+INBOUND_WINDOW = float(os.getenv("INBOUND_WINDOW", "60"))
+INBOUND_WINDOW_MAX = int(os.getenv("INBOUND_WINDOW_MAX", "30"))
+# تكلفة أزرار فئة action (تفعيل تجريبي، فحص المنتهية...) مقارنة بالرسالة العادية
+INBOUND_ACTION_COST = float(os.getenv("INBOUND_ACTION_COST", "3"))
+# التصرف عند التجاوز: drop يتجاهل، delay ينتظر حتى INBOUND_MAX_DELAY ثانية، reply_once يتجاهل مع تنبيه واحد
+INBOUND_POLICY = os.getenv("INBOUND_POLICY", "reply_once").lower()
+INBOUND_MAX_DELAY = float(os.getenv("INBOUND_MAX_DELAY", "5"))
+# مسار قاعدة البيانات المشتركة بين العمليات
+DATABASE_PATH = os.getenv("DATABASE_PATH", "subscriptions.db")
+# قاعدة PostgreSQL للأكواد والمشتركين (postgresql://...)، إذا لم تحدد يستخدم ملف SQLite
+DATABASE_URL = os.getenv("DATABASE_URL", "")
+DATABASE_POOL_MIN = int(os.getenv("DATABASE_POOL_MIN", "2"))
+DATABASE_POOL_MAX = int(os.getenv("DATABASE_POOL_MAX", "10"))
+# ذاكرة المشتركين المؤقتة: أقصى عدد سجلات ومدة الصلاحية بالثواني (0 يعطلها)
+SUBSCRIBER_CACHE_MAX_ENTRIES = int(os.getenv("SUBSCRIBER_CACHE_MAX_ENTRIES", "10000"))
+SUBSCRIBER_CACHE_TTL = float(os.getenv("SUBSCRIBER_CACHE_TTL", "60"))
+# بادئة اختيارية للأكواد الجديدة (مثلاً اسم الخطة أو العرض)، تفصل عن الكود بشرطة، حتى 8 أحرف أو أرقام
+CODE_PREFIX = os.getenv("CODE_PREFIX", "").upper()
+# مفتاح توقيع الأكواد (HMAC)، تعيينه يفعل الأكواد الموقعة التي لا تحفظ في جدول codes
+CODE_SIGNING_KEY = os.getenv("CODE_SIGNING_KEY", "")
+# النسخ الاحتياطي: المجلد (يفضل على قرص دائم)، الفاصل بالساعات (0 يعطل الجدولة) وعدد النسخ المحفوظة
+BACKUP_DIR = os.getenv("BACKUP_DIR", os.path.join(os.path.dirname(os.path.abspath(DATABASE_PATH)), "backups"))
+BACKUP_INTERVAL_HOURS = float(os.getenv("BACKUP_INTERVAL_HOURS", "6"))
+BACKUP_RETENTION = int(os.getenv("BACKUP_RETENTION", "14"))
+# عدد الصفحات المنسوخة في كل خطوة والانتظار بين الخطوات، حتى لا تحجز القاعدة عن الكتابة لفترة طويلة
+BACKUP_PAGES_PER_STEP = int(os.getenv("BACKUP_PAGES_PER_STEP", "256"))
+BACKUP_STEP_SLEEP = float(os.getenv("BACKUP_STEP_SLEEP", "0.05"))
+# إذا أعيد النسخ التدريجي من البداية بسبب الكتابة المستمرة لأكثر من هذه المدة، تنسخ القاعدة بخطوة واحدة
+BACKUP_MAX_SECONDS = float(os.getenv("BACKUP_MAX_SECONDS", "300"))
+# أرشفة البيانات الباردة: المشتركون المعطلون والأكواد المستهلكة الأقدم من هذه المدة تنقل لجداول الأرشيف
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "500"))
+# عدد الصفحات المعادة لنظام الملفات في كل خطوة من VACUUM التدريجي
+ARCHIVE_VACUUM_PAGES = int(os.getenv("ARCHIVE_VACUUM_PAGES", "1000"))
+# مدة عقد القيادة للمهام المجدولة بالثواني (يجدد تلقائياً كل ثلث المدة)
+LEADER_LEASE_TTL = int(os.getenv("LEADER_LEASE_TTL", "60"))
+# طابور المهام الدائم: عدد المهام المنفذة بالتوازي وحجم دفعة الحجز
+TASK_CONCURRENCY = int(os.getenv("TASK_CONCURRENCY", "5"))
+TASK_BATCH_SIZE = int(os.getenv("TASK_BATCH_SIZE", "20"))
+# الفاصل بالثواني بين دفعات حفظ بيانات المستخدمين وحالات المحادثات في القاعدة
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL", "10"))
+# حدود فحوص الصحة: تجاوزها يجعل /health يعيد 503 فيعيد Render تشغيل العملية
+HEALTH_MAX_LOOP_LAG = float(os.getenv("HEALTH_MAX_LOOP_LAG", "5"))
+HEALTH_MAX_POLL_AGE = float(os.getenv("HEALTH_MAX_POLL_AGE", "180"))
+HEALTH_MAX_SCHEDULER_AGE = float(os.getenv("HEALTH_MAX_SCHEDULER_AGE", "600"))
+HEALTH_DB_TIMEOUT = float(os.getenv("HEALTH_DB_TIMEOUT", "5"))
+READY_MAX_QUEUE_DEPTH = int(os.getenv("READY_MAX_QUEUE_DEPTH", "1000"))
+# محلل المعالجات البطيئة (يمكن تفعيله أثناء التشغيل بالأمر /profiler)
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "false").lower() in ("1", "true", "yes")
+PROFILER_TOP_N = int(os.getenv("PROFILER_TOP_N", "10"))
+PROFILER_STALL_THRESHOLD = float(os.getenv("PROFILER_STALL_THRESHOLD", "0.1"))
+PROFILER_STACK_DEPTH = int(os.getenv("PROFILER_STACK_DEPTH", "12"))
+
+def parse_lead_times(spec):
+    """تحويل "7d,3d,1d,1h" إلى قائمة (الوسم، المدة) مرتبة من الأبعد للأقرب"""
+    units = {'d': 'days', 'h': 'hours', 'm': 'minutes'}
+    leads = []
+    for item in spec.split(","):
+        item = item.strip().lower()
+        if not item or item[-1] not in units or not item[:-1].isdigit():
+            continue
+        leads.append((item, timedelta(**{units[item[-1]]: int(item[:-1])})))
+    return sorted(leads, key=lambda lead: lead[1], reverse=True)
+
+# أوقات التنبيه قبل انتهاء الاشتراك
+NOTIFICATION_LEAD_TIMES = parse_lead_times(os.getenv("NOTIFICATION_LEAD_TIMES", "7d,3d,1d,1h"))
+# عدد التنبيهات التي تحفظ حالتها في كل دفعة
+NOTIFICATION_BATCH_SIZE = int(os.getenv("NOTIFICATION_BATCH_SIZE", "50"))
+ALLOWED_UPDATES = ['message', 'callback_query']
+
 # تحديد المنطقة الزمنية بشكل صحيح
 try:
     if HAS_APSCHEDULER:
@@ -46,123 +171,3405 @@ except Exception as e:
     print(f"⚠️ خطأ في تحديد المنطقة الزمنية: {e}")
     TIMEZONE = None
 
-# حالات المحادثة
-(
-    WAITING_FOR_CODE, 
-    WAITING_FOR_ADMIN_ID, 
-    WAITING_FOR_CHANNEL_INFO, 
-    WAITING_FOR_BUTTON_TEXT, 
-    WAITING_FOR_BUTTON_RESPONSE,
-    WAITING_FOR_CHANNEL_SELECTION,
-    WAITING_FOR_CUSTOM_CHANNELS,
-    WAITING_FOR_BATCH_DETAILS,
-    WAITING_FOR_COUNT,
-    WAITING_FOR_BUTTON_COMMAND,
-    WAITING_FOR_BUTTON_DELETE,
-    WAITING_FOR_BUTTON_EDIT
-) = range(12)
+# التواريخ في القاعدة ثوان صحيحة منذ 1970 بتوقيت UTC، وتعرض بالمنطقة الزمنية المحددة
+def epoch_now():
+    return int(time.time())
+
+def format_timestamp(value, fmt='%Y-%m-%d %H:%M'):
+    """عرض طابع زمني بالمنطقة الزمنية المحددة (TIMEZONE أو توقيت الخادم)"""
+    if value is None:
+        return "-"
+    if isinstance(value, str):
+        # قيم نصية قديمة، مثلاً في مهام الطابور المضافة قبل الترحيل
+        return value[:10] if fmt == '%Y-%m-%d' else value[:16].replace('T', ' ')
+    return datetime.fromtimestamp(value, TIMEZONE).strftime(fmt)
+
+def format_date(value):
+    return format_timestamp(value, '%Y-%m-%d')
+
+def parse_legacy_timestamp(value):
+    """تحويل تاريخ نصي قديم إلى ثوان UTC: قيم isoformat كانت بتوقيت الخادم، وقيم CURRENT_TIMESTAMP بتوقيت UTC"""
+    if value is None or isinstance(value, (int, float)):
+        return None if value is None else int(value)
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if parsed.tzinfo is None and 'T' not in value:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp())
+
+# حالات المحادثة
+(
+    WAITING_FOR_CODE, 
+    WAITING_FOR_ADMIN_ID, 
+    WAITING_FOR_CHANNEL_INFO, 
+    WAITING_FOR_BUTTON_TEXT, 
+    WAITING_FOR_BUTTON_RESPONSE,
+    WAITING_FOR_CHANNEL_SELECTION,
+    WAITING_FOR_CUSTOM_CHANNELS,
+    WAITING_FOR_BATCH_DETAILS,
+    WAITING_FOR_COUNT,
+    WAITING_FOR_BUTTON_COMMAND,
+    WAITING_FOR_BUTTON_DELETE,
+    WAITING_FOR_BUTTON_EDIT
+) = range(12)
+
+# =============================================
+# نظام التسجيل
+# =============================================
+LOG_FILE = os.getenv("LOG_FILE", "subscription_bot.log")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()          # json أو text
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# مستويات لكل نظام فرعي، مثال: "bot.sweeps=DEBUG,bot.web=WARNING,httpx=INFO"
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+LOG_ROTATION = os.getenv("LOG_ROTATION", "size").lower()      # size أو time
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+
+class JsonLogFormatter(logging.Formatter):
+    """تنسيق السجلات كسطر JSON واحد لكل حدث"""
+    # الحقول القياسية في LogRecord، أي حقل آخر يعتبر من extra ويضاف للسجل
+    RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "pid": record.process,
+        }
+        for key, value in record.__dict__.items():
+            if key not in self.RESERVED and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """يضع السجل في الطابور كما هو، فيتم التنسيق والكتابة في خيط المستمع وليس في حلقة الأحداث"""
+    def prepare(self, record):
+        return record
+
+def setup_logging(log_file=LOG_FILE):
+    """إعداد خط سجلات غير معطل: QueueHandler في الخيط المستدعي و QueueListener يكتب للملف والشاشة"""
+    if LOG_FORMAT == "json":
+        formatter = JsonLogFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    
+    if LOG_ROTATION == "time":
+        file_handler = logging.handlers.TimedRotatingFileHandler(
+            log_file, when="midnight", backupCount=LOG_BACKUP_COUNT, encoding='utf-8'
+        )
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8'
+        )
+    stream_handler = logging.StreamHandler(sys.stdout)
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+    
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers[:] = [LazyQueueHandler(log_queue)]
+    root.setLevel(LOG_LEVEL)
+    
+    # httpx يسجل كل طلب HTTP (بما فيها getUpdates) بمستوى INFO
+    levels = {"httpx": "WARNING", "apscheduler": "WARNING"}
+    for item in LOG_LEVELS.split(","):
+        if "=" in item:
+            name, level = item.split("=", 1)
+            levels[name.strip()] = level.strip().upper()
+    for name, level in levels.items():
+        logging.getLogger(name).setLevel(level)
+    
+    listener = logging.handlers.QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+def use_worker_log_file(worker_name):
+    """عمال BOT_WORKERS عمليات منفصلة، وتدوير نفس الملف من عدة عمليات يفقد السجلات أو يخلطها،
+    فلكل عامل ملفه باسمه (ثابت عند إعادة تشغيل العامل): subscription_bot.bot-worker-0.log"""
+    global log_listener
+    atexit.unregister(log_listener.stop)
+    log_listener.stop()
+    for handler in log_listener.handlers:
+        handler.close()
+    base, ext = os.path.splitext(LOG_FILE)
+    log_listener = setup_logging(f"{base}.{worker_name}{ext}")
+
+log_listener = setup_logging()
+logger = logging.getLogger("bot")
+# مسجلات الأنظمة الفرعية، يمكن التحكم بمستوى كل منها عبر LOG_LEVELS
+sweep_logger = logger.getChild("sweeps")
+web_logger = logger.getChild("web")
+
+# =============================================
+# مقاييس التشغيل بصيغة Prometheus
+# =============================================
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def escape_label_value(value):
+    """تهريب قيمة الوسم حسب صيغة Prometheus النصية"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Metric:
+    """أساس المقاييس: سلاسل مفهرسة بقيم الوسوم مع حد أقصى لعددها"""
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=(), max_series=500):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.max_series = max_series
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def key(self, labels):
+        """مفتاح السلسلة، القيم الزائدة عن الحد تجمع تحت "other" حتى لا تتضخم الذاكرة"""
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        if key not in self.series and len(self.series) >= self.max_series:
+            key = tuple("other" for _ in self.labelnames)
+        return key
+
+    def format_labels(self, key, extra=None):
+        pairs = list(zip(self.labelnames, key))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in pairs) + "}"
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for key, value in sorted(self.series.items()):
+                lines.extend(self.render_series(key, value))
+        return lines
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        with self.lock:
+            key = self.key(labels)
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def render_series(self, key, value):
+        return [f"{self.name}{self.format_labels(key)} {value}"]
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.series[self.key(labels)] = value
+
+    def render_series(self, key, value):
+        return [f"{self.name}{self.format_labels(key)} {value}"]
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, max_series=500):
+        super().__init__(name, documentation, labelnames, max_series)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        with self.lock:
+            key = self.key(labels)
+            entry = self.series.get(key)
+            if entry is None:
+                # [عدادات الفئات غير التراكمية، المجموع، العدد]
+                entry = self.series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def render_series(self, key, value):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            lines.append(f"{self.name}_bucket{self.format_labels(key, ('le', repr(float(bound))))} {cumulative}")
+        lines.append(f"{self.name}_bucket{self.format_labels(key, ('le', '+Inf'))} {count}")
+        lines.append(f"{self.name}_sum{self.format_labels(key)} {total}")
+        lines.append(f"{self.name}_count{self.format_labels(key)} {count}")
+        return lines
+
+class MetricsRegistry:
+    """سجل المقاييس الخاص بالعملية الحالية، يعرض عبر المسار /metrics"""
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+HANDLER_SECONDS = metrics.histogram(
+    "bot_handler_duration_seconds", "مدة معالجة التحديث حسب الأمر أو الزر", ("route",))
+HANDLER_ERRORS = metrics.counter(
+    "bot_handler_errors_total", "التحديثات التي انتهت معالجتها باستثناء", ("route",))
+DB_QUERY_SECONDS = metrics.histogram(
+    "bot_db_query_seconds", "زمن استعلامات SQLite حسب الدالة المستدعية", ("method",),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0, 30.0))
+DB_COMMIT_SECONDS = metrics.histogram(
+    "bot_db_commit_seconds", "زمن تثبيت معاملات SQLite حسب الدالة المستدعية", ("method",),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0, 30.0))
+TELEGRAM_API_REQUESTS = metrics.counter(
+    "bot_telegram_api_requests_total", "طلبات Bot API حسب الدالة ورمز الحالة", ("method", "status"))
+TELEGRAM_API_SECONDS = metrics.histogram(
+    "bot_telegram_api_duration_seconds", "زمن طلبات Bot API حسب الدالة", ("method",))
+RATE_LIMIT_WAITS = metrics.counter(
+    "bot_rate_limit_waits_total", "مرات الانتظار بسبب حدود الإرسال أو إعادة المحاولة", ("reason",))
+RATE_LIMIT_WAIT_SECONDS = metrics.counter(
+    "bot_rate_limit_wait_seconds_total", "إجمالي ثواني الانتظار بسبب حدود الإرسال", ("reason",))
+SWEEP_SECONDS = metrics.histogram(
+    "bot_sweep_duration_seconds", "مدة المهام المجدولة التي نفذت كقائد", ("job",),
+    buckets=(0.1, 0.5, 1.0, 5.0, 15.0, 30.0, 60.0, 300.0, 900.0, 1800.0))
+SWEEP_RUNS = metrics.counter(
+    "bot_sweep_runs_total", "تشغيلات المهام المجدولة حسب النتيجة", ("job", "outcome"))
+TASKS_PROCESSED = metrics.counter(
+    "bot_tasks_processed_total", "مهام الطابور الدائم المعالجة حسب النوع والنتيجة", ("kind", "outcome"))
+ARCHIVED_ROWS = metrics.counter(
+    "bot_archived_rows_total", "الصفوف المنقولة لجداول الأرشيف", ("table",))
+
+async def rate_limited_sleep(seconds, reason):
+    """انتظار مع تسجيله في مقاييس حدود الإرسال"""
+    RATE_LIMIT_WAITS.inc(reason=reason)
+    RATE_LIMIT_WAIT_SECONDS.inc(seconds, reason=reason)
+    await asyncio.sleep(seconds)
+
+class BotRateLimiter(BaseRateLimiter):
+    """حد إرسال عام للبوت (token bucket) لكل الطلبات الموجهة لمحادثة، ورد 429 يوقف كل الطلبات حتى انتهاء مدته"""
+    def __init__(self, rate=BOT_RATE_LIMIT, max_retries=RATE_LIMIT_MAX_RETRIES):
+        self.rate = rate
+        self.burst = max(1.0, rate)
+        self.max_retries = max_retries
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        # المنتظرون يمرون بترتيب وصولهم
+        self.lock = asyncio.Lock()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await rate_limited_sleep(self.paused_until - now, "retry_after")
+                    continue
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await rate_limited_sleep((1 - self.tokens) / self.rate, "global_limit")
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        # getUpdates و getMe وردود الأزرار لا تخضع لحدود الإرسال
+        limited = "chat_id" in data
+        max_retries = rate_limit_args if isinstance(rate_limit_args, int) else self.max_retries
+        for attempt in range(max_retries + 1):
+            if limited:
+                await self.acquire()
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt >= max_retries:
+                    raise
+                logger.warning(f"⚠️ {endpoint}: تجاوز حد الإرسال، إيقاف الطلبات {e.retry_after} ثانية")
+                self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+                if not limited:
+                    await rate_limited_sleep(e.retry_after, "retry_after")
+
+class InstrumentedHTTPXRequest(HTTPXRequest):
+    """طبقة HTTP للبوت تسجل كل طلب لـ Bot API حسب الدالة ورمز الحالة"""
+    async def do_request(self, url, method, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        status = "error"
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+            status = str(code)
+            if api_method == "getUpdates" and code == 200:
+                health_monitor.mark("get_updates")
+            return code, payload
+        finally:
+            TELEGRAM_API_SECONDS.observe(time.perf_counter() - started, method=api_method)
+            TELEGRAM_API_REQUESTS.inc(method=api_method, status=status)
+
+# مجمع زمن القاعدة للمعالج الحالي، يضبطه محلل المعالجات لكل تنفيذ
+db_time_var = contextvars.ContextVar("db_time", default=None)
+
+def record_db_time(histogram, elapsed):
+    histogram.observe(elapsed, method=db_caller())
+    accumulator = db_time_var.get()
+    if accumulator is not None:
+        accumulator[0] += elapsed
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """مؤشر SQLite يقيس زمن كل استعلام وينسبه للدالة التي استدعته"""
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_db_time(DB_QUERY_SECONDS, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_db_time(DB_QUERY_SECONDS, time.perf_counter() - started)
+
+    def fetchall(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            record_db_time(DB_QUERY_SECONDS, time.perf_counter() - started)
+
+class InstrumentedConnection(sqlite3.Connection):
+    """اتصال SQLite ينشئ مؤشرات مقاسة ويقيس زمن التثبيت، يمرر إلى sqlite3.connect عبر factory"""
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        # Connection.execute الأصلية تتجاوز المؤشر المخصص، لذا نمررها عبره
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            record_db_time(DB_COMMIT_SECONDS, time.perf_counter() - started)
+
+INSTRUMENTED_DB_CODES = {
+    InstrumentedCursor.execute.__code__, InstrumentedCursor.executemany.__code__,
+    InstrumentedCursor.fetchall.__code__, InstrumentedConnection.execute.__code__,
+    InstrumentedConnection.executemany.__code__, InstrumentedConnection.commit.__code__,
+}
+
+def db_caller():
+    """اسم أول دالة خارج طبقة القياس في مكدس الاستدعاء"""
+    frame = sys._getframe(2)
+    while frame is not None and frame.f_code in INSTRUMENTED_DB_CODES:
+        frame = frame.f_back
+    return frame.f_code.co_name if frame is not None else "unknown"
+
+# =============================================
+# مراقبة صحة عملية البوت
+# =============================================
+EVENT_LOOP_LAG = metrics.gauge("bot_event_loop_lag_seconds", "آخر تأخير مقاس لحلقة الأحداث")
+EVENT_LOOP_LAG_HISTOGRAM = metrics.histogram(
+    "bot_event_loop_lag_distribution_seconds", "توزيع تأخير حلقة الأحداث",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0))
+
+class HealthMonitor:
+    """يجمع مؤشرات الصحة من داخل عملية البوت نفسها لتعكس /health و /ready حالتها الفعلية"""
+    def __init__(self):
+        self.started_at = time.time()
+        self.last_seen = {}
+        self.loop_lag = 0.0
+        self.max_loop_lag = 0.0
+        self.system = None
+        self.application = None
+        self.mode = BOT_MODE
+        # فحوص إضافية (name, ok, details) تضيفها أنماط التشغيل الأخرى مثل واجهة العمال
+        self.extra_checks = []
+        self._sampler = None
+
+    def bind(self, system=None, application=None, mode=None):
+        """ربط المراقب بنظام البوت وتطبيقه بعد إنشائهما"""
+        self.system = system or self.system
+        self.application = application or self.application
+        self.mode = mode or self.mode
+
+    def mark(self, name):
+        """تسجيل آخر وقت نجح فيه حدث (getUpdates، webhook، معالجة تحديث)"""
+        self.last_seen[name] = time.time()
+
+    def age(self, name):
+        seen = self.last_seen.get(name)
+        return None if seen is None else round(time.time() - seen, 3)
+
+    def start(self, interval=1.0):
+        """بدء قياس تأخير حلقة الأحداث في الحلقة الحالية"""
+        if self._sampler is None:
+            self._sampler = asyncio.get_running_loop().create_task(self.sample_loop_lag(interval))
+
+    async def stop(self):
+        if self._sampler:
+            self._sampler.cancel()
+            try:
+                await self._sampler
+            except asyncio.CancelledError:
+                pass
+            self._sampler = None
+
+    async def sample_loop_lag(self, interval):
+        """النوم لفترة ثابتة وقياس التأخير الزائد عنها، وهو الوقت الذي كانت فيه الحلقة محجوزة"""
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(interval)
+            lag = max(0.0, loop.time() - started - interval)
+            self.loop_lag = lag
+            self.max_loop_lag = max(self.max_loop_lag * 0.9, lag)
+            EVENT_LOOP_LAG.set(round(lag, 6))
+            EVENT_LOOP_LAG_HISTOGRAM.observe(lag)
+
+    def ping_db(self):
+        """قراءة من القاعدة باتصال للقراءة فقط: في وضع WAL لا تنتظر الكتّاب، فلا يفشل الفحص بسبب ضغط الكتابة وحده"""
+        started = time.perf_counter()
+        conn = sqlite3.connect(f"file:{self.system.db_path}?mode=ro", uri=True, timeout=HEALTH_DB_TIMEOUT)
+        try:
+            conn.execute('SELECT 1 FROM sqlite_master LIMIT 1').fetchall()
+        finally:
+            conn.close()
+        return time.perf_counter() - started
+
+    def scheduler_check(self):
+        """حالة المهام المجدولة وآخر تشغيل لكل منها"""
+        scheduler = self.system.scheduler
+        jobs = {}
+        for job_id, run in self.system.job_runs.items():
+            jobs[job_id] = {"last_run_age": round(time.time() - run["at"], 3), "ok": run["ok"]}
+        if scheduler is not None:
+            for job in scheduler.get_jobs():
+                entry = jobs.setdefault(job.id, {})
+                entry["next_run"] = job.next_run_time.isoformat() if job.next_run_time else None
+        
+        expected = self.system.scheduler_expected
+        running = bool(scheduler and scheduler.running)
+        ok = running or not expected
+        # مهمة الاستئناف تعمل كل دقيقة، فغياب أي تشغيل لفترة طويلة يعني أن خيوط المجدول عالقة
+        last_run = max((run["at"] for run in self.system.job_runs.values()), default=self.started_at)
+        if running and time.time() - last_run > HEALTH_MAX_SCHEDULER_AGE:
+            ok = False
+        return {"ok": ok, "expected": expected, "running": running, "jobs": jobs}
+
+    async def check(self, readiness=False):
+        """تنفيذ الفحوص وإرجاع (سليم؟، التفاصيل)"""
+        loop = asyncio.get_running_loop()
+        checks = {}
+        
+        checks["event_loop"] = {
+            "ok": self.loop_lag <= HEALTH_MAX_LOOP_LAG,
+            "lag_seconds": round(self.loop_lag, 4),
+            "max_lag_seconds": round(self.max_loop_lag, 4),
+        }
+        
+        updates = {
+            "ok": True,
+            "mode": self.mode,
+            "last_update_age": self.age("update"),
+            "last_get_updates_age": self.age("get_updates"),
+            "last_webhook_age": self.age("webhook"),
+        }
+        if self.mode == "polling" and self.application is not None:
+            # getUpdates ينجح مرة كل مهلة استطلاع حتى بدون رسائل، فتوقفه يعني أن الاستطلاع عالق
+            last_poll = self.last_seen.get("get_updates", self.started_at)
+            updates["ok"] = time.time() - last_poll <= HEALTH_MAX_POLL_AGE
+        checks["updates"] = updates
+        
+        if self.application is not None:
+            processor = self.application.update_processor
+            depth = self.application.update_queue.qsize()
+            checks["queues"] = {
+                "ok": not readiness or depth <= READY_MAX_QUEUE_DEPTH,
+                "update_queue": depth,
+                "in_flight": getattr(processor, "in_flight", None),
+                "running": self.application.running,
+            }
+            if readiness and not self.application.running:
+                checks["queues"]["ok"] = False
+        
+        if self.system is not None:
+            try:
+                latency = await asyncio.wait_for(
+                    loop.run_in_executor(None, self.ping_db), HEALTH_DB_TIMEOUT + 1
+                )
+                checks["database"] = {"ok": True, "ping_seconds": round(latency, 4)}
+            except Exception as e:
+                checks["database"] = {"ok": False, "error": str(e) or type(e).__name__}
+            
+            if readiness:
+                try:
+                    checks["database"]["task_queue"] = await asyncio.wait_for(
+                        loop.run_in_executor(None, self.system.task_queue.stats), HEALTH_DB_TIMEOUT + 1
+                    )
+                except Exception as e:
+                    checks["database"]["task_queue"] = {"error": str(e) or type(e).__name__}
+            
+            checks["scheduler"] = self.scheduler_check()
+        
+        for extra_check in self.extra_checks:
+            name, ok, details = extra_check()
+            checks[name] = dict(details, ok=ok)
+        
+        healthy = all(check["ok"] for check in checks.values())
+        return healthy, checks
+
+health_monitor = HealthMonitor()
+
+# =============================================
+# زمن بدء التشغيل
+# =============================================
+STARTUP_SECONDS = metrics.gauge(
+    "bot_startup_seconds", "مدة كل مرحلة من بدء العملية حتى معالجة أول تحديث", ("phase",))
+
+class StartupTimer:
+    """يقيس مراحل بدء التشغيل (الاستيراد، القاعدة، التهيئة، الاستطلاع...) حتى أول تحديث معالج"""
+    def __init__(self, started=PROCESS_STARTED):
+        self.started = started
+        self.last = started
+        self.phases = []
+        self.ready_after = None
+        self.first_update_after = None
+
+    def mark(self, phase):
+        """تسجيل مدة المرحلة التي انتهت الآن"""
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        STARTUP_SECONDS.set(round(now - self.last, 4), phase=phase)
+        self.last = now
+
+    def summary(self):
+        return ", ".join(f"{phase} {seconds * 1000:.0f}ms" for phase, seconds in self.phases)
+
+    def ready(self):
+        """البوت جاهز لاستقبال التحديثات"""
+        self.ready_after = time.perf_counter() - self.started
+        STARTUP_SECONDS.set(round(self.ready_after, 4), phase="ready")
+        logger.info(f"⏱️ البوت جاهز خلال {self.ready_after:.3f}s ({self.summary()})")
+
+    def first_update(self):
+        """يستدعى بعد معالجة كل تحديث، ويسجل الأول فقط"""
+        if self.first_update_after is not None:
+            return
+        self.first_update_after = time.perf_counter() - self.started
+        STARTUP_SECONDS.set(round(self.first_update_after, 4), phase="first_update")
+        logger.info(f"⏱️ أول تحديث عولج بعد {self.first_update_after:.3f}s من بدء العملية")
+
+    def report(self):
+        """ملخص المراحل لصفحة /status"""
+        return {
+            "phases_ms": {phase: round(seconds * 1000, 1) for phase, seconds in self.phases},
+            "ready_seconds": None if self.ready_after is None else round(self.ready_after, 3),
+            "first_update_seconds": None if self.first_update_after is None else round(self.first_update_after, 3),
+        }
+
+startup_timer = StartupTimer()
+
+# =============================================
+# محلل المعالجات البطيئة
+# =============================================
+HANDLER_BLOCKED_SECONDS = metrics.histogram(
+    "bot_handler_blocked_seconds", "الوقت الذي حجز فيه المعالج حلقة الأحداث (عند تفعيل المحلل)", ("route",))
+HANDLER_DB_SECONDS = metrics.histogram(
+    "bot_handler_db_seconds", "زمن SQLite داخل المعالج (عند تفعيل المحلل)", ("route",))
+LOOP_STALLS = metrics.counter(
+    "bot_event_loop_stalls_total", "مرات توقف حلقة الأحداث أطول من حد المحلل", ("route",))
+
+class ProfiledInvocation:
+    """قياسات تنفيذ واحد لمعالج"""
+    __slots__ = ("route", "user_id", "started_at", "wall", "blocked", "db", "samples", "step_started")
+
+    def __init__(self, route, user_id):
+        self.route = route
+        self.user_id = user_id
+        self.started_at = time.time()
+        self.wall = 0.0
+        self.blocked = 0.0
+        self.db = [0.0]
+        self.samples = []
+        self.step_started = None
+
+class StepTimer:
+    """يقود الدالة غير المتزامنة خطوة بخطوة ويجمع زمن كل خطوة، وهو الوقت الذي لم تستطع فيه الحلقة تنفيذ غيرها"""
+    def __init__(self, coroutine, invocation, profiler):
+        self.coroutine = coroutine
+        self.invocation = invocation
+        self.profiler = profiler
+
+    def __await__(self):
+        invocation = self.invocation
+        value, error = None, None
+        while True:
+            invocation.step_started = time.perf_counter()
+            self.profiler.current = invocation
+            try:
+                if error is not None:
+                    yielded = self.coroutine.throw(error)
+                else:
+                    yielded = self.coroutine.send(value)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                invocation.blocked += time.perf_counter() - invocation.step_started
+                invocation.step_started = None
+                self.profiler.current = None
+            try:
+                value, error = (yield yielded), None
+            except BaseException as e:
+                value, error = None, e
+
+class HandlerProfiler:
+    """يسجل زمن كل معالج الكلي والمحجوز وزمن القاعدة، ويحتفظ بأبطأ التنفيذات مع عينات من المكدس"""
+    def __init__(self, top_n=PROFILER_TOP_N, stall_threshold=PROFILER_STALL_THRESHOLD):
+        self.enabled = False
+        self.top_n = top_n
+        self.stall_threshold = stall_threshold
+        self.current = None
+        self.lock = threading.Lock()
+        self.slowest = []        # (wall, seq, invocation) كومة صغرى بحجم top_n
+        self.routes = {}         # route -> [count, wall, blocked, db, max_wall]
+        self.seq = 0
+        self.loop_thread_id = None
+        self.heartbeat = 0.0
+        self._ticker = None
+        self._watchdog = None
+        self._stop = threading.Event()
+
+    def enable(self):
+        """تفعيل المحلل من داخل حلقة الأحداث"""
+        if self.enabled:
+            return
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.perf_counter()
+        self._stop.clear()
+        self._ticker = asyncio.get_running_loop().create_task(self.tick())
+        self._watchdog = threading.Thread(target=self.watch, name="profiler-watchdog", daemon=True)
+        self._watchdog.start()
+        self.enabled = True
+        logger.info("🔬 تم تفعيل محلل المعالجات")
+
+    def disable(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        self._stop.set()
+        if self._ticker:
+            self._ticker.cancel()
+            self._ticker = None
+        logger.info("🔬 تم إيقاف محلل المعالجات")
+
+    def reset(self):
+        with self.lock:
+            self.slowest = []
+            self.routes = {}
+
+    async def tick(self):
+        """نبض الحلقة: تأخره يعني أن شيئاً ما يحجزها"""
+        while True:
+            self.heartbeat = time.perf_counter()
+            await asyncio.sleep(self.stall_threshold / 2)
+
+    def watch(self):
+        """خيط مراقبة يلتقط مكدس خيط الحلقة عندما يتأخر النبض أكثر من الحد"""
+        interval = self.stall_threshold / 2
+        last_sampled = 0.0
+        while not self._stop.wait(interval):
+            now = time.perf_counter()
+            if now - self.heartbeat < self.stall_threshold or now - last_sampled < self.stall_threshold:
+                continue
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+            last_sampled = now
+            stack = "".join(traceback.format_stack(frame, limit=PROFILER_STACK_DEPTH))
+            invocation = self.current
+            route = invocation.route if invocation else "unattributed"
+            LOOP_STALLS.inc(route=route)
+            if invocation is not None:
+                if len(invocation.samples) < 5:
+                    invocation.samples.append(stack)
+            else:
+                logger.warning(f"🐢 حلقة الأحداث متوقفة منذ {now - self.heartbeat:.2f} ثانية خارج المعالجات:\n{stack}")
+
+    async def run(self, route, coroutine, update=None):
+        """تنفيذ المعالج تحت القياس"""
+        user = update.effective_user if isinstance(update, Update) else None
+        invocation = ProfiledInvocation(route, user.id if user else None)
+        token = db_time_var.set(invocation.db)
+        started = time.perf_counter()
+        try:
+            await StepTimer(coroutine, invocation, self)
+        finally:
+            invocation.wall = time.perf_counter() - started
+            db_time_var.reset(token)
+            self.record(invocation)
+
+    def record(self, invocation):
+        HANDLER_BLOCKED_SECONDS.observe(invocation.blocked, route=invocation.route)
+        HANDLER_DB_SECONDS.observe(invocation.db[0], route=invocation.route)
+        with self.lock:
+            totals = self.routes.setdefault(invocation.route, [0, 0.0, 0.0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += invocation.wall
+            totals[2] += invocation.blocked
+            totals[3] += invocation.db[0]
+            totals[4] = max(totals[4], invocation.wall)
+            self.seq += 1
+            entry = (invocation.wall, self.seq, invocation)
+            if len(self.slowest) < self.top_n:
+                heapq.heappush(self.slowest, entry)
+            elif entry > self.slowest[0]:
+                heapq.heapreplace(self.slowest, entry)
+
+    def report(self, with_stacks=False):
+        """نص التقرير: المسارات الأكثر حجزاً للحلقة ثم أبطأ التنفيذات"""
+        with self.lock:
+            routes = sorted(self.routes.items(), key=lambda item: item[1][2], reverse=True)
+            slowest = sorted(self.slowest, reverse=True)
+        
+        lines = [f"🔬 محلل المعالجات ({'مفعل' if self.enabled else 'متوقف'})", ""]
+        lines.append("📊 المسارات (العدد | الكلي | المحجوز | القاعدة | الأقصى):")
+        for route, (count, wall, blocked, db, max_wall) in routes[:self.top_n]:
+            lines.append(f"• {route}: {count} | {wall:.3f}s | {blocked:.3f}s | {db:.3f}s | {max_wall:.3f}s")
+        lines.append("")
+        lines.append(f"🐢 أبطأ {len(slowest)} تنفيذات:")
+        for wall, _, invocation in slowest:
+            lines.append(
+                f"• {invocation.route} (المستخدم {invocation.user_id}): {wall:.3f}s، "
+                f"محجوز {invocation.blocked:.3f}s، القاعدة {invocation.db[0]:.3f}s، "
+                f"عينات {len(invocation.samples)}"
+            )
+            if with_stacks:
+                for sample in invocation.samples:
+                    lines.append(sample)
+        return "\n".join(lines)
+
+handler_profiler = HandlerProfiler()
+
+# =============================================
+# ديكوراتور إعادة المحاولة
+# =============================================
+def retry_async(max_retries=3, delay=1.0):
+    """ديكوراتور لإعادة المحاولة للدوال غير المتزامنة"""
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            last_exception = None
+            for attempt in range(max_retries):
+                try:
+                    return await func(*args, **kwargs)
+                except Exception as e:
+                    last_exception = e
+                    if attempt < max_retries - 1:
+                        wait_time = delay * (2 ** attempt)  # exponential backoff
+                        reason = "retry"
+                        if isinstance(e, RetryAfter):
+                            # Telegram يحدد مدة الانتظار المطلوبة عند تجاوز حد الإرسال
+                            wait_time = max(wait_time, e.retry_after)
+                            reason = "retry_after"
+                        logger.warning(f"⚠️ محاولة {attempt + 1} فشلت، إعادة المحاولة بعد {wait_time} ثانية: {e}")
+                        await rate_limited_sleep(wait_time, reason)
+                    else:
+                        logger.error(f"❌ فشلت جميع {max_retries} محاولات: {e}")
+            raise last_exception
+        return wrapper
+    return decorator
+
+# =============================================
+# معالجة التحديثات بالتوازي مع الحفاظ على ترتيب كل مستخدم
+# =============================================
+# الأوامر المسجلة في التطبيق (الثابتة والأزرار الديناميكية)، وأي نص آخر يبدأ بـ / يظهر في المقاييس كـ command:other
+KNOWN_COMMANDS = set()
+
+def register_command_labels(handlers):
+    """إضافة أوامر CommandHandler (ومنها داخل ConversationHandler) لأسماء المسارات المسموحة في المقاييس"""
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            register_command_labels(handler.entry_points)
+            for state_handlers in handler.states.values():
+                register_command_labels(state_handlers)
+            register_command_labels(handler.fallbacks)
+        elif isinstance(handler, CommandHandler):
+            KNOWN_COMMANDS.update(handler.commands)
+
+class OrderedUpdateProcessor(BaseUpdateProcessor):
+    """يعالج تحديثات المستخدمين المختلفين بالتوازي، وتحديثات نفس المحادثة بالترتيب"""
+    def __init__(self, max_concurrent_updates=MAX_CONCURRENT_UPDATES, max_pending_updates=None, on_processed=None, admission=None):
+        # الحد الموروث يحدد عدد التحديثات المعلقة، أما التنفيذ الفعلي فيحده self._active
+        # حتى لا تستهلك تحديثات مستخدم ينتظر دوره مقاعد المستخدمين الآخرين
+        super().__init__(max_pending_updates or max_concurrent_updates * 16)
+        self.concurrency_limit = max_concurrent_updates
+        self._active = asyncio.Semaphore(max_concurrent_updates)
+        self._key_locks = {}
+        self.in_flight = 0
+        # يستدعى مع التحديث بعد انتهاء معالجته (تسجيله في SQLitePersistence كتحديث معالج)
+        self.on_processed = on_processed
+        # ينتظر قبل حجز مقعد التنفيذ (سياسة delay لحد الرسائل الواردة)، فلا يحجز المستخدم المتأخر مقعداً وهو نائم
+        self.admission = admission
+
+    @staticmethod
+    def ordering_key(update):
+        """مفتاح الترتيب: المحادثة أولاً ثم المستخدم، أو None للتحديثات غير المرتبطة بهما"""
+        if isinstance(update, Update):
+            if update.effective_chat:
+                return update.effective_chat.id
+            if update.effective_user:
+                return update.effective_user.id
+        return None
+
+    @staticmethod
+    def route_label(update):
+        """اسم المسار المستخدم في المقاييس: الأمر، أو اسم مسار الزر في موجه الأزرار"""
+        if not isinstance(update, Update):
+            return "other"
+        if update.callback_query:
+            route = CALLBACK_ROUTER.resolve(update.callback_query.data or "")
+            return f"callback:{route.metric if route else 'unknown'}"
+        message = update.effective_message
+        if message and message.text and message.text.startswith('/'):
+            # عدد السلاسل محدود بالأوامر المسجلة، فلا ينشئ المستخدمون سلسلة لكل نص عشوائي
+            command = message.text.split()[0].split('@')[0][1:].lower()
+            return f"command:/{command}" if command in KNOWN_COMMANDS else "command:other"
+        return "message"
+
+    async def timed(self, update, coroutine):
+        """تنفيذ المعالج مع قياس مدته"""
+        route = self.route_label(update)
+        started = time.perf_counter()
+        try:
+            if handler_profiler.enabled:
+                await handler_profiler.run(route, coroutine, update)
+            else:
+                await coroutine
+            if self.on_processed is not None:
+                self.on_processed(update)
+            health_monitor.mark("update")
+            startup_timer.first_update()
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, route=route)
+
+    async def do_process_update(self, update, coroutine):
+        """انتظار دور المحادثة ثم مقعد تنفيذ قبل معالجة التحديث"""
+        key = self.ordering_key(update)
+        self.in_flight += 1
+        if key is None:
+            try:
+                if self.admission is not None:
+                    await self.admission(update)
+                async with self._active:
+                    await self.timed(update, coroutine)
+            finally:
+                self.in_flight -= 1
+            return
+        
+        entry = self._key_locks.get(key)
+        if entry is None:
+            entry = self._key_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            # asyncio.Lock يوقظ المنتظرين بترتيب وصولهم، فيحافظ على ترتيب التحديثات
+            async with entry[0]:
+                if self.admission is not None:
+                    await self.admission(update)
+                async with self._active:
+                    await self.timed(update, coroutine)
+        finally:
+            self.in_flight -= 1
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._key_locks[key]
+
+    async def initialize(self):
+        """لا يحتاج لتهيئة"""
+
+    async def shutdown(self):
+        """لا يحتاج لإيقاف"""
+
+# =============================================
+# عقود القيادة للمهام المجدولة (Leader Election)
+# =============================================
+class LeaseBackend:
+    """واجهة تخزين عقود القيادة، يمكن استبدالها بتخزين آخر (Redis، PostgreSQL...)"""
+    def acquire(self, name, holder, ttl, min_interval=0):
+        """محاولة الحصول على العقد، تعيد رمز الحماية (fencing token) أو None"""
+        raise NotImplementedError
+
+    def renew(self, name, holder, token, ttl):
+        """تجديد العقد، يفشل إذا انتقل العقد لعقدة أخرى"""
+        raise NotImplementedError
+
+    def release(self, name, holder, token, completed=True):
+        """تحرير العقد وتسجيل اكتمال المهمة"""
+        raise NotImplementedError
+
+    def is_interrupted(self, name):
+        """هل بدأت المهمة ولم تكتمل وانتهى عقد قائدها (عقدة متوقفة)"""
+        raise NotImplementedError
+
+    def close(self):
+        """إغلاق موارد التخزين"""
+
+class SQLiteLeaseBackend(LeaseBackend):
+    """تخزين عقود القيادة في جدول SQLite مشترك بين كل العقد"""
+    def __init__(self, db_path=DATABASE_PATH):
+        # اتصال مستقل لأن التجديد يتم من خيط منفصل
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30, isolation_level=None,
+                                    factory=InstrumentedConnection)
+        self.conn.execute('PRAGMA busy_timeout=30000')
+        self.lock = threading.Lock()
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS leader_leases (
+                name TEXT PRIMARY KEY,
+                holder TEXT,
+                fencing_token INTEGER NOT NULL DEFAULT 0,
+                expires_at REAL NOT NULL DEFAULT 0,
+                started_at REAL,
+                completed_at REAL
+            )
+        ''')
+
+    def acquire(self, name, holder, ttl, min_interval=0):
+        now = time.time()
+        with self.lock:
+            try:
+                self.conn.execute('BEGIN IMMEDIATE')
+                row = self.conn.execute(
+                    'SELECT holder, fencing_token, expires_at, completed_at FROM leader_leases WHERE name = ?',
+                    (name,)
+                ).fetchone()
+                
+                if row:
+                    current_holder, token, expires_at, completed_at = row
+                    if expires_at > now and current_holder != holder:
+                        self.conn.execute('ROLLBACK')
+                        return None
+                    # عقدة أخرى أنجزت نفس التشغيل للتو
+                    if completed_at and now - completed_at < min_interval:
+                        self.conn.execute('ROLLBACK')
+                        return None
+                    token += 1
+                    self.conn.execute('''
+                        UPDATE leader_leases
+                        SET holder = ?, fencing_token = ?, expires_at = ?, started_at = ?
+                        WHERE name = ?
+                    ''', (holder, token, now + ttl, now, name))
+                else:
+                    token = 1
+                    self.conn.execute('''
+                        INSERT INTO leader_leases (name, holder, fencing_token, expires_at, started_at)
+                        VALUES (?, ?, ?, ?, ?)
+                    ''', (name, holder, token, now + ttl, now))
+                
+                self.conn.execute('COMMIT')
+                return token
+            except Exception as e:
+                if self.conn.in_transaction:
+                    self.conn.execute('ROLLBACK')
+                sweep_logger.error("❌ خطأ في الحصول على عقد القيادة %s: %s", name, e)
+                return None
+
+    def renew(self, name, holder, token, ttl):
+        with self.lock:
+            try:
+                cursor = self.conn.execute('''
+                    UPDATE leader_leases SET expires_at = ?
+                    WHERE name = ? AND holder = ? AND fencing_token = ?
+                ''', (time.time() + ttl, name, holder, token))
+                return cursor.rowcount == 1
+            except Exception as e:
+                sweep_logger.error("❌ خطأ في تجديد عقد القيادة %s: %s", name, e)
+                return False
+
+    def release(self, name, holder, token, completed=True):
+        with self.lock:
+            try:
+                if completed:
+                    self.conn.execute('''
+                        UPDATE leader_leases SET expires_at = 0, completed_at = ?
+                        WHERE name = ? AND holder = ? AND fencing_token = ?
+                    ''', (time.time(), name, holder, token))
+                else:
+                    self.conn.execute('''
+                        UPDATE leader_leases SET expires_at = 0
+                        WHERE name = ? AND holder = ? AND fencing_token = ?
+                    ''', (name, holder, token))
+            except Exception as e:
+                sweep_logger.error("❌ خطأ في تحرير عقد القيادة %s: %s", name, e)
+
+    def is_interrupted(self, name):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT expires_at, started_at, completed_at FROM leader_leases WHERE name = ?',
+                (name,)
+            ).fetchone()
+        if not row or row[1] is None:
+            return False
+        expires_at, started_at, completed_at = row
+        return expires_at < time.time() and (completed_at is None or completed_at < started_at)
+
+    def close(self):
+        self.conn.close()
+
+class PostgresBridge:
+    """اتصال PostgreSQL بواجهة متزامنة لعقود القيادة وطابور المهام (مثل اتصالي SQLite المستقلين لهما):
+    حلقة أحداث خاصة في خيط منفصل مع مجمع صغير، فتستدعى من خيط المجدول أو خيط التجديد أو حلقة البوت"""
+    def __init__(self, dsn=DATABASE_URL):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="postgres-bridge", daemon=True)
+        self.thread.start()
+        self.pool = self.run(self._open(dsn))
+
+    async def _open(self, dsn):
+        import asyncpg
+        pool = await asyncpg.create_pool(dsn, min_size=1, max_size=2)
+        await pool.execute(POSTGRES_COORDINATION_SCHEMA)
+        return pool
+
+    def run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def close(self):
+        if self.pool is None:
+            return
+        self.run(self.pool.close())
+        self.pool = None
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=5)
+
+class PostgresLeaseBackend(LeaseBackend):
+    """عقود القيادة في PostgreSQL، فتتنسق العقد التي تشارك نفس قاعدة DATABASE_URL"""
+    def __init__(self, bridge):
+        self.bridge = bridge
+
+    def acquire(self, name, holder, ttl, min_interval=0):
+        try:
+            return self.bridge.run(self._acquire(name, holder, ttl, min_interval))
+        except Exception as e:
+            sweep_logger.error("❌ خطأ في الحصول على عقد القيادة %s: %s", name, e)
+            return None
+
+    async def _acquire(self, name, holder, ttl, min_interval):
+        now = time.time()
+        async with self.bridge.pool.acquire() as conn:
+            async with conn.transaction():
+                # الصف موجود دائماً قبل القفل، فلا تتسابق عقدتان على إنشائه
+                await conn.execute('INSERT INTO leader_leases (name) VALUES ($1) ON CONFLICT (name) DO NOTHING', name)
+                row = await conn.fetchrow(
+                    'SELECT holder, fencing_token, expires_at, completed_at FROM leader_leases WHERE name = $1 FOR UPDATE',
+                    name
+                )
+                if row['expires_at'] > now and row['holder'] != holder:
+                    return None
+                # عقدة أخرى أنجزت نفس التشغيل للتو
+                if row['completed_at'] and now - row['completed_at'] < min_interval:
+                    return None
+                token = row['fencing_token'] + 1
+                await conn.execute('''
+                    UPDATE leader_leases
+                    SET holder = $2, fencing_token = $3, expires_at = $4, started_at = $5
+                    WHERE name = $1
+                ''', name, holder, token, now + ttl, now)
+                return token
+
+    def renew(self, name, holder, token, ttl):
+        try:
+            return self.bridge.run(self.bridge.pool.fetchval('''
+                UPDATE leader_leases SET expires_at = $4
+                WHERE name = $1 AND holder = $2 AND fencing_token = $3
+                RETURNING 1
+            ''', name, holder, token, time.time() + ttl)) is not None
+        except Exception as e:
+            sweep_logger.error("❌ خطأ في تجديد عقد القيادة %s: %s", name, e)
+            return False
+
+    def release(self, name, holder, token, completed=True):
+        try:
+            self.bridge.run(self.bridge.pool.execute('''
+                UPDATE leader_leases SET expires_at = 0, completed_at = CASE WHEN $4 THEN $5 ELSE completed_at END
+                WHERE name = $1 AND holder = $2 AND fencing_token = $3
+            ''', name, holder, token, completed, time.time()))
+        except Exception as e:
+            sweep_logger.error("❌ خطأ في تحرير عقد القيادة %s: %s", name, e)
+
+    def is_interrupted(self, name):
+        row = self.bridge.run(self.bridge.pool.fetchrow(
+            'SELECT expires_at, started_at, completed_at FROM leader_leases WHERE name = $1', name
+        ))
+        if not row or row['started_at'] is None:
+            return False
+        expires_at, started_at, completed_at = row
+        return expires_at < time.time() and (completed_at is None or completed_at < started_at)
+
+    def close(self):
+        self.bridge.close()
+
+class LeaderLease:
+    """عقد قيادة محجوز لمهمة واحدة مع تجديد دوري في الخلفية"""
+    def __init__(self, backend, name, holder, token, ttl):
+        self.backend = backend
+        self.name = name
+        self.holder = holder
+        self.token = token
+        self.ttl = ttl
+        self.lost = False
+        self._stop = threading.Event()
+        self._heartbeat = threading.Thread(target=self._renew_loop, name=f"lease-{name}", daemon=True)
+        self._heartbeat.start()
+
+    def _renew_loop(self):
+        while not self._stop.wait(self.ttl / 3):
+            if not self.backend.renew(self.name, self.holder, self.token, self.ttl):
+                self.lost = True
+                sweep_logger.warning("⚠️ فقدان عقد القيادة للمهمة %s (الرمز %s)", self.name, self.token)
+                return
+
+    def still_valid(self):
+        """يجب على المهمة التوقف فور فقدان العقد لتجنب تكرار العمل مع القائد الجديد"""
+        return not self.lost
+
+    def release(self, completed=True):
+        self._stop.set()
+        self.backend.release(self.name, self.holder, self.token, completed)
+
+class LeaderElection:
+    """تشغيل المهام المجدولة على عقدة واحدة فقط بين كل النسخ العاملة"""
+    def __init__(self, backend, ttl=LEADER_LEASE_TTL):
+        self.backend = backend
+        self.ttl = ttl
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+
+    def acquire(self, name, min_interval=0):
+        token = self.backend.acquire(name, self.holder, self.ttl, min_interval)
+        if token is None:
+            return None
+        return LeaderLease(self.backend, name, self.holder, token, self.ttl)
+
+# =============================================
+# طابور المهام الدائم (Durable Task Queue)
+# =============================================
+class DurableTaskQueue:
+    """طابور مهام مخزن في SQLite: كل مهمة وحدة مستقلة تحفظ حالتها ويعاد تنفيذها عند الفشل"""
+    def __init__(self, db_path=DATABASE_PATH):
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30, isolation_level=None,
+                                    factory=InstrumentedConnection)
+        self.conn.execute('PRAGMA busy_timeout=30000')
+        self.lock = threading.Lock()
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS task_queue (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL DEFAULT '{}',
+                idempotency_key TEXT UNIQUE,
+                state TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                max_attempts INTEGER NOT NULL DEFAULT 5,
+                visible_at REAL NOT NULL DEFAULT 0,
+                claimed_by TEXT,
+                last_error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_task_queue_claim ON task_queue (state, visible_at)')
+
+    def enqueue_many(self, tasks, max_attempts=5):
+        """إضافة مهام (kind, payload, idempotency_key)، المهام ذات المفتاح المكرر تتجاهل"""
+        now = time.time()
+        rows = [
+            (kind, json.dumps(payload), key, max_attempts, now, now, now)
+            for kind, payload, key in tasks
+        ]
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                before = self.conn.total_changes
+                self.conn.executemany('''
+                    INSERT OR IGNORE INTO task_queue
+                    (kind, payload, idempotency_key, max_attempts, visible_at, created_at, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', rows)
+                added = self.conn.total_changes - before
+                self.conn.execute('COMMIT')
+                return added
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def enqueue(self, kind, payload, idempotency_key=None, max_attempts=5):
+        """إضافة مهمة واحدة"""
+        return self.enqueue_many([(kind, payload, idempotency_key)], max_attempts) == 1
+
+    # شرط رمز الحماية: fence هو (اسم المهمة، رمز العقد) والكتابة تنفذ فقط إذا كان العقد ما زال بنفس الرمز
+    FENCE_SQL = 'EXISTS (SELECT 1 FROM leader_leases WHERE name = ? AND fencing_token = ?)'
+
+    def claim(self, worker_id, limit=TASK_BATCH_SIZE, visibility_timeout=300, fence=None):
+        """حجز دفعة من المهام الجاهزة، والمهام المحجوزة التي انتهت مهلتها تعود للظهور"""
+        now = time.time()
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                if fence and not self.conn.execute(f'SELECT {self.FENCE_SQL}', fence).fetchone()[0]:
+                    self.conn.execute('ROLLBACK')
+                    return []
+                # المهمة التي توقف منفذها في كل محاولاتها (انهيار العملية أثناء التنفيذ) تتوقف نهائياً بدلاً من حجزها للأبد
+                self.conn.execute('''
+                    UPDATE task_queue
+                    SET state = 'failed', last_error = COALESCE(last_error, 'انتهت مهلة التنفيذ في كل المحاولات'),
+                        updated_at = ?
+                    WHERE state = 'running' AND visible_at <= ? AND attempts >= max_attempts
+                ''', (now, now))
+                rows = self.conn.execute('''
+                    SELECT id, kind, payload, attempts FROM task_queue
+                    WHERE state IN ('pending', 'running') AND visible_at <= ? AND attempts < max_attempts
+                    ORDER BY id
+                    LIMIT ?
+                ''', (now, limit)).fetchall()
+                
+                if rows:
+                    self.conn.executemany('''
+                        UPDATE task_queue
+                        SET state = 'running', claimed_by = ?, attempts = attempts + 1,
+                            visible_at = ?, updated_at = ?
+                        WHERE id = ?
+                    ''', [(worker_id, now + visibility_timeout, now, row[0]) for row in rows])
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+        
+        return [(task_id, kind, json.loads(payload), attempts + 1) for task_id, kind, payload, attempts in rows]
+
+    def complete(self, task_id, fence=None):
+        """تعليم المهمة كمكتملة، تعيد False إذا فقد العقد (تعود المهمة للظهور ويعيدها القائد الجديد)"""
+        where, params = ('id = ?', (task_id,)) if not fence else (f'id = ? AND {self.FENCE_SQL}', (task_id, *fence))
+        with self.lock:
+            return self.conn.execute(
+                f"UPDATE task_queue SET state = 'done', last_error = NULL, updated_at = ? WHERE {where}",
+                (time.time(), *params)
+            ).rowcount == 1
+
+    def fail(self, task_id, error, attempts, base_delay=30, fence=None):
+        """تسجيل فشل المهمة وجدولة إعادة المحاولة بتأخير متزايد أو إيقافها نهائياً"""
+        now = time.time()
+        where, params = ('id = ?', (task_id,)) if not fence else (f'id = ? AND {self.FENCE_SQL}', (task_id, *fence))
+        with self.lock:
+            self.conn.execute(f'''
+                UPDATE task_queue
+                SET state = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'pending' END,
+                    visible_at = ?, last_error = ?, updated_at = ?
+                WHERE {where}
+            ''', (now + base_delay * (2 ** (attempts - 1)), str(error)[:500], now, *params))
+
+    def stats(self):
+        """عدد المهام في كل حالة"""
+        with self.lock:
+            rows = self.conn.execute('SELECT state, COUNT(*) FROM task_queue GROUP BY state').fetchall()
+        return dict(rows)
+
+    def purge_done(self, older_than_seconds=7 * 86400):
+        """حذف المهام المكتملة القديمة (مفاتيح منع التكرار تبقى طوال هذه المدة)"""
+        with self.lock:
+            cursor = self.conn.execute(
+                "DELETE FROM task_queue WHERE state = 'done' AND updated_at < ?",
+                (time.time() - older_than_seconds,)
+            )
+            return cursor.rowcount
+
+    def close(self):
+        self.conn.close()
+
+class PostgresTaskQueue:
+    """نفس واجهة DurableTaskQueue في PostgreSQL، فتفرغ كل العقد المشتركة في القاعدة نفس الطابور"""
+    def __init__(self, bridge):
+        self.bridge = bridge
+
+    def enqueue_many(self, tasks, max_attempts=5):
+        """إضافة مهام (kind, payload, idempotency_key)، المهام ذات المفتاح المكرر تتجاهل"""
+        if not tasks:
+            return 0
+        now = time.time()
+        kinds, payloads, keys = zip(*((kind, json.dumps(payload), key) for kind, payload, key in tasks))
+        rows = self.bridge.run(self.bridge.pool.fetch('''
+            INSERT INTO task_queue (kind, payload, idempotency_key, max_attempts, visible_at, created_at, updated_at)
+            SELECT kind, payload, key, $4, $5, $5, $5
+            FROM unnest($1::text[], $2::text[], $3::text[]) AS t(kind, payload, key)
+            ON CONFLICT (idempotency_key) DO NOTHING
+            RETURNING id
+        ''', list(kinds), list(payloads), list(keys), max_attempts, now))
+        return len(rows)
+
+    def enqueue(self, kind, payload, idempotency_key=None, max_attempts=5):
+        """إضافة مهمة واحدة"""
+        return self.enqueue_many([(kind, payload, idempotency_key)], max_attempts) == 1
+
+    # شرط رمز الحماية كما في DurableTaskQueue، المعاملات ${n} و ${n+1} هي اسم المهمة ورمز العقد
+    FENCE_SQL = 'EXISTS (SELECT 1 FROM leader_leases WHERE name = ${} AND fencing_token = ${})'
+
+    def claim(self, worker_id, limit=TASK_BATCH_SIZE, visibility_timeout=300, fence=None):
+        """حجز دفعة من المهام الجاهزة، SKIP LOCKED يسمح لعدة عقد بالحجز معاً دون انتظار"""
+        return self.bridge.run(self._claim(worker_id, limit, visibility_timeout, fence))
+
+    async def _claim(self, worker_id, limit, visibility_timeout, fence):
+        now = time.time()
+        async with self.bridge.pool.acquire() as conn:
+            async with conn.transaction():
+                # FOR SHARE يمنع القائد الجديد من أخذ العقد حتى تنتهي هذه المعاملة
+                if fence and not await conn.fetchval(
+                    'SELECT 1 FROM leader_leases WHERE name = $1 AND fencing_token = $2 FOR SHARE', *fence
+                ):
+                    return []
+                await conn.execute('''
+                    UPDATE task_queue
+                    SET state = 'failed', last_error = COALESCE(last_error, 'انتهت مهلة التنفيذ في كل المحاولات'),
+                        updated_at = $1
+                    WHERE state = 'running' AND visible_at <= $1 AND attempts >= max_attempts
+                ''', now)
+                rows = await conn.fetch('''
+                    UPDATE task_queue
+                    SET state = 'running', claimed_by = $1, attempts = attempts + 1, visible_at = $2, updated_at = $3
+                    WHERE id IN (
+                        SELECT id FROM task_queue
+                        WHERE state IN ('pending', 'running') AND visible_at <= $3 AND attempts < max_attempts
+                        ORDER BY id
+                        LIMIT $4
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING id, kind, payload, attempts
+                ''', worker_id, now + visibility_timeout, now, limit)
+        return sorted((row['id'], row['kind'], json.loads(row['payload']), row['attempts']) for row in rows)
+
+    def complete(self, task_id, fence=None):
+        """تعليم المهمة كمكتملة، تعيد False إذا فقد العقد"""
+        where = 'id = $2' if not fence else f'id = $2 AND {self.FENCE_SQL.format(3, 4)}'
+        status = self.bridge.run(self.bridge.pool.execute(
+            f"UPDATE task_queue SET state = 'done', last_error = NULL, updated_at = $1 WHERE {where}",
+            time.time(), task_id, *(fence or ())
+        ))
+        return status == "UPDATE 1"
+
+    def fail(self, task_id, error, attempts, base_delay=30, fence=None):
+        """تسجيل فشل المهمة وجدولة إعادة المحاولة بتأخير متزايد أو إيقافها نهائياً"""
+        now = time.time()
+        where = 'id = $4' if not fence else f'id = $4 AND {self.FENCE_SQL.format(5, 6)}'
+        self.bridge.run(self.bridge.pool.execute(f'''
+            UPDATE task_queue
+            SET state = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'pending' END,
+                visible_at = $1, last_error = $2, updated_at = $3
+            WHERE {where}
+        ''', now + base_delay * (2 ** (attempts - 1)), str(error)[:500], now, task_id, *(fence or ())))
+
+    def stats(self):
+        """عدد المهام في كل حالة"""
+        rows = self.bridge.run(self.bridge.pool.fetch('SELECT state, COUNT(*) FROM task_queue GROUP BY state'))
+        return {row[0]: row[1] for row in rows}
+
+    def purge_done(self, older_than_seconds=7 * 86400):
+        """حذف المهام المكتملة القديمة (مفاتيح منع التكرار تبقى طوال هذه المدة)"""
+        status = self.bridge.run(self.bridge.pool.execute(
+            "DELETE FROM task_queue WHERE state = 'done' AND updated_at < $1",
+            time.time() - older_than_seconds
+        ))
+        return int(status.split()[-1])
+
+    def close(self):
+        self.bridge.close()
+
+# جداول التنسيق بين العقد (عقود القيادة وطابور المهام) عند استخدام PostgreSQL
+POSTGRES_COORDINATION_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS leader_leases (
+        name TEXT PRIMARY KEY,
+        holder TEXT,
+        fencing_token BIGINT NOT NULL DEFAULT 0,
+        expires_at DOUBLE PRECISION NOT NULL DEFAULT 0,
+        started_at DOUBLE PRECISION,
+        completed_at DOUBLE PRECISION
+    );
+    CREATE TABLE IF NOT EXISTS task_queue (
+        id BIGSERIAL PRIMARY KEY,
+        kind TEXT NOT NULL,
+        payload TEXT NOT NULL DEFAULT '{}',
+        idempotency_key TEXT UNIQUE,
+        state TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        max_attempts INTEGER NOT NULL DEFAULT 5,
+        visible_at DOUBLE PRECISION NOT NULL DEFAULT 0,
+        claimed_by TEXT,
+        last_error TEXT,
+        created_at DOUBLE PRECISION NOT NULL,
+        updated_at DOUBLE PRECISION NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_task_queue_claim ON task_queue (state, visible_at);
+'''
+
+def create_coordination(db_path=DATABASE_PATH):
+    """عقود القيادة وطابور المهام في نفس قاعدة المشتركين: مع PostgreSQL لا تتنسق العقد عبر ملف SQLite محلي"""
+    if DATABASE_URL and HAS_ASYNCPG:
+        bridge = PostgresBridge(DATABASE_URL)
+        return LeaderElection(PostgresLeaseBackend(bridge)), PostgresTaskQueue(bridge)
+    return LeaderElection(SQLiteLeaseBackend(db_path)), DurableTaskQueue(db_path)
+
+# =============================================
+# حفظ بيانات المستخدمين وحالات المحادثات في SQLite
+# =============================================
+PERSISTENCE_ROWS_WRITTEN = metrics.counter(
+    "bot_persistence_rows_written_total", "صفوف بيانات المستخدمين والمحادثات المحفوظة أو المحذوفة", ("kind",))
+DUPLICATE_UPDATES = metrics.counter(
+    "bot_duplicate_updates_total", "تحديثات أعيد إرسالها بعد معالجتها فتم تجاهلها")
+
+class SQLitePersistence(BasePersistence):
+    """حفظ context.user_data وحالات المحادثات بصيغة JSON، صف لكل مستخدم بدلاً من ملف pickle واحد.
+    بيانات المستخدم تحمل عند أول تحديث منه فقط، وتكتب الصفوف التي تغيرت فقط في معاملة واحدة كل دفعة"""
+    def __init__(self, db_path=DATABASE_PATH, update_interval=PERSISTENCE_INTERVAL, dedup_window=UPDATE_DEDUP_WINDOW):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30, isolation_level=None,
+                                    factory=InstrumentedConnection)
+        self.conn.execute('PRAGMA busy_timeout=30000')
+        self.lock = threading.Lock()
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS persisted_user_data (
+                user_id INTEGER PRIMARY KEY,
+                data TEXT NOT NULL,
+                updated_at INTEGER NOT NULL
+            )
+        ''')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS persisted_conversations (
+                name TEXT NOT NULL,
+                conversation_key TEXT NOT NULL,
+                state TEXT NOT NULL,
+                updated_at INTEGER NOT NULL,
+                PRIMARY KEY (name, conversation_key)
+            ) WITHOUT ROWID
+        ''')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS processed_updates (
+                update_id INTEGER PRIMARY KEY,
+                processed_at INTEGER NOT NULL
+            )
+        ''')
+        # آخر JSON محفوظ لكل مستخدم محمل، للمقارنة قبل الكتابة
+        self.saved_user_data = {}
+        # التغييرات المنتظرة للدفعة القادمة: None يعني حذف الصف
+        self.pending_users = {}
+        self.pending_conversations = {}
+        self.pending_updates = []
+        self.write_task = None
+        # Telegram يعيد إرسال آخر التحديثات فقط، فتكفي آخر dedup_window معرفات في الذاكرة
+        self.dedup_window = dedup_window
+        self.processed_updates = {row[0] for row in self.conn.execute(
+            'SELECT update_id FROM processed_updates ORDER BY update_id DESC LIMIT ?', (dedup_window,)
+        )}
+
+    # ---- بيانات المستخدمين ----
+    async def get_user_data(self):
+        # لا تحمل بيانات كل المستخدمين عند البدء، بل بيانات كل مستخدم عند أول تحديث منه
+        return {}
+
+    async def refresh_user_data(self, user_id, user_data):
+        """يستدعى قبل معالجة كل تحديث، ويقرأ القاعدة مرة واحدة فقط لكل مستخدم"""
+        if user_id in self.saved_user_data:
+            return
+        with self.lock:
+            row = self.conn.execute('SELECT data FROM persisted_user_data WHERE user_id = ?', (user_id,)).fetchone()
+        self.saved_user_data[user_id] = row[0] if row else None
+        if row:
+            for key, value in json.loads(row[0]).items():
+                user_data.setdefault(key, value)
+
+    async def update_user_data(self, user_id, data):
+        """يستدعى كل دفعة لكل مستخدم استقبل تحديثاً، ويكتب فقط إذا تغيرت بياناته"""
+        try:
+            encoded = json.dumps(data, ensure_ascii=False, sort_keys=True) if data else None
+        except (TypeError, ValueError) as e:
+            logger.warning(f"⚠️ بيانات المستخدم {user_id} لا يمكن حفظها بصيغة JSON: {e}")
+            return
+        if encoded != self.saved_user_data.get(user_id):
+            self.saved_user_data[user_id] = encoded
+            self.pending_users[user_id] = encoded
+            self.schedule_write()
+
+    async def drop_user_data(self, user_id):
+        self.saved_user_data[user_id] = None
+        self.pending_users[user_id] = None
+        self.schedule_write()
+
+    # ---- حالات المحادثات ----
+    async def get_conversations(self, name):
+        """حالات المحادثات المفتوحة لمعالج واحد (عددها صغير، فتحمل كلها عند البدء)"""
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT conversation_key, state FROM persisted_conversations WHERE name = ?', (name,)
+            ).fetchall()
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+
+    async def update_conversation(self, name, key, new_state):
+        self.pending_conversations[(name, json.dumps(list(key)))] = (
+            None if new_state is None else json.dumps(new_state)
+        )
+        self.schedule_write()
+
+    # ---- منع معالجة التحديث مرتين ----
+    def claim_update(self, update_id):
+        """True إذا لم يعالج التحديث من قبل، ويسجل معرفه في الذاكرة فقط حتى تنتهي معالجته"""
+        if update_id in self.processed_updates:
+            return False
+        self.processed_updates.add(update_id)
+        if len(self.processed_updates) > self.dedup_window * 2:
+            # معرفات التحديثات متزايدة، فتحذف الأقدم
+            self.processed_updates = set(sorted(self.processed_updates)[-self.dedup_window:])
+        return True
+
+    def mark_processed(self, update):
+        """يستدعى بعد انتهاء كل المعالجات، فالتحديث الذي انقطعت معالجته بإعادة التشغيل يعالج عند إعادة إرساله"""
+        if isinstance(update, Update):
+            self.pending_updates.append(update.update_id)
+            # تجمع معرفات التحديثات المتقاربة في كتابة واحدة
+            self.schedule_write(delay=1.0)
+
+    # ---- الكتابة على دفعات ----
+    def schedule_write(self, delay=0):
+        """كل تحديثات الدفعة تصل من asyncio.gather واحد، فتكتب معاً في الدورة التالية للحلقة"""
+        if self.write_task is None:
+            self.write_task = asyncio.get_running_loop().create_task(self.write_soon(delay))
+
+    async def write_soon(self, delay):
+        await asyncio.sleep(delay)
+        self.write_task = None
+        try:
+            self.write_pending()
+        except Exception as e:
+            logger.error(f"❌ خطأ في حفظ بيانات المستخدمين والمحادثات: {e}")
+
+    def write_pending(self):
+        """كتابة كل التغييرات المنتظرة في معاملة واحدة"""
+        users, self.pending_users = self.pending_users, {}
+        conversations, self.pending_conversations = self.pending_conversations, {}
+        update_ids, self.pending_updates = self.pending_updates, []
+        if not users and not conversations and not update_ids:
+            return
+        now = epoch_now()
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.conn.executemany('''
+                    INSERT INTO persisted_user_data (user_id, data, updated_at) VALUES (?, ?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at
+                ''', [(user_id, data, now) for user_id, data in users.items() if data is not None])
+                self.conn.executemany(
+                    'DELETE FROM persisted_user_data WHERE user_id = ?',
+                    [(user_id,) for user_id, data in users.items() if data is None]
+                )
+                self.conn.executemany('''
+                    INSERT INTO persisted_conversations (name, conversation_key, state, updated_at) VALUES (?, ?, ?, ?)
+                    ON CONFLICT(name, conversation_key) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at
+                ''', [(name, key, state, now) for (name, key), state in conversations.items() if state is not None])
+                self.conn.executemany(
+                    'DELETE FROM persisted_conversations WHERE name = ? AND conversation_key = ?',
+                    [(name, key) for (name, key), state in conversations.items() if state is None]
+                )
+                if update_ids:
+                    self.conn.executemany(
+                        'INSERT OR IGNORE INTO processed_updates (update_id, processed_at) VALUES (?, ?)',
+                        [(update_id, now) for update_id in update_ids]
+                    )
+                    self.conn.execute(
+                        'DELETE FROM processed_updates WHERE update_id <= ?', (max(update_ids) - self.dedup_window,)
+                    )
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                # تعاد للدفعة القادمة ما لم تستبدلها تغييرات أحدث
+                self.pending_users = {**users, **self.pending_users}
+                self.pending_conversations = {**conversations, **self.pending_conversations}
+                self.pending_updates = update_ids + self.pending_updates
+                raise
+        PERSISTENCE_ROWS_WRITTEN.inc(len(users), kind="user_data")
+        PERSISTENCE_ROWS_WRITTEN.inc(len(conversations), kind="conversation")
+
+    async def flush(self):
+        """يستدعى عند إيقاف التطبيق بعد آخر دفعة: كتابة ما تبقى وإغلاق الاتصال"""
+        if self.write_task is not None:
+            self.write_task.cancel()
+            self.write_task = None
+        self.write_pending()
+        self.conn.close()
+
+    # ---- بيانات غير محفوظة (store_data يعطلها) ----
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+# =============================================
+# النسخ الاحتياطي أثناء التشغيل (SQLite Backup API)
+# =============================================
+BACKUP_LAST_SUCCESS = metrics.gauge(
+    "bot_backup_last_success_timestamp_seconds", "وقت آخر نسخة احتياطية ناجحة")
+BACKUP_SIZE_BYTES = metrics.gauge("bot_backup_size_bytes", "حجم آخر نسخة احتياطية مضغوطة")
+
+class BackupError(Exception):
+    """نسخة احتياطية تالفة أو لا يمكن استعادتها"""
+
+class BackupManager:
+    """نسخ احتياطية متسقة للقاعدة أثناء الكتابة، مضغوطة ومحدودة العدد، مع استعادة بعد التحقق"""
+    PREFIX = "subscriptions-"
+    SUFFIX = ".db.gz"
+
+    def __init__(self, db_path=DATABASE_PATH, backup_dir=BACKUP_DIR, retention=BACKUP_RETENTION):
+        self.db_path = db_path
+        self.backup_dir = backup_dir
+        self.retention = retention
+        self.lock = threading.Lock()
+
+    def list_backups(self):
+        """النسخ الموجودة من الأحدث للأقدم"""
+        if not os.path.isdir(self.backup_dir):
+            return []
+        names = [
+            name for name in os.listdir(self.backup_dir)
+            if name.startswith(self.PREFIX) and name.endswith(self.SUFFIX)
+        ]
+        return [os.path.join(self.backup_dir, name) for name in sorted(names, reverse=True)]
+
+    def snapshot(self, target_path):
+        """نسخ القاعدة لملف SQLite على خطوات صغيرة، كل خطوة تحجز القراءة لعدد محدود من الصفحات فقط"""
+        source = sqlite3.connect(self.db_path, timeout=30)
+        target = sqlite3.connect(target_path)
+        started = time.monotonic()
+
+        def check_deadline(status, remaining, total):
+            # الكتابة من اتصال آخر تعيد النسخ التدريجي من البداية، فلا ننتظر بلا نهاية تحت الضغط
+            if time.monotonic() - started > BACKUP_MAX_SECONDS:
+                raise TimeoutError(f"{remaining}/{total} صفحة متبقية")
+
+        try:
+            try:
+                source.backup(target, pages=BACKUP_PAGES_PER_STEP, sleep=BACKUP_STEP_SLEEP, progress=check_deadline)
+            except TimeoutError as e:
+                # في وضع WAL تقرأ الخطوة الواحدة من لقطة ثابتة ولا تمنع الكتابة
+                sweep_logger.warning("⚠️ النسخ التدريجي لم يكتمل خلال %.0fs (%s)، النسخ بخطوة واحدة", BACKUP_MAX_SECONDS, e)
+                source.backup(target)
+            # النسخة ملف واحد مستقل بدون WAL
+            target.execute('PRAGMA journal_mode=DELETE')
+        finally:
+            target.close()
+            source.close()
+
+    @staticmethod
+    def verify_database(path):
+        """التحقق من سلامة ملف قاعدة غير مضغوط، يعيد (عدد المشتركين، عدد الأكواد، إصدار المخطط)"""
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            result = conn.execute('PRAGMA integrity_check').fetchone()[0]
+            if result != 'ok':
+                raise BackupError(f"فشل فحص السلامة: {result}")
+            tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            missing = {'subscribers', 'codes', 'admins'} - tables
+            if missing:
+                raise BackupError(f"جداول مفقودة: {', '.join(sorted(missing))}")
+            return (
+                conn.execute('SELECT COUNT(*) FROM subscribers').fetchone()[0],
+                conn.execute('SELECT COUNT(*) FROM codes').fetchone()[0],
+                conn.execute('PRAGMA user_version').fetchone()[0],
+            )
+        except sqlite3.DatabaseError as e:
+            raise BackupError(str(e)) from e
+        finally:
+            conn.close()
+
+    @staticmethod
+    def copy_stream(source_file, target_file):
+        shutil.copyfileobj(source_file, target_file, 1024 * 1024)
+
+    def create_backup(self):
+        """إنشاء نسخة مضغوطة جديدة وحذف الأقدم من حد الاحتفاظ، يعيد (المسار، الحجم، المدة)"""
+        with self.lock:
+            started = time.perf_counter()
+            os.makedirs(self.backup_dir, exist_ok=True)
+            final_path = os.path.join(
+                self.backup_dir, f"{self.PREFIX}{datetime.now(timezone.utc).strftime('%Y%m%d-%H%M%S')}{self.SUFFIX}"
+            )
+            snapshot_path = final_path + ".snapshot"
+            partial_path = final_path + ".partial"
+            try:
+                self.snapshot(snapshot_path)
+                # لا تحفظ نسخة تالفة فوق نسخ سليمة
+                self.verify_database(snapshot_path)
+                with open(snapshot_path, 'rb') as source, gzip.open(partial_path, 'wb', compresslevel=6) as target:
+                    self.copy_stream(source, target)
+                os.replace(partial_path, final_path)
+            finally:
+                for path in (snapshot_path, partial_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+
+            size = os.path.getsize(final_path)
+            self.prune()
+            BACKUP_LAST_SUCCESS.set(time.time())
+            BACKUP_SIZE_BYTES.set(size)
+            return final_path, size, time.perf_counter() - started
+
+    def prune(self):
+        """حذف النسخ الزائدة عن حد الاحتفاظ (الأقدم أولاً)"""
+        removed = 0
+        for path in self.list_backups()[max(self.retention, 1):]:
+            os.remove(path)
+            removed += 1
+        return removed
+
+    def verify_backup(self, backup_path):
+        """فك ضغط النسخة في ملف مؤقت والتحقق منها دون المساس بالقاعدة الحالية"""
+        temp_path = backup_path + ".verify"
+        try:
+            self.decompress(backup_path, temp_path)
+            return self.verify_database(temp_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def decompress(self, backup_path, target_path):
+        try:
+            with gzip.open(backup_path, 'rb') as source, open(target_path, 'wb') as target:
+                self.copy_stream(source, target)
+        except (OSError, EOFError) as e:
+            raise BackupError(f"ملف مضغوط تالف: {e}") from e
+
+    def restore(self, backup_path, target_path=None):
+        """استعادة نسخة بعد التحقق منها، القاعدة الحالية تحفظ باسم .before-restore (يجب إيقاف البوت أولاً)"""
+        target_path = target_path or self.db_path
+        temp_path = target_path + ".restore"
+        try:
+            self.decompress(backup_path, temp_path)
+            counts = self.verify_database(temp_path)
+            if os.path.exists(target_path):
+                # دمج WAL في الملف قبل نقله، حتى تكون النسخة المحفوظة كاملة
+                conn = sqlite3.connect(target_path)
+                conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+                conn.close()
+                os.replace(target_path, target_path + ".before-restore")
+            for suffix in ("-wal", "-shm"):
+                if os.path.exists(target_path + suffix):
+                    os.remove(target_path + suffix)
+            os.replace(temp_path, target_path)
+            return counts
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+def run_backup_cli(args):
+    """python main.py backup | verify [ملف] | restore <ملف|latest>"""
+    manager = BackupManager()
+    command = args[0]
+    try:
+        if command == "backup":
+            path, size, seconds = manager.create_backup()
+            print(f"✅ تم إنشاء النسخة {path} ({size / 1024:.0f} KB في {seconds:.1f}s)")
+        elif command in ("verify", "restore"):
+            backups = manager.list_backups()
+            backup_path = args[1] if len(args) > 1 and args[1] != "latest" else (backups[0] if backups else None)
+            if not backup_path:
+                print(f"❌ لا توجد نسخ احتياطية في {manager.backup_dir}")
+                return 1
+            if command == "verify":
+                subscribers, codes, version = manager.verify_backup(backup_path)
+                print(f"✅ النسخة {backup_path} سليمة: {subscribers} مشترك، {codes} كود (إصدار المخطط {version})")
+            else:
+                subscribers, codes, version = manager.restore(backup_path)
+                print(f"✅ تمت استعادة {backup_path} إلى {manager.db_path}: {subscribers} مشترك، {codes} كود")
+                print(f"💾 القاعدة السابقة محفوظة في {manager.db_path}.before-restore")
+        else:
+            print(f"❌ أمر غير معروف: {command}")
+            return 1
+    except BackupError as e:
+        print(f"❌ النسخة غير صالحة: {e}")
+        return 1
+    return 0
+
+# =============================================
+# صيغة أكواد الاشتراك
+# =============================================
+# الكود الجديد: [بادئة-] + 12 حرفاً عشوائياً + حرف تحقق (Luhn بأساس 36)
+# الأكواد القديمة (12 حرفاً بدون تحقق) تبقى مقبولة ويتحقق منها في القاعدة فقط
+CODE_ALPHABET = string.digits + string.ascii_uppercase
+CODE_BODY_LENGTH = 12
+CODE_PATTERN = re.compile(r'^(?:[A-Z0-9]{1,8}-)?[A-Z0-9]{%d}$' % (CODE_BODY_LENGTH + 1))
+LEGACY_CODE_PATTERN = re.compile(r'^[A-Z0-9]{12}$')
+CODE_PREFIX_PATTERN = re.compile(r'^[A-Z0-9]{1,8}$')
+CODE_TOKEN_PATTERN = re.compile(r'[A-Z0-9]+(?:-[A-Z0-9]+)?')
+# جداول ترجمة: حرف -> قيمته، وحرف -> مجموع أرقام ضعف قيمته بأساس 36
+CODE_VALUES = bytes.maketrans(CODE_ALPHABET.encode(), bytes(range(36)))
+CODE_DOUBLED = bytes.maketrans(CODE_ALPHABET.encode(), bytes((2 * v) // 36 + (2 * v) % 36 for v in range(36)))
+# بايت عشوائي -> حرف، مع حذف البايتات 252-255 حتى يكون التوزيع متساوياً (252 = 36 × 7)
+CODE_RANDOM_TABLE = bytes(CODE_ALPHABET.encode()[b % 36] for b in range(256))
+CODE_RANDOM_DELETE = bytes(range(252, 256))
+
+def luhn36_total(chars, double_first=True):
+    """مجموع Luhn من اليمين لسلسلة بايتات من أحرف الكود"""
+    reversed_chars = chars[::-1]
+    if double_first:
+        doubled, plain = reversed_chars[0::2], reversed_chars[1::2]
+    else:
+        doubled, plain = reversed_chars[1::2], reversed_chars[0::2]
+    return sum(doubled.translate(CODE_DOUBLED)) + sum(plain.translate(CODE_VALUES))
+
+def has_valid_checksum(code):
+    """التحقق من صيغة الكود الجديد وحرف التحقق بدون الرجوع للقاعدة"""
+    if not CODE_PATTERN.match(code):
+        return False
+    return luhn36_total(code.replace('-', '').encode(), double_first=False) % 36 == 0
+
+def random_code_bodies(count, length=CODE_BODY_LENGTH):
+    """أجزاء عشوائية للأكواد من بايتات secrets مترجمة دفعة واحدة"""
+    needed = count * length
+    chars = b""
+    while len(chars) < needed:
+        missing = needed - len(chars)
+        chars += secrets.token_bytes(missing * 256 // 252 + 16).translate(CODE_RANDOM_TABLE, CODE_RANDOM_DELETE)
+    return [chars[i:i + length] for i in range(0, needed, length)]
+
+def validate_code_prefix(prefix):
+    """البادئة يجب أن تطابق CODE_PATTERN، وإلا رفضت كل أكواد الدفعة عند الاستخدام"""
+    if prefix and not CODE_PREFIX_PATTERN.match(prefix):
+        raise ValueError(f"بادئة الكود غير صالحة: {prefix!r} (من 1 إلى 8 أحرف إنجليزية كبيرة أو أرقام)")
+    return prefix
+
+def generate_checked_codes(count, prefix=""):
+    """إنشاء أكواد بحرف تحقق، مجموع البادئة يحسب مرة واحدة لكل الدفعة"""
+    prefix = validate_code_prefix(prefix.upper())
+    # أول حرف من البادئة يأتي بعد جسم الكود من اليمين، فيضاعف إذا كان طول الجسم زوجياً
+    prefix_total = luhn36_total(prefix.encode(), double_first=CODE_BODY_LENGTH % 2 == 0) if prefix else 0
+    head = f"{prefix}-" if prefix else ""
+    codes = []
+    for body in random_code_bodies(count):
+        check = CODE_ALPHABET[-(prefix_total + luhn36_total(body)) % 36]
+        codes.append(f"{head}{body.decode()}{check}")
+    return codes
+
+validate_code_prefix(CODE_PREFIX)
+
+# =============================================
+# الأكواد الموقعة (بدون صف في جدول codes)
+# =============================================
+# الحمولة: الإصدار، الخطة، المدة بالأيام، مجموعة القنوات (0 = كل القنوات الإضافية)، رقم عشوائي فريد
+# يليها أول 6 بايتات من HMAC-SHA256، والمجموع 20 بايت = 32 حرفاً بترميز base32
+SIGNED_CODE_VERSION = 1
+SIGNED_CODE_LAYOUT = struct.Struct('>BBHHq')
+SIGNED_CODE_TAG_BYTES = 6
+SIGNED_CODE_PATTERN = re.compile(r'^[A-Z2-7]{32}$')
+
+def signed_code_tag(payload, key=CODE_SIGNING_KEY, keyed=None):
+    """أول بايتات HMAC للحمولة، keyed كائن HMAC جاهز بالمفتاح لتوفير تهيئته لكل كود"""
+    mac = keyed.copy() if keyed else hmac.new(key.encode(), digestmod=hashlib.sha256)
+    mac.update(payload)
+    return mac.digest()[:SIGNED_CODE_TAG_BYTES]
+
+def generate_signed_codes(count, plan, duration_days, channel_set=0, key=CODE_SIGNING_KEY):
+    """إنشاء أكواد موقعة، الرقم العشوائي (64 بت) هو ما يسجل عند الاستخدام لمنع تكراره"""
+    keyed = hmac.new(key.encode(), digestmod=hashlib.sha256)
+    codes = []
+    for nonce in struct.unpack(f'>{count}q', secrets.token_bytes(8 * count)):
+        payload = SIGNED_CODE_LAYOUT.pack(SIGNED_CODE_VERSION, plan, duration_days, channel_set, nonce)
+        codes.append(base64.b32encode(payload + signed_code_tag(payload, keyed=keyed)).decode())
+    return codes
+
+def verify_signed_code(code, key=CODE_SIGNING_KEY):
+    """التحقق من التوقيع وقراءة الصلاحيات من الكود بدون قاعدة البيانات، يعيد None إذا كان مزوراً"""
+    if not key or not SIGNED_CODE_PATTERN.match(code):
+        return None
+    raw = base64.b32decode(code)
+    payload, tag = raw[:SIGNED_CODE_LAYOUT.size], raw[SIGNED_CODE_LAYOUT.size:]
+    if not hmac.compare_digest(tag, signed_code_tag(payload, key)):
+        return None
+    version, plan, duration_days, channel_set, nonce = SIGNED_CODE_LAYOUT.unpack(payload)
+    if version != SIGNED_CODE_VERSION or duration_days == 0:
+        return None
+    return {'plan': plan, 'duration_days': duration_days, 'channel_set': channel_set, 'nonce': nonce}
+
+# =============================================
+# طبقة التخزين (SQLite أو PostgreSQL)
+# =============================================
+class SubscriptionStore:
+    """واجهة تخزين الأكواد والمشتركين وسجل التنبيهات، كل الدوال غير متزامنة لتناسب PostgreSQL
+    
+    كل التواريخ ثوان صحيحة منذ 1970 بتوقيت UTC
+    """
+    name = "base"
+
+    async def open(self):
+        """تهيئة الاتصالات والجداول"""
+
+    async def close(self):
+        """إغلاق الاتصالات"""
+
+    # الأكواد
+    async def get_redeemable_code(self, code):
+        """(id, duration_days, is_used, expires_at, channels, excluded_channels, apply_to_all, max_uses, current_uses, is_trial)"""
+        raise NotImplementedError
+
+    async def is_code_available(self, code):
+        raise NotImplementedError
+
+    async def exhaust_code(self, code_id):
+        raise NotImplementedError
+
+    async def insert_codes(self, rows):
+        """rows: (code, duration_days, price, created_by, expires_at, batch_id, channels, excluded_channels, apply_to_all, max_uses, is_trial)"""
+        raise NotImplementedError
+
+    async def list_available_codes(self, now):
+        raise NotImplementedError
+
+    # المشتركون
+    async def get_subscriber(self, user_id):
+        """(code_used, subscribed_at, expires_at, is_active, invite_links, is_trial, trial_used) أو None"""
+        raise NotImplementedError
+
+    async def redeem_code(self, code_id, subscriber):
+        """زيادة استخدامات الكود وحفظ المشترك في معاملة واحدة، يعيد False إذا نفدت استخداماته"""
+        raise NotImplementedError
+
+    async def is_nonce_redeemed(self, nonce):
+        raise NotImplementedError
+
+    async def redeem_signed_code(self, nonce, plan, subscriber):
+        """تسجيل استخدام كود موقع وحفظ المشترك في معاملة واحدة، يعيد False إذا سبق استخدامه"""
+        raise NotImplementedError
+
+    async def create_trial(self, subscriber, trial_code, duration_days):
+        raise NotImplementedError
+
+    async def list_subscribers(self):
+        raise NotImplementedError
+
+    async def expired_subscribers(self, now, trial_only=False):
+        """(user_id, expires_at) للمشتركين الفعالين المنتهين"""
+        raise NotImplementedError
+
+    async def expire_subscriber(self, user_id, expires_at):
+        """تعطيل المشترك إذا كان ما زال فعالاً بنفس تاريخ الانتهاء، يعيد (code_used, invite_links, is_trial) أو None"""
+        raise NotImplementedError
+
+    async def expiring_subscribers(self, start, end):
+        """(user_id, code_used, expires_at, is_trial) للمشتركين الذين ينتهون بين التاريخين"""
+        raise NotImplementedError
+
+    async def stats(self):
+        raise NotImplementedError
+
+    # سجل التنبيهات
+    async def sent_notification_keys(self, keys):
+        raise NotImplementedError
+
+    async def reserve_notifications(self, rows):
+        """rows: (idempotency_key, user_id, expires_at, kind)، تعيد مجموعة المفاتيح التي حجزت فعلاً (الموجودة تتجاهل)"""
+        raise NotImplementedError
+
+    async def finish_notifications(self, failed_keys, sent_keys, sent_users, now):
+        raise NotImplementedError
+
+    # الأرشيف
+    async def archive_subscribers(self, cutoff, limit, now):
+        """نقل حتى limit مشترك معطل انتهى قبل cutoff إلى subscribers_archive، تعيد معرفات المستخدمين المنقولين"""
+        raise NotImplementedError
+
+    async def archive_codes(self, cutoff, after_id, limit, now):
+        """نقل حتى limit كود (مستخدم أو منتهي أو معطل قبل cutoff) بعد after_id بترتيب id، تعيد (العدد، آخر id)"""
+        raise NotImplementedError
+
+    async def compact(self):
+        """استرجاع المساحة المحررة بعد الأرشفة، تعيد عدد الصفحات المحررة"""
+        return 0
+
+    async def has_archived_trial(self, user_id):
+        raise NotImplementedError
+
+    async def archived_subscriber(self, user_id):
+        """(code_used, subscribed_at, expires_at, is_trial, archived_at) لكل اشتراك مؤرشف للمستخدم"""
+        raise NotImplementedError
+
+    async def archived_code(self, code):
+        """(code, duration_days, price, is_used, created_at, archived_at) أو None"""
+        raise NotImplementedError
+
+    # المشرفون
+    async def is_admin(self, user_id):
+        raise NotImplementedError
+
+    async def add_admin(self, user_id, username, first_name, last_name, added_by):
+        """إضافة المشرف أو إعادة تفعيله"""
+        raise NotImplementedError
+
+    async def remove_admin(self, user_id):
+        raise NotImplementedError
+
+    async def list_admins(self):
+        """(user_id, username, first_name, last_name, added_at) للمشرفين الفعالين"""
+        raise NotImplementedError
+
+    # القنوات
+    async def add_channel(self, channel_id, channel_username, channel_name, added_by, channel_type, require_subscription, is_main_channel):
+        """إضافة القناة أو استبدال بياناتها"""
+        raise NotImplementedError
+
+    async def active_channels(self):
+        """(id, channel_id, channel_username, channel_name, added_at, is_active, is_main_channel) للقنوات الفعالة"""
+        raise NotImplementedError
+
+    async def additional_channels(self):
+        """(channel_id, channel_username, channel_name) للقنوات الفعالة غير الرئيسية"""
+        raise NotImplementedError
+
+    async def main_channel(self):
+        """(channel_id, channel_username, channel_name) أو None"""
+        raise NotImplementedError
+
+    async def channel_by_id(self, channel_id):
+        """(channel_id, channel_username, channel_name) للقناة الفعالة أو None"""
+        raise NotImplementedError
+
+    async def get_or_create_channel_set(self, channels_json, created_by):
+        """رقم مجموعة القنوات، تنشأ إذا لم تكن موجودة"""
+        raise NotImplementedError
+
+    async def get_channel_set(self, set_id):
+        """قائمة قنوات المجموعة بصيغة JSON أو None"""
+        raise NotImplementedError
+
+    # الأزرار الديناميكية
+    async def add_button(self, button_text, button_command, button_response, created_by):
+        """يعيد False إذا كان الأمر موجوداً مسبقاً"""
+        raise NotImplementedError
+
+    async def list_buttons(self, active_only=True):
+        """(id, button_text, button_command, button_response, is_active, created_by, created_at) بالأحدث أولاً"""
+        raise NotImplementedError
+
+    async def get_button(self, button_command):
+        raise NotImplementedError
+
+    async def delete_button(self, button_command):
+        raise NotImplementedError
+
+    async def toggle_button(self, button_command):
+        """عكس حالة الزر، تعيد الحالة الجديدة أو None إذا لم يكن موجوداً"""
+        raise NotImplementedError
+
+    async def edit_button(self, button_command, new_text=None, new_response=None):
+        raise NotImplementedError
+
+    # أرقام إصدارات السجلات المشتركة بين العمليات
+    async def registry_version(self, name):
+        raise NotImplementedError
+
+    async def bump_registry_version(self, name):
+        raise NotImplementedError
+
+class SQLiteStore(SubscriptionStore):
+    """التخزين في ملف SQLite المحلي عبر اتصال النظام"""
+    name = "sqlite"
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    async def get_redeemable_code(self, code):
+        return self.conn.execute('''
+            SELECT id, duration_days, is_used, expires_at, channels, excluded_channels, apply_to_all_channels, max_uses, current_uses, is_trial
+            FROM codes 
+            WHERE code = ? AND is_used = FALSE AND is_active = TRUE
+        ''', (code,)).fetchone()
+
+    async def is_code_available(self, code):
+        return self.conn.execute(
+            'SELECT id FROM codes WHERE code = ? AND is_used = FALSE AND is_active = TRUE', (code,)
+        ).fetchone() is not None
+
+    async def exhaust_code(self, code_id):
+        self.conn.execute('UPDATE codes SET is_used = TRUE WHERE id = ?', (code_id,))
+        self.conn.commit()
+
+    async def insert_codes(self, rows):
+        try:
+            self.conn.executemany('''
+                INSERT INTO codes (code, duration_days, price, created_by, expires_at, batch_id, channels, excluded_channels, apply_to_all_channels, max_uses, is_trial, is_active)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, TRUE)
+            ''', rows)
+            self.conn.commit()
+        except Exception:
+            # لا نترك جزءاً من الدفعة في المعاملة المفتوحة
+            self.conn.rollback()
+            raise
+
+    async def list_available_codes(self, now):
+        return self.conn.execute('''
+            SELECT code, duration_days, price, created_at, expires_at, is_trial
+            FROM codes 
+            WHERE is_used = FALSE AND is_active = TRUE AND (expires_at IS NULL OR expires_at > ?)
+            ORDER BY created_at DESC
+        ''', (now,)).fetchall()
+
+    async def get_subscriber(self, user_id):
+        return self.conn.execute('''
+            SELECT code_used, subscribed_at, expires_at, is_active, invite_links, is_trial, trial_used
+            FROM subscribers 
+            WHERE user_id = ?
+        ''', (user_id,)).fetchone()
+
+    def save_subscriber(self, subscriber):
+        self.conn.execute('''
+            INSERT OR REPLACE INTO subscribers 
+            (user_id, username, first_name, last_name, code_used, expires_at, is_active, channels, excluded_channels, apply_to_all_channels, invite_links, last_notification, is_trial, trial_used)
+            VALUES (?, ?, ?, ?, ?, ?, TRUE, ?, ?, ?, ?, NULL, ?, ?)
+        ''', (subscriber['user_id'], subscriber['username'], subscriber['first_name'], subscriber['last_name'],
+              subscriber['code_used'], subscriber['expires_at'], subscriber['channels'], subscriber['excluded_channels'],
+              subscriber['apply_to_all_channels'], subscriber['invite_links'], subscriber['is_trial'], subscriber['is_trial']))
+
+    async def redeem_code(self, code_id, subscriber):
+        try:
+            # الشرط يعاد فحصه عند الزيادة، فلا يتجاوز طلبان متزامنان max_uses
+            claimed = self.conn.execute('''
+                UPDATE codes 
+                SET current_uses = current_uses + 1,
+                    is_used = CASE WHEN current_uses + 1 >= max_uses THEN TRUE ELSE FALSE END,
+                    used_at = CAST(strftime('%s', 'now') AS INTEGER)
+                WHERE id = ? AND is_active AND NOT is_used AND current_uses < max_uses
+            ''', (code_id,)).rowcount == 1
+            if claimed:
+                self.save_subscriber(subscriber)
+            self.conn.commit()
+            return claimed
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    async def is_nonce_redeemed(self, nonce):
+        return self.conn.execute('SELECT 1 FROM redeemed_nonces WHERE nonce = ?', (nonce,)).fetchone() is not None
+
+    async def redeem_signed_code(self, nonce, plan, subscriber):
+        try:
+            claimed = self.conn.execute('''
+                INSERT OR IGNORE INTO redeemed_nonces (nonce, plan, user_id, redeemed_at)
+                VALUES (?, ?, ?, ?)
+            ''', (nonce, plan, subscriber['user_id'], time.time())).rowcount == 1
+            if claimed:
+                self.save_subscriber(subscriber)
+            self.conn.commit()
+            return claimed
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    async def create_trial(self, subscriber, trial_code, duration_days):
+        try:
+            self.conn.execute('''
+                INSERT INTO subscribers 
+                (user_id, username, first_name, last_name, code_used, expires_at, is_active, 
+                 channels, excluded_channels, apply_to_all_channels, invite_links, is_trial, trial_used)
+                VALUES (?, ?, ?, ?, ?, ?, TRUE, '[]', '[]', TRUE, ?, TRUE, FALSE)
+            ''', (subscriber['user_id'], subscriber['username'], subscriber['first_name'], subscriber['last_name'],
+                  trial_code, subscriber['expires_at'], subscriber['invite_links']))
+            self.conn.execute('''
+                INSERT INTO codes (code, duration_days, price, created_by, is_trial, is_active)
+                VALUES (?, ?, 0.0, 'system', TRUE, FALSE)
+            ''', (trial_code, duration_days))
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    async def list_subscribers(self):
+        return self.conn.execute('''
+            SELECT user_id, username, first_name, last_name, code_used, 
+                   subscribed_at, expires_at, is_active, is_trial
+            FROM subscribers 
+            ORDER BY subscribed_at DESC
+        ''').fetchall()
+
+    async def expired_subscribers(self, now, trial_only=False):
+        trial_filter = "AND is_trial = TRUE" if trial_only else ""
+        return self.conn.execute(f'''
+            SELECT user_id, expires_at
+            FROM subscribers 
+            WHERE expires_at < ? AND is_active = TRUE {trial_filter}
+        ''', (now,)).fetchall()
+
+    async def expire_subscriber(self, user_id, expires_at):
+        # RETURNING يجمع القراءة والتعطيل في عبارة واحدة، فلا يعطل نفس الاشتراك مرتين
+        row = self.conn.execute('''
+            UPDATE subscribers 
+            SET is_active = FALSE,
+                trial_used = CASE WHEN is_trial THEN TRUE ELSE trial_used END
+            WHERE user_id = ? AND expires_at = ? AND is_active = TRUE
+            RETURNING code_used, invite_links, is_trial
+        ''', (user_id, expires_at)).fetchall()
+        self.conn.commit()
+        return row[0] if row else None
+
+    async def expiring_subscribers(self, start, end):
+        return self.conn.execute('''
+            SELECT user_id, code_used, expires_at, is_trial
+            FROM subscribers 
+            WHERE is_active = TRUE AND expires_at BETWEEN ? AND ?
+        ''', (start, end)).fetchall()
+
+    async def stats(self):
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute('SELECT COUNT(*) FROM subscribers WHERE is_active = TRUE')
+            active_subscribers = cursor.fetchone()[0]
+            
+            cursor.execute('SELECT COUNT(*) FROM codes WHERE is_used = FALSE AND is_active = TRUE')
+            available_codes = cursor.fetchone()[0]
+            
+            cursor.execute('SELECT COUNT(*) FROM codes WHERE is_used = TRUE')
+            used_codes = cursor.fetchone()[0]
+            
+            cursor.execute('SELECT SUM(price) FROM codes WHERE is_used = TRUE')
+            total_revenue = cursor.fetchone()[0] or 0
+
+            # الأكواد المستخدمة المؤرشفة تبقى في الإحصائيات عبر مجاميع تحدث عند الأرشفة
+            cursor.execute('SELECT used_codes, total_revenue FROM archive_totals')
+            archived_used, archived_revenue = cursor.fetchone()
+            used_codes += archived_used
+            total_revenue += archived_revenue
+
+            cursor.execute('SELECT COUNT(*) FROM additional_channels WHERE is_active = TRUE')
+            active_channels = cursor.fetchone()[0]
+        finally:
+            cursor.close()
+        
+        return {
+            'active_subscribers': active_subscribers,
+            'available_codes': available_codes,
+            'used_codes': used_codes,
+            'total_revenue': total_revenue,
+            'active_channels': active_channels
+        }
+
+    async def sent_notification_keys(self, keys):
+        found = set()
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            found.update(row[0] for row in self.conn.execute(
+                f'SELECT idempotency_key FROM notification_log WHERE idempotency_key IN ({placeholders})',
+                chunk
+            ).fetchall())
+        return found
+
+    async def reserve_notifications(self, rows):
+        try:
+            # صف بصف لمعرفة ما أدرج فعلاً، فلا ترسل عمليتان نفس التنبيه
+            reserved = set()
+            for row in rows:
+                if self.conn.execute('''
+                    INSERT OR IGNORE INTO notification_log (idempotency_key, user_id, expires_at, kind, sent_at)
+                    VALUES (?, ?, ?, ?, NULL)
+                ''', row).rowcount == 1:
+                    reserved.add(row[0])
+            self.conn.commit()
+            return reserved
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    async def finish_notifications(self, failed_keys, sent_keys, sent_users, now):
+        self.conn.executemany(
+            'DELETE FROM notification_log WHERE idempotency_key = ?',
+            [(key,) for key in failed_keys]
+        )
+        self.conn.executemany(
+            'UPDATE notification_log SET sent_at = ? WHERE idempotency_key = ?',
+            [(now, key) for key in sent_keys]
+        )
+        self.conn.executemany(
+            'UPDATE subscribers SET last_notification = ? WHERE user_id = ?',
+            [(int(now), user_id) for user_id in sent_users]
+        )
+        self.conn.commit()
+
+    def move_to_archive(self, table, ids, now):
+        """نسخ الصفوف لجدول الأرشيف وحذفها من الجدول الأصلي (داخل معاملة مفتوحة)"""
+        columns = ", ".join(row[1] for row in self.conn.execute(f'PRAGMA table_info({table})').fetchall())
+        placeholders = ",".join("?" * len(ids))
+        self.conn.execute(f'''
+            INSERT INTO {table}_archive ({columns}, archived_at)
+            SELECT {columns}, ? FROM {table} WHERE id IN ({placeholders})
+        ''', (now, *ids))
+        self.conn.execute(f'DELETE FROM {table} WHERE id IN ({placeholders})', ids)
+
+    async def archive_subscribers(self, cutoff, limit, now):
+        # IMMEDIATE يحجز الكتابة قبل القراءة حتى لا تغير عملية أخرى الصفوف المختارة
+        self.conn.commit()
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = self.conn.execute('''
+                SELECT id, user_id FROM subscribers
+                WHERE is_active = FALSE AND expires_at < ?
+                LIMIT ?
+            ''', (cutoff, limit)).fetchall()
+            if rows:
+                self.move_to_archive('subscribers', [row[0] for row in rows], now)
+            self.conn.commit()
+            return [row[1] for row in rows]
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    async def archive_codes(self, cutoff, after_id, limit, now):
+        self.conn.commit()
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            # المسح بترتيب id من آخر موضع، فتمر الدفعات على الجدول مرة واحدة رغم أن الشرط لا يستخدم فهرساً
+            rows = self.conn.execute('''
+                SELECT id, is_used, price FROM codes
+                WHERE id > ? AND (
+                    (is_used = TRUE AND COALESCE(used_at, created_at) < ?)
+                    OR expires_at < ?
+                    OR (is_active = FALSE AND created_at < ?)
+                )
+                ORDER BY id
+                LIMIT ?
+            ''', (after_id, cutoff, cutoff, cutoff, limit)).fetchall()
+            if rows:
+                used = [row for row in rows if row[1]]
+                self.conn.execute('''
+                    UPDATE archive_totals SET used_codes = used_codes + ?, total_revenue = total_revenue + ?
+                ''', (len(used), sum(row[2] or 0 for row in used)))
+                self.move_to_archive('codes', [row[0] for row in rows], now)
+            self.conn.commit()
+            return len(rows), rows[-1][0] if rows else after_id
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    async def compact(self):
+        self.conn.commit()
+        before = self.conn.execute('PRAGMA page_count').fetchone()[0]
+
+        # القاعدة تحول للوضع التدريجي عند البدء (convert_to_incremental_vacuum)، فلا VACUUM كامل هنا
+        if self.conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            return 0
+        # خطوات صغيرة مع إفساح المجال لمعالجات البوت بين كل خطوة
+        while self.conn.execute('PRAGMA freelist_count').fetchone()[0]:
+            self.conn.execute(f'PRAGMA incremental_vacuum({ARCHIVE_VACUUM_PAGES})').fetchall()
+            await asyncio.sleep(0)
+
+        return before - self.conn.execute('PRAGMA page_count').fetchone()[0]
+
+    async def has_archived_trial(self, user_id):
+        return self.conn.execute('''
+            SELECT 1 FROM subscribers_archive
+            WHERE user_id = ? AND (is_trial = TRUE OR trial_used = TRUE)
+            LIMIT 1
+        ''', (user_id,)).fetchone() is not None
+
+    async def archived_subscriber(self, user_id):
+        return self.conn.execute('''
+            SELECT code_used, subscribed_at, expires_at, is_trial, archived_at
+            FROM subscribers_archive
+            WHERE user_id = ?
+            ORDER BY expires_at DESC
+        ''', (user_id,)).fetchall()
+
+    async def archived_code(self, code):
+        return self.conn.execute('''
+            SELECT code, duration_days, price, is_used, created_at, archived_at
+            FROM codes_archive
+            WHERE code = ?
+        ''', (code,)).fetchone()
+
+    async def is_admin(self, user_id):
+        return self.conn.execute(
+            'SELECT id FROM admins WHERE user_id = ? AND is_active = TRUE', (user_id,)
+        ).fetchone() is not None
+
+    async def add_admin(self, user_id, username, first_name, last_name, added_by):
+        self.conn.execute('''
+            INSERT OR REPLACE INTO admins (user_id, username, first_name, last_name, added_by, is_active)
+            VALUES (?, ?, ?, ?, ?, TRUE)
+        ''', (user_id, username, first_name, last_name, added_by))
+        self.conn.commit()
+
+    async def remove_admin(self, user_id):
+        self.conn.execute('DELETE FROM admins WHERE user_id = ?', (user_id,))
+        self.conn.commit()
+
+    async def list_admins(self):
+        return self.conn.execute('''
+            SELECT user_id, username, first_name, last_name, added_at 
+            FROM admins WHERE is_active = TRUE ORDER BY added_at DESC
+        ''').fetchall()
+
+    async def add_channel(self, channel_id, channel_username, channel_name, added_by, channel_type, require_subscription, is_main_channel):
+        self.conn.execute('''
+            INSERT OR REPLACE INTO additional_channels 
+            (channel_id, channel_username, channel_name, added_by, is_active, channel_type, require_subscription, is_main_channel)
+            VALUES (?, ?, ?, ?, TRUE, ?, ?, ?)
+        ''', (channel_id, channel_username, channel_name, added_by, channel_type, require_subscription, is_main_channel))
+        self.conn.commit()
+
+    async def active_channels(self):
+        return self.conn.execute('''
+            SELECT id, channel_id, channel_username, channel_name, added_at, is_active, is_main_channel
+            FROM additional_channels 
+            WHERE is_active = TRUE
+            ORDER BY is_main_channel DESC, added_at DESC
+        ''').fetchall()
+
+    async def additional_channels(self):
+        return self.conn.execute('''
+            SELECT channel_id, channel_username, channel_name 
+            FROM additional_channels 
+            WHERE is_active = TRUE AND is_main_channel = FALSE
+        ''').fetchall()
+
+    async def main_channel(self):
+        return self.conn.execute('''
+            SELECT channel_id, channel_username, channel_name 
+            FROM additional_channels 
+            WHERE is_main_channel = TRUE AND is_active = TRUE
+        ''').fetchone()
+
+    async def channel_by_id(self, channel_id):
+        return self.conn.execute('''
+            SELECT channel_id, channel_username, channel_name 
+            FROM additional_channels 
+            WHERE channel_id = ? AND is_active = TRUE
+        ''', (channel_id,)).fetchone()
+
+    async def get_or_create_channel_set(self, channels_json, created_by):
+        self.conn.execute('INSERT OR IGNORE INTO channel_sets (channels, created_by) VALUES (?, ?)', (channels_json, created_by))
+        set_id = self.conn.execute('SELECT id FROM channel_sets WHERE channels = ?', (channels_json,)).fetchone()[0]
+        self.conn.commit()
+        return set_id
+
+    async def get_channel_set(self, set_id):
+        row = self.conn.execute('SELECT channels FROM channel_sets WHERE id = ?', (set_id,)).fetchone()
+        return row[0] if row else None
+
+    async def add_button(self, button_text, button_command, button_response, created_by):
+        added = self.conn.execute('''
+            INSERT OR IGNORE INTO dynamic_buttons (button_text, button_command, button_response, created_by, is_active)
+            VALUES (?, ?, ?, ?, TRUE)
+        ''', (button_text, button_command, button_response, created_by)).rowcount == 1
+        self.conn.commit()
+        return added
+
+    async def list_buttons(self, active_only=True):
+        where = 'WHERE is_active = TRUE' if active_only else ''
+        return self.conn.execute(f'''
+            SELECT id, button_text, button_command, button_response, is_active, created_by, created_at
+            FROM dynamic_buttons {where} ORDER BY created_at DESC
+        ''').fetchall()
+
+    async def get_button(self, button_command):
+        return self.conn.execute('''
+            SELECT id, button_text, button_command, button_response, is_active, created_by, created_at
+            FROM dynamic_buttons WHERE button_command = ?
+        ''', (button_command,)).fetchone()
+
+    async def delete_button(self, button_command):
+        self.conn.execute('DELETE FROM dynamic_buttons WHERE button_command = ?', (button_command,))
+        self.conn.commit()
+
+    async def toggle_button(self, button_command):
+        row = self.conn.execute('SELECT is_active FROM dynamic_buttons WHERE button_command = ?', (button_command,)).fetchone()
+        if not row:
+            return None
+        new_state = not row[0]
+        self.conn.execute('UPDATE dynamic_buttons SET is_active = ? WHERE button_command = ?', (new_state, button_command))
+        self.conn.commit()
+        return new_state
+
+    async def edit_button(self, button_command, new_text=None, new_response=None):
+        self.conn.execute('''
+            UPDATE dynamic_buttons
+            SET button_text = COALESCE(?, button_text), button_response = COALESCE(?, button_response)
+            WHERE button_command = ?
+        ''', (new_text or None, new_response or None, button_command))
+        self.conn.commit()
+
+    async def registry_version(self, name):
+        row = self.conn.execute('SELECT version FROM registry_versions WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else 0
+
+    async def bump_registry_version(self, name):
+        self.conn.execute('''
+            INSERT INTO registry_versions (name, version) VALUES (?, 1)
+            ON CONFLICT(name) DO UPDATE SET version = version + 1
+        ''', (name,))
+        self.conn.commit()
+
+POSTGRES_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS codes (
+        id BIGSERIAL PRIMARY KEY,
+        code TEXT UNIQUE NOT NULL,
+        duration_days INTEGER NOT NULL,
+        price DOUBLE PRECISION DEFAULT 0,
+        is_used BOOLEAN DEFAULT FALSE,
+        used_by BIGINT,
+        used_at BIGINT,
+        created_by TEXT NOT NULL,
+        created_at BIGINT DEFAULT extract(epoch from now())::bigint,
+        expires_at BIGINT,
+        batch_id TEXT,
+        channels TEXT DEFAULT '[]',
+        excluded_channels TEXT DEFAULT '[]',
+        apply_to_all_channels BOOLEAN DEFAULT TRUE,
+        max_uses INTEGER DEFAULT 1,
+        current_uses INTEGER DEFAULT 0,
+        is_active BOOLEAN DEFAULT TRUE,
+        is_trial BOOLEAN DEFAULT FALSE
+    );
+    CREATE TABLE IF NOT EXISTS subscribers (
+        id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT UNIQUE NOT NULL,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        code_used TEXT NOT NULL,
+        subscribed_at BIGINT DEFAULT extract(epoch from now())::bigint,
+        expires_at BIGINT NOT NULL,
+        is_active BOOLEAN DEFAULT TRUE,
+        notified INTEGER DEFAULT 0,
+        channels TEXT DEFAULT '[]',
+        excluded_channels TEXT DEFAULT '[]',
+        apply_to_all_channels BOOLEAN DEFAULT TRUE,
+        invite_links TEXT DEFAULT '[]',
+        last_notification BIGINT,
+        is_trial BOOLEAN DEFAULT FALSE,
+        trial_used BOOLEAN DEFAULT FALSE
+    );
+    CREATE INDEX IF NOT EXISTS idx_subscribers_active_expires ON subscribers (is_active, expires_at);
+    CREATE TABLE IF NOT EXISTS redeemed_nonces (
+        nonce BIGINT PRIMARY KEY,
+        plan INTEGER NOT NULL,
+        user_id BIGINT NOT NULL,
+        redeemed_at DOUBLE PRECISION NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS notification_log (
+        idempotency_key TEXT PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        expires_at BIGINT NOT NULL,
+        kind TEXT NOT NULL,
+        sent_at DOUBLE PRECISION
+    );
+    CREATE TABLE IF NOT EXISTS subscribers_archive (LIKE subscribers);
+    ALTER TABLE subscribers_archive ADD COLUMN IF NOT EXISTS archived_at BIGINT;
+    CREATE INDEX IF NOT EXISTS idx_subscribers_archive_user ON subscribers_archive (user_id);
+    CREATE TABLE IF NOT EXISTS codes_archive (LIKE codes);
+    ALTER TABLE codes_archive ADD COLUMN IF NOT EXISTS archived_at BIGINT;
+    CREATE INDEX IF NOT EXISTS idx_codes_archive_code ON codes_archive (code);
+    CREATE TABLE IF NOT EXISTS archive_totals (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        used_codes BIGINT NOT NULL DEFAULT 0,
+        total_revenue DOUBLE PRECISION NOT NULL DEFAULT 0
+    );
+    INSERT INTO archive_totals (id) VALUES (1) ON CONFLICT DO NOTHING;
+    CREATE TABLE IF NOT EXISTS admins (
+        id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT UNIQUE NOT NULL,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        added_by BIGINT,
+        added_at TEXT DEFAULT to_char(now() AT TIME ZONE 'UTC', 'YYYY-MM-DD HH24:MI:SS'),
+        permissions TEXT DEFAULT 'all',
+        is_active BOOLEAN DEFAULT TRUE
+    );
+    CREATE TABLE IF NOT EXISTS additional_channels (
+        id BIGSERIAL PRIMARY KEY,
+        channel_id TEXT UNIQUE NOT NULL,
+        channel_username TEXT,
+        channel_name TEXT,
+        added_by BIGINT,
+        added_at TEXT DEFAULT to_char(now() AT TIME ZONE 'UTC', 'YYYY-MM-DD HH24:MI:SS'),
+        is_active BOOLEAN DEFAULT TRUE,
+        channel_type TEXT DEFAULT 'premium',
+        require_subscription BOOLEAN DEFAULT TRUE,
+        is_main_channel BOOLEAN DEFAULT FALSE
+    );
+    CREATE TABLE IF NOT EXISTS dynamic_buttons (
+        id BIGSERIAL PRIMARY KEY,
+        button_text TEXT NOT NULL,
+        button_command TEXT UNIQUE NOT NULL,
+        button_response TEXT NOT NULL,
+        is_active BOOLEAN DEFAULT TRUE,
+        created_by BIGINT,
+        created_at TEXT DEFAULT to_char(now() AT TIME ZONE 'UTC', 'YYYY-MM-DD HH24:MI:SS')
+    );
+    CREATE TABLE IF NOT EXISTS channel_sets (
+        id BIGSERIAL PRIMARY KEY,
+        channels TEXT UNIQUE NOT NULL,
+        created_by BIGINT,
+        created_at TEXT DEFAULT to_char(now() AT TIME ZONE 'UTC', 'YYYY-MM-DD HH24:MI:SS')
+    );
+    CREATE TABLE IF NOT EXISTS registry_versions (
+        name TEXT PRIMARY KEY,
+        version BIGINT NOT NULL DEFAULT 0
+    );
+'''
+
+class PostgresStore(SubscriptionStore):
+    """التخزين في PostgreSQL عبر مجمع اتصالات asyncpg، يسمح لعدة نسخ من البوت بمشاركة نفس البيانات"""
+    name = "postgres"
+
+    def __init__(self, dsn=DATABASE_URL, min_size=DATABASE_POOL_MIN, max_size=DATABASE_POOL_MAX):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.pool = None
+
+    async def open(self):
+        """إنشاء المجمع في حلقة البوت وإنشاء الجداول"""
+        import asyncpg
+        self.pool = await asyncpg.create_pool(self.dsn, min_size=self.min_size, max_size=self.max_size)
+        async with self.pool.acquire() as conn:
+            await conn.execute(POSTGRES_SCHEMA)
+            # المشرف الأساسي والقناة الرئيسية كما في seed_defaults لقاعدة SQLite
+            await conn.execute('''
+                INSERT INTO admins (user_id, username, first_name, last_name, added_by, permissions, is_active)
+                VALUES ($1, 'SPX_47', 'المشرف', 'الرئيسي', $1, 'all', TRUE)
+                ON CONFLICT (user_id) DO NOTHING
+            ''', ADMIN_IDS[0])
+            await conn.execute('''
+                INSERT INTO additional_channels (channel_id, channel_username, channel_name, added_by, is_active, is_main_channel)
+                VALUES ($1, $2, 'القناة الرئيسية', $3, TRUE, TRUE)
+                ON CONFLICT (channel_id) DO NOTHING
+            ''', CHANNEL_ID, CHANNEL_USERNAME, ADMIN_IDS[0])
+        logger.info("✅ تم الاتصال بقاعدة PostgreSQL")
+
+    async def close(self):
+        if self.pool:
+            await self.pool.close()
+            self.pool = None
+
+    async def get_redeemable_code(self, code):
+        row = await self.pool.fetchrow('''
+            SELECT id, duration_days, is_used, expires_at, channels, excluded_channels, apply_to_all_channels, max_uses, current_uses, is_trial
+            FROM codes 
+            WHERE code = $1 AND is_used = FALSE AND is_active = TRUE
+        ''', code)
+        return tuple(row) if row else None
+
+    async def is_code_available(self, code):
+        return await self.pool.fetchval(
+            'SELECT id FROM codes WHERE code = $1 AND is_used = FALSE AND is_active = TRUE', code
+        ) is not None
+
+    async def exhaust_code(self, code_id):
+        await self.pool.execute('UPDATE codes SET is_used = TRUE WHERE id = $1', code_id)
+
+    async def insert_codes(self, rows):
+        await self.pool.executemany('''
+            INSERT INTO codes (code, duration_days, price, created_by, expires_at, batch_id, channels, excluded_channels, apply_to_all_channels, max_uses, is_trial, is_active)
+            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, TRUE)
+        ''', [(row[0], row[1], float(row[2]), str(row[3]), *row[4:8], bool(row[8]), row[9], bool(row[10])) for row in rows])
+
+    async def list_available_codes(self, now):
+        rows = await self.pool.fetch('''
+            SELECT code, duration_days, price, created_at, expires_at, is_trial
+            FROM codes 
+            WHERE is_used = FALSE AND is_active = TRUE AND (expires_at IS NULL OR expires_at > $1)
+            ORDER BY created_at DESC
+        ''', now)
+        return [tuple(row) for row in rows]
+
+    async def get_subscriber(self, user_id):
+        row = await self.pool.fetchrow('''
+            SELECT code_used, subscribed_at, expires_at, is_active, invite_links, is_trial, trial_used
+            FROM subscribers 
+            WHERE user_id = $1
+        ''', user_id)
+        return tuple(row) if row else None
+
+    async def save_subscriber(self, conn, subscriber):
+        await conn.execute('''
+            INSERT INTO subscribers 
+            (user_id, username, first_name, last_name, code_used, expires_at, is_active, channels, excluded_channels, apply_to_all_channels, invite_links, last_notification, is_trial, trial_used)
+            VALUES ($1, $2, $3, $4, $5, $6, TRUE, $7, $8, $9, $10, NULL, $11, $11)
+            ON CONFLICT (user_id) DO UPDATE SET
+                username = EXCLUDED.username, first_name = EXCLUDED.first_name, last_name = EXCLUDED.last_name,
+                code_used = EXCLUDED.code_used, expires_at = EXCLUDED.expires_at, is_active = TRUE,
+                channels = EXCLUDED.channels, excluded_channels = EXCLUDED.excluded_channels,
+                apply_to_all_channels = EXCLUDED.apply_to_all_channels, invite_links = EXCLUDED.invite_links,
+                last_notification = NULL, is_trial = EXCLUDED.is_trial, trial_used = EXCLUDED.trial_used,
+                subscribed_at = extract(epoch from now())::bigint
+        ''', subscriber['user_id'], subscriber['username'], subscriber['first_name'], subscriber['last_name'],
+            subscriber['code_used'], subscriber['expires_at'], subscriber['channels'], subscriber['excluded_channels'],
+            bool(subscriber['apply_to_all_channels']), subscriber['invite_links'], bool(subscriber['is_trial']))
+
+    async def redeem_code(self, code_id, subscriber):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                claimed = await conn.fetchval('''
+                    UPDATE codes 
+                    SET current_uses = current_uses + 1,
+                        is_used = current_uses + 1 >= max_uses,
+                        used_at = extract(epoch from now())::bigint
+                    WHERE id = $1 AND is_active AND NOT is_used AND current_uses < max_uses
+                    RETURNING id
+                ''', code_id)
+                if claimed is None:
+                    return False
+                await self.save_subscriber(conn, subscriber)
+                return True
+
+    async def is_nonce_redeemed(self, nonce):
+        return await self.pool.fetchval('SELECT 1 FROM redeemed_nonces WHERE nonce = $1', nonce) is not None
+
+    async def redeem_signed_code(self, nonce, plan, subscriber):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                claimed = await conn.fetchval('''
+                    INSERT INTO redeemed_nonces (nonce, plan, user_id, redeemed_at)
+                    VALUES ($1, $2, $3, $4)
+                    ON CONFLICT (nonce) DO NOTHING
+                    RETURNING nonce
+                ''', nonce, plan, subscriber['user_id'], time.time())
+                if claimed is None:
+                    return False
+                await self.save_subscriber(conn, subscriber)
+                return True
+
+    async def create_trial(self, subscriber, trial_code, duration_days):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute('''
+                    INSERT INTO subscribers 
+                    (user_id, username, first_name, last_name, code_used, expires_at, is_active, 
+                     channels, excluded_channels, apply_to_all_channels, invite_links, is_trial, trial_used)
+                    VALUES ($1, $2, $3, $4, $5, $6, TRUE, '[]', '[]', TRUE, $7, TRUE, FALSE)
+                ''', subscriber['user_id'], subscriber['username'], subscriber['first_name'], subscriber['last_name'],
+                    trial_code, subscriber['expires_at'], subscriber['invite_links'])
+                await conn.execute('''
+                    INSERT INTO codes (code, duration_days, price, created_by, is_trial, is_active)
+                    VALUES ($1, $2, 0, 'system', TRUE, FALSE)
+                ''', trial_code, duration_days)
+
+    async def list_subscribers(self):
+        rows = await self.pool.fetch('''
+            SELECT user_id, username, first_name, last_name, code_used, 
+                   subscribed_at, expires_at, is_active, is_trial
+            FROM subscribers 
+            ORDER BY subscribed_at DESC
+        ''')
+        return [tuple(row) for row in rows]
+
+    async def expired_subscribers(self, now, trial_only=False):
+        trial_filter = "AND is_trial = TRUE" if trial_only else ""
+        rows = await self.pool.fetch(f'''
+            SELECT user_id, expires_at
+            FROM subscribers 
+            WHERE expires_at < $1 AND is_active = TRUE {trial_filter}
+        ''', now)
+        return [tuple(row) for row in rows]
+
+    async def expire_subscriber(self, user_id, expires_at):
+        # SKIP LOCKED: إذا كانت نسخة أخرى تعالج نفس المشترك الآن نتخطاه بدلاً من انتظارها
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                row = await conn.fetchrow('''
+                    SELECT id, code_used, invite_links, is_trial FROM subscribers
+                    WHERE user_id = $1 AND expires_at = $2 AND is_active = TRUE
+                    FOR UPDATE SKIP LOCKED
+                ''', user_id, expires_at)
+                if not row:
+                    return None
+                await conn.execute('''
+                    UPDATE subscribers 
+                    SET is_active = FALSE,
+                        trial_used = CASE WHEN is_trial THEN TRUE ELSE trial_used END
+                    WHERE id = $1
+                ''', row['id'])
+                return row['code_used'], row['invite_links'], row['is_trial']
+
+    async def expiring_subscribers(self, start, end):
+        rows = await self.pool.fetch('''
+            SELECT user_id, code_used, expires_at, is_trial
+            FROM subscribers 
+            WHERE is_active = TRUE AND expires_at BETWEEN $1 AND $2
+        ''', start, end)
+        return [tuple(row) for row in rows]
+
+    async def stats(self):
+        row = await self.pool.fetchrow('''
+            SELECT
+                (SELECT COUNT(*) FROM subscribers WHERE is_active = TRUE),
+                (SELECT COUNT(*) FROM codes WHERE is_used = FALSE AND is_active = TRUE),
+                (SELECT COUNT(*) FROM codes WHERE is_used = TRUE) + (SELECT used_codes FROM archive_totals),
+                (SELECT COALESCE(SUM(price), 0) FROM codes WHERE is_used = TRUE) + (SELECT total_revenue FROM archive_totals),
+                (SELECT COUNT(*) FROM additional_channels WHERE is_active = TRUE)
+        ''')
+        return {
+            'active_subscribers': row[0],
+            'available_codes': row[1],
+            'used_codes': row[2],
+            'total_revenue': row[3],
+            'active_channels': row[4]
+        }
+
+    async def sent_notification_keys(self, keys):
+        rows = await self.pool.fetch(
+            'SELECT idempotency_key FROM notification_log WHERE idempotency_key = ANY($1::text[])', keys
+        )
+        return {row[0] for row in rows}
+
+    async def reserve_notifications(self, rows):
+        if not rows:
+            return set()
+        keys, user_ids, expires, kinds = (list(column) for column in zip(*rows))
+        reserved = await self.pool.fetch('''
+            INSERT INTO notification_log (idempotency_key, user_id, expires_at, kind, sent_at)
+            SELECT key, user_id, expires_at, kind, NULL
+            FROM unnest($1::text[], $2::bigint[], $3::bigint[], $4::text[]) AS t(key, user_id, expires_at, kind)
+            ON CONFLICT (idempotency_key) DO NOTHING
+            RETURNING idempotency_key
+        ''', keys, user_ids, expires, kinds)
+        return {row[0] for row in reserved}
+
+    async def finish_notifications(self, failed_keys, sent_keys, sent_users, now):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(
+                    'DELETE FROM notification_log WHERE idempotency_key = ANY($1::text[])', failed_keys
+                )
+                await conn.execute(
+                    'UPDATE notification_log SET sent_at = $1 WHERE idempotency_key = ANY($2::text[])',
+                    now, sent_keys
+                )
+                await conn.execute(
+                    'UPDATE subscribers SET last_notification = $1 WHERE user_id = ANY($2::bigint[])',
+                    int(now), sent_users
+                )
+
+    async def archive_subscribers(self, cutoff, limit, now):
+        # الأرشيف بنفس ترتيب أعمدة الجدول الأصلي (LIKE) مع archived_at في النهاية
+        rows = await self.pool.fetch('''
+            WITH moved AS (
+                DELETE FROM subscribers WHERE id IN (
+                    SELECT id FROM subscribers
+                    WHERE is_active = FALSE AND expires_at < $1
+                    LIMIT $2
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING *
+            ), archived AS (
+                INSERT INTO subscribers_archive SELECT moved.*, $3::bigint FROM moved
+            )
+            SELECT user_id FROM moved
+        ''', cutoff, limit, now)
+        return [row[0] for row in rows]
+
+    async def archive_codes(self, cutoff, after_id, limit, now):
+        row = await self.pool.fetchrow('''
+            WITH moved AS (
+                DELETE FROM codes WHERE id IN (
+                    SELECT id FROM codes
+                    WHERE id > $1 AND (
+                        (is_used = TRUE AND COALESCE(used_at, created_at) < $2)
+                        OR expires_at < $2
+                        OR (is_active = FALSE AND created_at < $2)
+                    )
+                    ORDER BY id
+                    LIMIT $3
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING *
+            ), archived AS (
+                INSERT INTO codes_archive SELECT moved.*, $4::bigint FROM moved
+            ), totals AS (
+                UPDATE archive_totals SET
+                    used_codes = used_codes + (SELECT COUNT(*) FROM moved WHERE is_used),
+                    total_revenue = total_revenue + (SELECT COALESCE(SUM(price), 0) FROM moved WHERE is_used)
+                WHERE id = 1
+            )
+            SELECT COUNT(*), MAX(id) FROM moved
+        ''', after_id, cutoff, limit, now)
+        return row[0], row[1] or after_id
+
+    async def has_archived_trial(self, user_id):
+        return await self.pool.fetchval('''
+            SELECT 1 FROM subscribers_archive
+            WHERE user_id = $1 AND (is_trial = TRUE OR trial_used = TRUE)
+            LIMIT 1
+        ''', user_id) is not None
+
+    async def archived_subscriber(self, user_id):
+        rows = await self.pool.fetch('''
+            SELECT code_used, subscribed_at, expires_at, is_trial, archived_at
+            FROM subscribers_archive
+            WHERE user_id = $1
+            ORDER BY expires_at DESC
+        ''', user_id)
+        return [tuple(row) for row in rows]
+
+    async def archived_code(self, code):
+        row = await self.pool.fetchrow('''
+            SELECT code, duration_days, price, is_used, created_at, archived_at
+            FROM codes_archive
+            WHERE code = $1
+        ''', code)
+        return tuple(row) if row else None
+
+    async def is_admin(self, user_id):
+        return await self.pool.fetchval(
+            'SELECT id FROM admins WHERE user_id = $1 AND is_active = TRUE', user_id
+        ) is not None
+
+    async def add_admin(self, user_id, username, first_name, last_name, added_by):
+        await self.pool.execute('''
+            INSERT INTO admins (user_id, username, first_name, last_name, added_by, is_active)
+            VALUES ($1, $2, $3, $4, $5, TRUE)
+            ON CONFLICT (user_id) DO UPDATE
+            SET username = EXCLUDED.username, first_name = EXCLUDED.first_name, last_name = EXCLUDED.last_name,
+                added_by = EXCLUDED.added_by, is_active = TRUE
+        ''', user_id, username, first_name, last_name, added_by)
+
+    async def remove_admin(self, user_id):
+        await self.pool.execute('DELETE FROM admins WHERE user_id = $1', user_id)
+
+    async def list_admins(self):
+        rows = await self.pool.fetch('''
+            SELECT user_id, username, first_name, last_name, added_at 
+            FROM admins WHERE is_active = TRUE ORDER BY added_at DESC
+        ''')
+        return [tuple(row) for row in rows]
+
+    async def add_channel(self, channel_id, channel_username, channel_name, added_by, channel_type, require_subscription, is_main_channel):
+        await self.pool.execute('''
+            INSERT INTO additional_channels 
+            (channel_id, channel_username, channel_name, added_by, is_active, channel_type, require_subscription, is_main_channel)
+            VALUES ($1, $2, $3, $4, TRUE, $5, $6, $7)
+            ON CONFLICT (channel_id) DO UPDATE
+            SET channel_username = EXCLUDED.channel_username, channel_name = EXCLUDED.channel_name, added_by = EXCLUDED.added_by,
+                is_active = TRUE, channel_type = EXCLUDED.channel_type, require_subscription = EXCLUDED.require_subscription,
+                is_main_channel = EXCLUDED.is_main_channel
+        ''', channel_id, channel_username, channel_name, added_by, channel_type, require_subscription, is_main_channel)
+
+    async def active_channels(self):
+        rows = await self.pool.fetch('''
+            SELECT id, channel_id, channel_username, channel_name, added_at, is_active, is_main_channel
+            FROM additional_channels 
+            WHERE is_active = TRUE
+            ORDER BY is_main_channel DESC, added_at DESC
+        ''')
+        return [tuple(row) for row in rows]
 
-# =============================================
-# نظام التسجيل
-# =============================================
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('subscription_bot.log', encoding='utf-8'),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
-logger = logging.getLogger(__name__)
+    async def additional_channels(self):
+        rows = await self.pool.fetch('''
+            SELECT channel_id, channel_username, channel_name 
+            FROM additional_channels 
+            WHERE is_active = TRUE AND is_main_channel = FALSE
+        ''')
+        return [tuple(row) for row in rows]
+
+    async def main_channel(self):
+        row = await self.pool.fetchrow('''
+            SELECT channel_id, channel_username, channel_name 
+            FROM additional_channels 
+            WHERE is_main_channel = TRUE AND is_active = TRUE
+            LIMIT 1
+        ''')
+        return tuple(row) if row else None
+
+    async def channel_by_id(self, channel_id):
+        row = await self.pool.fetchrow('''
+            SELECT channel_id, channel_username, channel_name 
+            FROM additional_channels 
+            WHERE channel_id = $1 AND is_active = TRUE
+        ''', str(channel_id))
+        return tuple(row) if row else None
+
+    async def get_or_create_channel_set(self, channels_json, created_by):
+        # التحديث الفارغ يعيد id الصف الموجود، فيكفي استعلام واحد في الحالتين
+        return await self.pool.fetchval('''
+            INSERT INTO channel_sets (channels, created_by) VALUES ($1, $2)
+            ON CONFLICT (channels) DO UPDATE SET channels = EXCLUDED.channels
+            RETURNING id
+        ''', channels_json, created_by)
+
+    async def get_channel_set(self, set_id):
+        return await self.pool.fetchval('SELECT channels FROM channel_sets WHERE id = $1', set_id)
+
+    async def add_button(self, button_text, button_command, button_response, created_by):
+        return await self.pool.fetchval('''
+            INSERT INTO dynamic_buttons (button_text, button_command, button_response, created_by, is_active)
+            VALUES ($1, $2, $3, $4, TRUE)
+            ON CONFLICT (button_command) DO NOTHING
+            RETURNING id
+        ''', button_text, button_command, button_response, created_by) is not None
+
+    async def list_buttons(self, active_only=True):
+        where = 'WHERE is_active = TRUE' if active_only else ''
+        rows = await self.pool.fetch(f'''
+            SELECT id, button_text, button_command, button_response, is_active, created_by, created_at
+            FROM dynamic_buttons {where} ORDER BY created_at DESC
+        ''')
+        return [tuple(row) for row in rows]
+
+    async def get_button(self, button_command):
+        row = await self.pool.fetchrow('''
+            SELECT id, button_text, button_command, button_response, is_active, created_by, created_at
+            FROM dynamic_buttons WHERE button_command = $1
+        ''', button_command)
+        return tuple(row) if row else None
+
+    async def delete_button(self, button_command):
+        await self.pool.execute('DELETE FROM dynamic_buttons WHERE button_command = $1', button_command)
+
+    async def toggle_button(self, button_command):
+        return await self.pool.fetchval(
+            'UPDATE dynamic_buttons SET is_active = NOT is_active WHERE button_command = $1 RETURNING is_active',
+            button_command
+        )
 
-# =============================================
-# ديكوراتور إعادة المحاولة
-# =============================================
-def retry_async(max_retries=3, delay=1.0):
-    """ديكوراتور لإعادة المحاولة للدوال غير المتزامنة"""
-    def decorator(func):
-        @wraps(func)
-        async def wrapper(*args, **kwargs):
-            last_exception = None
-            for attempt in range(max_retries):
-                try:
-                    return await func(*args, **kwargs)
-                except Exception as e:
-                    last_exception = e
-                    if attempt < max_retries - 1:
-                        wait_time = delay * (2 ** attempt)  # exponential backoff
-                        logger.warning(f"⚠️ محاولة {attempt + 1} فشلت، إعادة المحاولة بعد {wait_time} ثانية: {e}")
-                        await asyncio.sleep(wait_time)
-                    else:
-                        logger.error(f"❌ فشلت جميع {max_retries} محاولات: {e}")
-            raise last_exception
-        return wrapper
-    return decorator
+    async def edit_button(self, button_command, new_text=None, new_response=None):
+        await self.pool.execute('''
+            UPDATE dynamic_buttons
+            SET button_text = COALESCE($2, button_text), button_response = COALESCE($3, button_response)
+            WHERE button_command = $1
+        ''', button_command, new_text or None, new_response or None)
+
+    async def registry_version(self, name):
+        return await self.pool.fetchval('SELECT version FROM registry_versions WHERE name = $1', name) or 0
+
+    async def bump_registry_version(self, name):
+        await self.pool.execute('''
+            INSERT INTO registry_versions (name, version) VALUES ($1, 1)
+            ON CONFLICT (name) DO UPDATE SET version = registry_versions.version + 1
+        ''', name)
+
+def create_store(system):
+    """اختيار طبقة التخزين: PostgreSQL إذا تم تعيين DATABASE_URL وكانت asyncpg مثبتة"""
+    if DATABASE_URL:
+        if HAS_ASYNCPG:
+            return PostgresStore(DATABASE_URL)
+        logger.warning("⚠️ DATABASE_URL معين لكن مكتبة asyncpg غير مثبتة، سيتم استخدام SQLite")
+    return SQLiteStore(system.conn)
+
+SUBSCRIBER_CACHE_LOOKUPS = metrics.counter(
+    "bot_subscriber_cache_lookups_total", "عمليات القراءة من ذاكرة المشتركين المؤقتة", ("result",))
+SUBSCRIBER_CACHE_SIZE = metrics.gauge("bot_subscriber_cache_entries", "عدد المشتركين في الذاكرة المؤقتة")
+
+class SubscriberCache:
+    """ذاكرة مؤقتة (LRU مع مدة صلاحية) لسجلات المشتركين حسب user_id، تحفظ أيضاً غياب السجل"""
+    def __init__(self, max_entries=SUBSCRIBER_CACHE_MAX_ENTRIES, ttl=SUBSCRIBER_CACHE_TTL, shared_version=None, sync_interval=1.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        # جيل كل مستخدم هو قيمة العداد عند آخر إبطال له: القراءة التي بدأت قبل الإبطال لا تعيد تخزين قيمة قديمة.
+        # العداد لا ينقص أبداً، والمستخدم الذي حذف جيله يأخذ أعلى جيل محذوف (floor) بدلاً من 0
+        self.counter = 0
+        self.floor = 0
+        self.generations = OrderedDict()
+        # رقم إصدار مشترك في القاعدة تزيده عمليات الكتابة من خارج عامل المستخدم (الفحص الدوري والأرشفة في القائد)
+        self.shared_version = shared_version
+        self.sync_interval = sync_interval
+        self.synced_version = None
+        self.synced_at = 0.0
+        self.lock = threading.Lock()
+
+    async def sync(self, now):
+        """قراءة الإصدار المشترك مرة كل sync_interval، وتفريغ الذاكرة إذا تغير"""
+        if self.shared_version is None or now - self.synced_at < self.sync_interval:
+            return
+        self.synced_at = now
+        version = await self.shared_version()
+        if version != self.synced_version:
+            if self.synced_version is not None:
+                self.clear()
+            self.synced_version = version
+
+    async def get(self, user_id, loader):
+        """إرجاع السجل من الذاكرة، أو تحميله عبر loader وتخزينه"""
+        if self.ttl <= 0:
+            return await loader(user_id)
+        
+        now = time.monotonic()
+        await self.sync(now)
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry and entry[1] > now:
+                self.entries.move_to_end(user_id)
+                SUBSCRIBER_CACHE_LOOKUPS.inc(result="hit")
+                return entry[0]
+            started = self.counter
+        
+        SUBSCRIBER_CACHE_LOOKUPS.inc(result="miss")
+        record = await loader(user_id)
+        
+        with self.lock:
+            if self.generations.get(user_id, self.floor) <= started:
+                self.entries[user_id] = (record, time.monotonic() + self.ttl)
+                self.entries.move_to_end(user_id)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+            SUBSCRIBER_CACHE_SIZE.set(len(self.entries))
+        return record
+
+    def invalidate(self, user_id):
+        """حذف سجل المستخدم بعد أي كتابة عليه"""
+        with self.lock:
+            self.entries.pop(user_id, None)
+            self.counter += 1
+            self.generations.pop(user_id, None)
+            self.generations[user_id] = self.counter
+            if len(self.generations) > self.max_entries * 2:
+                # الأجيال القديمة لا تهم إلا أثناء قراءة جارية، لذا يكفي الاحتفاظ بالأحدث (الأقدم إبطالاً أولاً)
+                while len(self.generations) > self.max_entries:
+                    _, generation = self.generations.popitem(last=False)
+                    self.floor = max(self.floor, generation)
+            SUBSCRIBER_CACHE_SIZE.set(len(self.entries))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generations.clear()
+            # القراءات الجارية وقت التفريغ لا تخزن نتيجتها
+            self.counter += 1
+            self.floor = self.counter
+            SUBSCRIBER_CACHE_SIZE.set(0)
 
 # =============================================
 # نظام إدارة قاعدة البيانات - الإصدار المحدث
 # =============================================
+# رقم إصدار المخطط (PRAGMA user_version). القاعدة التي بلغته تتخطى إنشاء الجداول والأعمدة عند البدء،
+# لذلك أي تغيير في الجداول أو الأعمدة أو الفهارس يتطلب زيادته (وخطوة في migrate_schema إذا لزم نقل بيانات)
+SCHEMA_VERSION = 3
+EPOCH_DEFAULT = "(CAST(strftime('%s', 'now') AS INTEGER))"
+
+# الجداول التي قد يعاد بناؤها عند الترحيل، {name} يسمح بإنشاء النسخة الجديدة باسم مؤقت
+CODES_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS {name} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        code TEXT UNIQUE NOT NULL,
+        duration_days INTEGER NOT NULL,
+        price REAL DEFAULT 0,
+        is_used BOOLEAN DEFAULT FALSE,
+        used_by INTEGER,
+        used_at INTEGER,
+        created_by INTEGER NOT NULL,
+        created_at INTEGER DEFAULT %s,
+        expires_at INTEGER,
+        batch_id TEXT,
+        channels TEXT DEFAULT '[]',
+        excluded_channels TEXT DEFAULT '[]',
+        apply_to_all_channels BOOLEAN DEFAULT TRUE,
+        max_uses INTEGER DEFAULT 1,
+        current_uses INTEGER DEFAULT 0,
+        is_active BOOLEAN DEFAULT TRUE,
+        is_trial BOOLEAN DEFAULT FALSE
+    )
+''' % EPOCH_DEFAULT
+
+SUBSCRIBERS_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS {name} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER UNIQUE NOT NULL,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        code_used TEXT NOT NULL,
+        subscribed_at INTEGER DEFAULT %s,
+        expires_at INTEGER NOT NULL,
+        is_active BOOLEAN DEFAULT TRUE,
+        notified INTEGER DEFAULT 0,
+        channels TEXT DEFAULT '[]',
+        excluded_channels TEXT DEFAULT '[]',
+        apply_to_all_channels BOOLEAN DEFAULT TRUE,
+        invite_links TEXT DEFAULT '[]',
+        last_notification INTEGER,
+        is_trial BOOLEAN DEFAULT FALSE,
+        trial_used BOOLEAN DEFAULT FALSE
+    )
+''' % EPOCH_DEFAULT
+
+NOTIFICATION_LOG_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS {name} (
+        idempotency_key TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        expires_at INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        sent_at REAL
+    ) WITHOUT ROWID
+'''
+
 class SubscriptionManagementSystem:
-    def __init__(self):
+    def __init__(self, db_path=DATABASE_PATH, enable_scheduler=True):
+        self.db_path = db_path
         self.setup_database()
+        # الأكواد والمشتركون والتنبيهات تمر عبر طبقة التخزين (SQLite أو PostgreSQL)
+        self.store = create_store(self)
+        self.subscriber_cache = SubscriberCache(shared_version=self.get_subscribers_version)
+        self.backups = BackupManager(db_path)
         self.application = None
-        self.setup_scheduler()
+        self.loop = None
+        self.leader, self.task_queue = create_coordination(db_path)
+        # آخر تشغيل لكل مهمة مجدولة، تعرضه فحوص الصحة
+        self.job_runs = {}
+        self.scheduler_expected = enable_scheduler and HAS_APSCHEDULER
+        # المجدول يبدأ بعد أن يصبح البوت جاهزاً لاستقبال التحديثات (start_scheduler)
+        self.scheduler = None
         
     def set_application(self, application):
         """تعيين تطبيق البوت للمهام المجدولة"""
         self.application = application
         
+    def bind_loop(self, loop):
+        """تعيين حلقة أحداث البوت لتشغيل المهام المجدولة فيها بدلاً من حلقة جديدة"""
+        self.loop = loop
+
+    async def open_store(self):
+        """فتح طبقة التخزين في حلقة البوت (مجمع اتصالات PostgreSQL مرتبط بالحلقة التي أنشئ فيها)"""
+        await self.store.open()
+
+    def run_coroutine(self, coro):
+        """تشغيل دالة غير متزامنة من خيط المهام المجدولة"""
+        if self.loop and self.loop.is_running():
+            # عميل HTTP الخاص بالبوت مرتبط بحلقته، لذا ننفذ المهمة فيها
+            return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+        
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            loop.close()
+
+    def run_leader_job(self, name, coro_func, min_interval=1800):
+        """تشغيل مهمة مجدولة من خيط المجدول فقط إذا حصلت هذه العقدة على عقد القيادة"""
+        return self.run_coroutine(self.run_leader_job_async(name, coro_func, min_interval))
+
+    async def run_leader_job_async(self, name, coro_func, min_interval=1800):
+        """مثل run_leader_job من داخل حلقة البوت (التشغيل اليدوي من المشرف)، تعيد False إذا كانت عقدة أخرى تنفذ المهمة"""
+        lease = await asyncio.to_thread(self.leader.acquire, name, min_interval)
+        if not lease:
+            sweep_logger.info("⏭️ تخطي المهمة %s: عقدة أخرى تنفذها أو نفذتها للتو", name)
+            SWEEP_RUNS.inc(job=name, outcome="skipped")
+            return False
+        
+        sweep_logger.info("👑 تنفيذ المهمة %s كقائد (الرمز %s)", name, lease.token)
+        completed = False
+        outcome = "error"
+        started = time.perf_counter()
+        try:
+            await coro_func(lease=lease)
+            completed = not lease.lost
+            outcome = "completed" if completed else "lease_lost"
+        except Exception as e:
+            # المهمة لا تعتبر مكتملة، فيستأنفها resume_interrupted_jobs أو التشغيل التالي
+            sweep_logger.error("❌ فشل تنفيذ المهمة %s: %s", name, e)
+            raise
+        finally:
+            await asyncio.to_thread(lease.release, completed)
+            SWEEP_SECONDS.observe(time.perf_counter() - started, job=name)
+            SWEEP_RUNS.inc(job=name, outcome=outcome)
+        return True
+
+    def resume_interrupted_jobs(self):
+        """استئناف المهام التي توقف قائدها قبل إكمالها"""
+        jobs = {
+            'check_expired_subscriptions': self.check_expired_subscriptions_async,
+            'check_expired_trials': self.check_expired_trials_async,
+            'send_expiry_notifications': self.send_expiry_notifications_async,
+            'archive_cold_data': self.archive_cold_data_async,
+        }
+        if not self.application:
+            return
+        for name, coro_func in jobs.items():
+            try:
+                if self.leader.backend.is_interrupted(name):
+                    sweep_logger.warning("⚠️ المهمة %s لم تكتمل على القائد السابق، جاري الاستئناف", name)
+                    self.run_leader_job(name, coro_func, min_interval=0)
+            except Exception as e:
+                sweep_logger.error("❌ خطأ في استئناف المهمة %s: %s", name, e)
+        
     def setup_database(self):
         """إعداد قاعدة البيانات"""
-        self.conn = sqlite3.connect('subscriptions.db', check_same_thread=False)
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30,
+                                    factory=InstrumentedConnection)
         self.cursor = self.conn.cursor()
+
+        # VACUUM التدريجي بعد الأرشفة، يطبق فقط على القواعد الجديدة (القديمة تحول مرة واحدة في create_schema)
+        self.cursor.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        # WAL يسمح بالقراءة أثناء الكتابة عند مشاركة القاعدة بين عدة عمليات
+        self.cursor.execute('PRAGMA journal_mode=WAL')
+        self.cursor.execute('PRAGMA synchronous=NORMAL')
+        self.cursor.execute('PRAGMA busy_timeout=30000')
+        
+        # القاعدة التي بلغت إصدار المخطط الحالي لا تحتاج لإعادة تنفيذ CREATE و ALTER في كل تشغيل
+        if self.cursor.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+            self.create_schema()
+        self.seed_defaults()
         
+        self.conn.commit()
+        sweep_logger.info("✅ تم إعداد قاعدة البيانات بنجاح")
+
+    def create_schema(self):
+        """إنشاء الجداول والفهارس الناقصة وترحيل القواعد القديمة، ثم تسجيل إصدار المخطط الحالي"""
         # جدول الأكواد
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS codes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                code TEXT UNIQUE NOT NULL,
-                duration_days INTEGER NOT NULL,
-                price REAL DEFAULT 0,
-                is_used BOOLEAN DEFAULT FALSE,
-                used_by INTEGER,
-                used_at TEXT,
-                created_by INTEGER NOT NULL,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                expires_at TEXT,
-                batch_id TEXT,
-                channels TEXT DEFAULT '[]',
-                excluded_channels TEXT DEFAULT '[]',
-                apply_to_all_channels BOOLEAN DEFAULT TRUE,
-                max_uses INTEGER DEFAULT 1,
-                current_uses INTEGER DEFAULT 0,
-                is_active BOOLEAN DEFAULT TRUE,
-                is_trial BOOLEAN DEFAULT FALSE
-            )
-        ''')
+        self.cursor.execute(CODES_TABLE_SQL.format(name='codes'))
         
         # جدول المشتركين
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS subscribers (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER UNIQUE NOT NULL,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT,
-                code_used TEXT NOT NULL,
-                subscribed_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                expires_at TEXT NOT NULL,
-                is_active BOOLEAN DEFAULT TRUE,
-                notified INTEGER DEFAULT 0,
-                channels TEXT DEFAULT '[]',
-                excluded_channels TEXT DEFAULT '[]',
-                apply_to_all_channels BOOLEAN DEFAULT TRUE,
-                invite_links TEXT DEFAULT '[]',
-                last_notification TEXT,
-                is_trial BOOLEAN DEFAULT FALSE,
-                trial_used BOOLEAN DEFAULT FALSE
-            )
-        ''')
+        self.cursor.execute(SUBSCRIBERS_TABLE_SQL.format(name='subscribers'))
         
         # جدول المشرفين
         self.cursor.execute('''
@@ -208,24 +3615,167 @@ class SubscriptionManagementSystem:
             )
         ''')
         
-        # إضافة المشرف الأساسي إذا لم يكن موجوداً
+        # سجل التنبيهات المرسلة: مفتاح لكل (مستخدم، تاريخ انتهاء، نوع تنبيه) لمنع التكرار
+        self.cursor.execute(NOTIFICATION_LOG_TABLE_SQL.format(name='notification_log'))
+        
+        # الأكواد الموقعة المستخدمة: رقمها العشوائي فقط (rowid بدون فهرس إضافي)
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS redeemed_nonces (
+                nonce INTEGER PRIMARY KEY,
+                plan INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                redeemed_at REAL NOT NULL
+            )
+        ''')
+        
+        # مجموعات القنوات التي تشير إليها الأكواد الموقعة برقمها
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS channel_sets (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                channels TEXT UNIQUE NOT NULL,
+                created_by INTEGER,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # أرقام إصدارات السجلات المشتركة بين العمليات (لإبطال الذاكرة المؤقتة للقوائم)
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS registry_versions (
+                name TEXT PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        
+        # التحقق من الأعمدة المفقودة وإضافتها
+        self.add_missing_columns()
+        
+        # ترحيل القواعد القديمة حسب رقم إصدار المخطط
+        self.migrate_schema()
+        
+        # فهرس لاستعلامات النطاق على تاريخ الانتهاء (التنبيهات والفحص الدوري)، بعد الترحيل لأنه يعيد بناء الجدول
+        self.cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_subscribers_active_expires
+            ON subscribers (is_active, expires_at)
+        ''')
+
+        # جداول الأرشيف للبيانات الباردة، بنفس أعمدة الجداول الأصلية
+        self.create_archive_table('subscribers')
+        self.create_archive_table('codes')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_subscribers_archive_user ON subscribers_archive (user_id)')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_codes_archive_code ON codes_archive (code)')
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS archive_totals (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                used_codes INTEGER NOT NULL DEFAULT 0,
+                total_revenue REAL NOT NULL DEFAULT 0
+            )
+        ''')
+        self.cursor.execute('INSERT OR IGNORE INTO archive_totals (id) VALUES (1)')
+
+        # الإصدار 3: التحويل لـ VACUUM التدريجي قبل تسجيل الإصدار، فإذا انقطع يعاد في التشغيل التالي
+        self.conn.commit()
+        self.convert_to_incremental_vacuum()
+
+        self.cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        self.conn.commit()
+
+    def convert_to_incremental_vacuum(self):
+        """القواعد المنشأة قبل تفعيل auto_vacuum تحتاج VACUUM كاملاً مرة واحدة، ينفذ عند البدء قبل استقبال التحديثات
+        حتى لا يحجز القاعدة عن المعالجات والعمال الآخرين أثناء الأرشفة"""
+        if self.cursor.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+            return
+        sweep_logger.warning("⚠️ تحويل القاعدة إلى auto_vacuum=INCREMENTAL عبر VACUUM كامل (مرة واحدة)")
+        started = time.perf_counter()
+        self.cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        self.cursor.execute('VACUUM')
+        sweep_logger.info("✅ تم تحويل القاعدة إلى VACUUM التدريجي في %.1fs", time.perf_counter() - started)
+
+    def seed_defaults(self):
+        """إضافة المشرف الأساسي والقناة الرئيسية إذا لم يكونا موجودين"""
         self.cursor.execute('''
             INSERT OR IGNORE INTO admins (user_id, username, first_name, last_name, added_by, permissions, is_active)
             VALUES (?, ?, ?, ?, ?, ?, ?)
         ''', (ADMIN_IDS[0], "SPX_47", "المشرف", "الرئيسي", ADMIN_IDS[0], "all", True))
         
-        # إضافة القناة الرئيسية إذا لم تكن موجودة
         self.cursor.execute('''
             INSERT OR IGNORE INTO additional_channels 
             (channel_id, channel_username, channel_name, added_by, is_active, is_main_channel)
             VALUES (?, ?, ?, ?, ?, ?)
         ''', (CHANNEL_ID, CHANNEL_USERNAME, "القناة الرئيسية", ADMIN_IDS[0], True, True))
-        
-        # التحقق من الأعمدة المفقودة وإضافتها
-        self.add_missing_columns()
-        
+
+    def migrate_schema(self):
+        """تنفيذ خطوات الترحيل المتبقية في معاملة واحدة، عملية واحدة فقط تنفذها عند تشغيل عدة عمال معاً"""
         self.conn.commit()
-        logger.info("✅ تم إعداد قاعدة البيانات بنجاح")
+        self.cursor.execute('BEGIN IMMEDIATE')
+        try:
+            version = self.cursor.execute('PRAGMA user_version').fetchone()[0]
+            # الإصداران 2 و 3 لم يغيرا بيانات موجودة (جداول الأرشيف و auto_vacuum فقط)، فآخر خطوة نقل بيانات هي 1
+            if version >= 1:
+                self.conn.rollback()
+                return
+            
+            if version < 1:
+                self.migrate_epoch_timestamps()
+            
+            self.cursor.execute('PRAGMA user_version = 1')
+            self.conn.commit()
+            sweep_logger.info("✅ تم ترحيل مخطط القاعدة من الإصدار %s إلى 1", version)
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    def create_archive_table(self, table):
+        """جدول {table}_archive بأعمدة الجدول الأصلي بدون قيود التفرد (المستخدم قد يؤرشف أكثر من مرة)"""
+        columns = self.cursor.execute(f'PRAGMA table_info({table})').fetchall()
+        archived = {row[1] for row in self.cursor.execute(f'PRAGMA table_info({table}_archive)').fetchall()}
+        if not archived:
+            definitions = ", ".join(f"{row[1]} {row[2]}" for row in columns)
+            self.cursor.execute(f'CREATE TABLE IF NOT EXISTS {table}_archive ({definitions}, archived_at INTEGER NOT NULL)')
+            return
+        # الأعمدة المضافة لاحقاً للجدول الأصلي تضاف للأرشيف أيضاً
+        for row in columns:
+            if row[1] not in archived:
+                self.cursor.execute(f'ALTER TABLE {table}_archive ADD COLUMN {row[1]} {row[2]}')
+
+    def rebuild_table(self, table, create_sql, convert):
+        """إعادة بناء جدول بالمخطط الجديد، convert: عمود -> تعبير SQL لتحويل قيمته"""
+        old_columns = [row[1] for row in self.cursor.execute(f'PRAGMA table_info({table})').fetchall()]
+        self.cursor.execute(create_sql.format(name=f'{table}_migrated'))
+        new_columns = [row[1] for row in self.cursor.execute(f'PRAGMA table_info({table}_migrated)').fetchall()]
+        columns = [column for column in new_columns if column in old_columns]
+        self.cursor.execute(
+            f"INSERT INTO {table}_migrated ({', '.join(columns)}) "
+            f"SELECT {', '.join(convert.get(column, column) for column in columns)} FROM {table}"
+        )
+        self.cursor.execute(f'DROP TABLE {table}')
+        self.cursor.execute(f'ALTER TABLE {table}_migrated RENAME TO {table}')
+
+    def migrate_epoch_timestamps(self):
+        """الإصدار 1: أعمدة التواريخ النصية تصبح ثوان صحيحة بتوقيت UTC"""
+        self.conn.create_function('legacy_epoch', 1, parse_legacy_timestamp, deterministic=True)
+        
+        self.rebuild_table('codes', CODES_TABLE_SQL, {
+            column: f'legacy_epoch({column})' for column in ('used_at', 'created_at', 'expires_at')
+        })
+        self.rebuild_table('subscribers', SUBSCRIBERS_TABLE_SQL, {
+            column: f'legacy_epoch({column})' for column in ('subscribed_at', 'expires_at', 'last_notification')
+        })
+        
+        # مفتاح التنبيه يحتوي تاريخ الانتهاء (مستخدم:تاريخ:نوع)، فيعاد بناؤه حتى لا تتكرر التنبيهات المرسلة
+        rows = self.cursor.execute(
+            'SELECT idempotency_key, user_id, expires_at, kind, sent_at FROM notification_log'
+        ).fetchall()
+        self.cursor.execute('DROP TABLE notification_log')
+        self.cursor.execute(NOTIFICATION_LOG_TABLE_SQL.format(name='notification_log'))
+        migrated = []
+        for key, user_id, expires_at, kind, sent_at in rows:
+            expires_epoch = parse_legacy_timestamp(expires_at)
+            if expires_epoch is not None:
+                migrated.append((f"{user_id}:{expires_epoch}:{kind}", user_id, expires_epoch, kind, sent_at))
+        self.cursor.executemany(
+            'INSERT OR IGNORE INTO notification_log (idempotency_key, user_id, expires_at, kind, sent_at) VALUES (?, ?, ?, ?, ?)',
+            migrated
+        )
 
     def add_missing_columns(self):
         """إضافة الأعمدة المفقودة إذا كانت غير موجودة"""
@@ -240,7 +3790,7 @@ class SubscriptionManagementSystem:
                 missing_columns.append('invite_links')
             
             if 'last_notification' not in columns:
-                self.cursor.execute('ALTER TABLE subscribers ADD COLUMN last_notification TEXT')
+                self.cursor.execute('ALTER TABLE subscribers ADD COLUMN last_notification INTEGER')
                 missing_columns.append('last_notification')
             
             if 'is_trial' not in columns:
@@ -268,22 +3818,39 @@ class SubscriptionManagementSystem:
                 missing_columns.append('additional_channels.is_main_channel')
             
             if missing_columns:
-                logger.info(f"✅ تم إضافة الأعمدة المفقودة: {missing_columns}")
+                sweep_logger.info("✅ تم إضافة الأعمدة المفقودة: %s", missing_columns)
                 
             self.conn.commit()
         except Exception as e:
-            logger.error(f"❌ خطأ في إضافة الأعمدة المفقودة: {e}")
+            sweep_logger.error("❌ خطأ في إضافة الأعمدة المفقودة: %s", e)
+
+    def close(self):
+        """إيقاف المهام المجدولة وإغلاق الاتصال بقاعدة البيانات"""
+        if self.scheduler:
+            self.scheduler.shutdown(wait=False)
+            self.scheduler = None
+        self.leader.backend.close()
+        self.task_queue.close()
+        self.conn.close()
+
+    def start_scheduler(self):
+        """تشغيل المهام المجدولة إذا طلبت عند إنشاء النظام، بعد أن يبدأ البوت باستقبال التحديثات"""
+        if self.scheduler_expected and self.scheduler is None:
+            self.setup_scheduler()
 
     def setup_scheduler(self):
         """إعداد المهام المجدولة"""
         if not HAS_APSCHEDULER:
-            logger.warning("⚠️ APScheduler غير مثبت، سيتم استخدام النظام بدون مهام مجدولة تلقائية")
+            sweep_logger.warning("⚠️ APScheduler غير مثبت، سيتم استخدام النظام بدون مهام مجدولة تلقائية")
             self.scheduler = None
             return
             
         try:
+            from apscheduler.schedulers.background import BackgroundScheduler
+            from apscheduler.executors.pool import ThreadPoolExecutor
+            from apscheduler.events import EVENT_JOB_EXECUTED, EVENT_JOB_ERROR, EVENT_JOB_MAX_INSTANCES
             executors = {
-                'default': ThreadPoolExecutor(1)
+                'default': ThreadPoolExecutor(3)
             }
             self.scheduler = BackgroundScheduler(executors=executors, timezone=TIMEZONE)
             
@@ -296,11 +3863,10 @@ class SubscriptionManagementSystem:
                 id='check_expired_subscriptions'
             )
             
-            # مهمة إرسال تنبيهات قبل انتهاء الاشتراك بيوم
+            # مهمة إرسال تنبيهات قبل انتهاء الاشتراك، كل ساعة لدعم التنبيه قبل ساعة من الانتهاء
             self.scheduler.add_job(
                 self.send_expiry_notifications_wrapper,
                 'cron', 
-                hour=9,
                 minute=0,
                 id='send_expiry_notifications'
             )
@@ -314,13 +3880,55 @@ class SubscriptionManagementSystem:
                 id='check_expired_trials'
             )
             
+            # تفريغ دوري لطابور المهام (إعادة محاولة المهام الفاشلة أو المعلقة)
+            self.scheduler.add_job(
+                self.drain_task_queue_wrapper,
+                'interval',
+                minutes=5,
+                id='drain_task_queue'
+            )
+            
+            # نسخة احتياطية دورية للقاعدة
+            if BACKUP_INTERVAL_HOURS > 0:
+                self.scheduler.add_job(
+                    self.backup_database_wrapper,
+                    'interval',
+                    hours=BACKUP_INTERVAL_HOURS,
+                    id='backup_database'
+                )
+
+            # أرشفة المشتركين المعطلين والأكواد المستهلكة يومياً في وقت قليل النشاط
+            self.scheduler.add_job(
+                self.archive_cold_data_wrapper,
+                'cron',
+                hour=4,
+                minute=0,
+                id='archive_cold_data'
+            )
+
+            # فحص دوري لالتقاط المهام التي توقف قائدها
+            self.scheduler.add_job(
+                self.resume_interrupted_jobs,
+                'interval',
+                minutes=1,
+                id='resume_interrupted_jobs'
+            )
+            
+            self.scheduler.add_listener(
+                self.on_job_event, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR | EVENT_JOB_MAX_INSTANCES
+            )
             self.scheduler.start()
-            logger.info("✅ تم إعداد المهام المجدولة")
+            sweep_logger.info("✅ تم إعداد المهام المجدولة")
             
         except Exception as e:
-            logger.error(f"❌ خطأ في إعداد المهام المجدولة: {e}")
+            sweep_logger.error("❌ خطأ في إعداد المهام المجدولة: %s", e)
             self.scheduler = None
 
+    def on_job_event(self, event):
+        """تسجيل وقت ونتيجة كل تشغيل لمهمة مجدولة"""
+        from apscheduler.events import EVENT_JOB_ERROR
+        self.job_runs[event.job_id] = {"at": time.time(), "ok": event.code != EVENT_JOB_ERROR}
+
     async def safe_send_message(self, bot, chat_id, text, reply_markup=None):
         """إرسال رسالة آمن مع إعادة المحاولة"""
         try:
@@ -331,334 +3939,371 @@ class SubscriptionManagementSystem:
                 parse_mode='HTML'
             )
         except Exception as e:
-            logger.error(f"❌ خطأ في إرسال رسالة لـ {chat_id}: {e}")
+            sweep_logger.error("❌ خطأ في إرسال رسالة لـ %s: %s", chat_id, e)
             raise
 
-    @retry_async(max_retries=3, delay=1.0)
-    async def remove_user_from_additional_channels_async(self, bot, user_id, invite_links_json):
-        """إخراج المستخدم من القنوات الإضافية فقط (ليس من القناة الرئيسية) - إصدار محسن"""
-        try:
-            if not invite_links_json:
-                return
-                
-            invite_links = json.loads(invite_links_json)
-            
-            for link_info in invite_links:
-                try:
-                    channel_id = link_info.get('channel_id')
-                    # التحقق إذا كانت هذه القناة الرئيسية
-                    if channel_id == CHANNEL_ID:
-                        logger.info(f"⏭️ تخطي إخراج المستخدم {user_id} من القناة الرئيسية")
-                        continue
-                    
-                    if channel_id:
-                        await bot.ban_chat_member(
-                            chat_id=channel_id,
-                            user_id=user_id
-                        )
-                        logger.info(f"✅ تم إخراج المستخدم {user_id} من القناة الإضافية {channel_id}")
-                        
-                        # الانتظار قليلاً لتجنب حظر API
-                        await asyncio.sleep(0.5)
-                        
-                except Exception as e:
-                    logger.error(f"❌ خطأ في إخراج المستخدم {user_id} من القناة {link_info.get('channel_id')}: {e}")
-                    continue  # الاستمرار مع القنوات الأخرى
-                    
-        except Exception as e:
-            logger.error(f"❌ خطأ في إخراج المستخدم من القنوات الإضافية: {e}")
-            raise  # لإعادة المحاولة
-
-    async def check_expired_subscriptions_async(self):
-        """التحقق من الاشتراكات المنتهية (إصدار async محسن)"""
-        try:
-            logger.info("🔄 بدء التحقق من الاشتراكات المنتهية...")
-            cursor = self.get_cursor()
-            current_time = datetime.now().isoformat()
-            
-            # الحصول على المشتركين الذين انتهت اشتراكاتهم
-            cursor.execute('''
-                SELECT user_id, username, first_name, code_used, expires_at, invite_links, is_trial
-                FROM subscribers 
-                WHERE expires_at < ? AND is_active = TRUE
-            ''', (current_time,))
-            
-            expired_subscribers = cursor.fetchall()
-            
-            if not expired_subscribers:
-                logger.info("✅ لا توجد اشتراكات منتهية")
-                cursor.close()
-                return
-            
-            logger.info(f"🔄 معالجة {len(expired_subscribers)} مشترك منتهي الاشتراك")
-            
-            processed_count = 0
-            error_count = 0
-            
-            for subscriber in expired_subscribers:
-                user_id, username, first_name, code_used, expires_at, invite_links_json, is_trial = subscriber
-                
+    @staticmethod
+    def revoke_tasks(user_id, expires_at, invite_links_json):
+        """مهمة إخراج لكل قناة إضافية في روابط المستخدم (ليس القناة الرئيسية)، فيعاد تنفيذ القناة الفاشلة وحدها"""
+        tasks = []
+        for link_info in json.loads(invite_links_json or "[]"):
+            channel_id = link_info.get('channel_id')
+            if not channel_id or channel_id == CHANNEL_ID:
+                continue
+            tasks.append(('revoke_channel', {'user_id': user_id, 'channel_id': channel_id},
+                          f"revoke:{user_id}:{expires_at}:{channel_id}"))
+        return tasks
+
+    async def check_expired_subscriptions_async(self, lease=None):
+        """التحقق من الاشتراكات المنتهية: تحويل كل مشترك منتهي لمهمة مستقلة في الطابور الدائم"""
+        sweep_logger.info("🔄 بدء التحقق من الاشتراكات المنتهية...")
+        queued = await self.enqueue_expired_subscribers(trial_only=False)
+        sweep_logger.info("🔄 تمت إضافة %s مشترك منتهي الاشتراك للطابور", queued)
+
+        processed_count, error_count = await self.process_task_queue(lease)
+        sweep_logger.info("✅ تم معالجة %s مهمة، %s أخطاء", processed_count, error_count)
+
+    async def enqueue_expired_subscribers(self, trial_only=False):
+        """إضافة مهمة تعطيل لكل مشترك منتهي، مفتاح منع التكرار يمنع إضافته مرتين لنفس الانتهاء"""
+        expired = await self.store.expired_subscribers(epoch_now(), trial_only=trial_only)
+        
+        tasks = [
+            ('expire_subscription', {'user_id': user_id, 'expires_at': expires_at}, f"expire:{user_id}:{expires_at}")
+            for user_id, expires_at in expired
+        ]
+        
+        if not tasks:
+            return 0
+        return self.task_queue.enqueue_many(tasks)
+
+    async def process_task_queue(self, lease=None):
+        """تفريغ الطابور: حجز دفعات وتنفيذ مهامها بالتوازي، كل مهمة تحفظ نتيجتها فور انتهائها"""
+        handlers = {
+            'expire_subscription': self.task_expire_subscription,
+            'revoke_access': self.task_revoke_access,
+            'revoke_channel': self.task_revoke_channel,
+            'notify_expired': self.task_notify_expired,
+        }
+        semaphore = asyncio.Semaphore(TASK_CONCURRENCY)
+        worker_id = self.leader.holder
+        # كتابات القائد مشروطة برمز عقده، فلا يحجز أو يسجل نتائج بعد انتقال القيادة لعقدة أخرى
+        fence = (lease.name, lease.token) if lease else None
+        processed_count = 0
+        error_count = 0
+        
+        async def run_task(task_id, kind, payload, attempts):
+            nonlocal processed_count, error_count
+            async with semaphore:
                 try:
-                    # تحديث حالة المشترك
-                    cursor.execute('''
-                        UPDATE subscribers 
-                        SET is_active = FALSE 
-                        WHERE user_id = ?
-                    ''', (user_id,))
-                    
-                    # إخراج المستخدم من القنوات الإضافية فقط (ليس من القناة الرئيسية)
-                    if self.application and self.application.bot:
-                        await self.remove_user_from_additional_channels_async(self.application.bot, user_id, invite_links_json)
-                    
-                    # إرسال رسالة للمستخدم باستخدام الإرسال الآمن
-                    if self.application and self.application.bot:
-                        try:
-                            trial_text = "تجريبية" if is_trial else "عادية"
-                            message_text = f"❌ انتهت صلاحية اشتراكك {trial_text}\n\n🎫 الكود: {code_used}\n📅 انتهى في: {expires_at.split()[0]}\n\nللاستمرار في الوصول للقنوات المميزة، يرجى تجديد الاشتراك."
-                            
-                            await self.safe_send_message(
-                                self.application.bot,
-                                user_id,
-                                message_text
-                            )
-                        except Exception as e:
-                            logger.error(f"❌ لا يمكن إرسال رسالة للمستخدم {user_id}: {e}")
-                            error_count += 1
-                    
+                    handler = handlers.get(kind)
+                    if handler is None:
+                        raise ValueError(f"نوع مهمة غير معروف: {kind}")
+                    await handler(payload)
+                    self.task_queue.complete(task_id, fence)
                     processed_count += 1
-                    logger.info(f"✅ تم تعطيل اشتراك المستخدم {user_id} ({username})")
-                    
-                    # إضافة تأخير لتجنب الضغط على API
-                    await asyncio.sleep(1.0)
-                    
+                    TASKS_PROCESSED.inc(kind=kind, outcome="done")
                 except Exception as e:
-                    logger.error(f"❌ خطأ في معالجة المستخدم {user_id}: {e}")
+                    sweep_logger.error("❌ فشل تنفيذ المهمة %s #%s (المحاولة %s): %s", kind, task_id, attempts, e)
+                    self.task_queue.fail(task_id, e, attempts, fence=fence)
                     error_count += 1
+                    TASKS_PROCESSED.inc(kind=kind, outcome="failed")
+        
+        while True:
+            # التوقف إذا انتقلت القيادة لعقدة أخرى أثناء التنفيذ
+            if lease and not lease.still_valid():
+                sweep_logger.warning("⚠️ تم فقدان عقد القيادة، إيقاف المهمة")
+                break
             
-            self.conn.commit()
-            cursor.close()
-            
-            logger.info(f"✅ تم معالجة {processed_count} مشترك، {error_count} أخطاء")
-            
+            batch = self.task_queue.claim(worker_id, TASK_BATCH_SIZE, fence=fence)
+            if not batch:
+                break
+            await asyncio.gather(*(run_task(*task) for task in batch))
+            if any(kind == 'expire_subscription' for _, kind, _, _ in batch):
+                # إبطال واحد لكل دفعة في ذاكرة العمال الآخرين
+                await self.bump_subscribers_version()
+        
+        return processed_count, error_count
+
+    async def archive_cold_data_async(self, lease=None):
+        """نقل المشتركين المعطلين والأكواد المستهلكة الأقدم من ARCHIVE_AFTER_DAYS لجداول الأرشيف على دفعات"""
+        now = epoch_now()
+        cutoff = now - ARCHIVE_AFTER_DAYS * 86400
+
+        archived_subscribers = 0
+        while not lease or lease.still_valid():
+            user_ids = await self.store.archive_subscribers(cutoff, ARCHIVE_BATCH_SIZE, now)
+            for user_id in user_ids:
+                self.subscriber_cache.invalidate(user_id)
+            if user_ids:
+                await self.bump_subscribers_version()
+            archived_subscribers += len(user_ids)
+            if len(user_ids) < ARCHIVE_BATCH_SIZE:
+                break
+            # كل دفعة معاملة قصيرة، فتتمكن المعالجات من الكتابة بينها
+            await asyncio.sleep(0)
+        ARCHIVED_ROWS.inc(archived_subscribers, table="subscribers")
+
+        archived_codes = 0
+        last_id = 0
+        while not lease or lease.still_valid():
+            moved, last_id = await self.store.archive_codes(cutoff, last_id, ARCHIVE_BATCH_SIZE, now)
+            archived_codes += moved
+            if moved < ARCHIVE_BATCH_SIZE:
+                break
+            await asyncio.sleep(0)
+        ARCHIVED_ROWS.inc(archived_codes, table="codes")
+
+        freed_pages = 0
+        if (archived_subscribers or archived_codes) and (not lease or lease.still_valid()):
+            freed_pages = await self.store.compact()
+
+        sweep_logger.info(
+            "🗄️ تمت أرشفة %s مشترك و %s كود، وتحرير %s صفحة", archived_subscribers, archived_codes, freed_pages
+        )
+        return archived_subscribers, archived_codes
+
+    def archive_cold_data_wrapper(self):
+        """غلاف للدالة غير المتزامنة للاستخدام مع المهام المجدولة"""
+        try:
+            if self.application:
+                self.run_leader_job('archive_cold_data', self.archive_cold_data_async)
+            else:
+                sweep_logger.warning("⚠️ تطبيق البوت غير معين للمهام المجدولة")
         except Exception as e:
-            logger.error(f"❌ خطأ في التحقق من الاشتراكات المنتهية: {e}")
+            sweep_logger.error("❌ خطأ في غلاف أرشفة البيانات: %s", e)
 
-    def check_expired_subscriptions_wrapper(self):
+    async def backup_database_async(self, lease=None):
+        """نسخة احتياطية في خيط منفصل حتى لا تتوقف حلقة البوت أثناء النسخ والضغط"""
+        path, size, seconds = await asyncio.to_thread(self.backups.create_backup)
+        sweep_logger.info("💾 تم إنشاء النسخة الاحتياطية %s (%.0f KB في %.1fs)", os.path.basename(path), size / 1024, seconds)
+        return path, size
+
+    def backup_database_wrapper(self):
         """غلاف للدالة غير المتزامنة للاستخدام مع المهام المجدولة"""
         try:
             if self.application:
-                # إنشاء حلقة أحداث جديدة وتشغيل المهمة
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                try:
-                    loop.run_until_complete(self.check_expired_subscriptions_async())
-                finally:
-                    loop.close()
+                self.run_leader_job('backup_database', self.backup_database_async)
             else:
-                logger.warning("⚠️ تطبيق البوت غير معين للمهام المجدولة")
+                sweep_logger.warning("⚠️ تطبيق البوت غير معين للمهام المجدولة")
         except Exception as e:
-            logger.error(f"❌ خطأ في غلاف التحقق من الاشتراكات المنتهية: {e}")
+            sweep_logger.error("❌ خطأ في غلاف النسخ الاحتياطي: %s", e)
 
-    async def check_expired_trials_async(self):
-        """التحقق من انتهاء الفترات التجريبية (إصدار async)"""
+    def drain_task_queue_wrapper(self):
+        """تفريغ دوري للطابور، يمكن تنفيذه على كل العقد بالتوازي لأن الحجز ذري"""
         try:
-            cursor = self.get_cursor()
-            current_time = datetime.now().isoformat()
-            
-            # الحصول على الفترات التجريبية المنتهية
-            cursor.execute('''
-                SELECT user_id, username, first_name, code_used, expires_at, invite_links
-                FROM subscribers 
-                WHERE expires_at < ? AND is_active = TRUE AND is_trial = TRUE
-            ''', (current_time,))
-            
-            expired_trials = cursor.fetchall()
-            
-            if not expired_trials:
-                logger.info("✅ لا توجد فترات تجريبية منتهية")
-                return
-            
-            logger.info(f"🔄 معالجة {len(expired_trials)} فترة تجريبية منتهية")
-            
-            for trial in expired_trials:
-                user_id, username, first_name, code_used, expires_at, invite_links_json = trial
-                
-                try:
-                    # تحديث حالة المشترك
-                    cursor.execute('''
-                        UPDATE subscribers 
-                        SET is_active = FALSE, trial_used = TRUE
-                        WHERE user_id = ?
-                    ''', (user_id,))
-                    
-                    # إخراج المستخدم من القنوات الإضافية فقط
-                    if self.application and self.application.bot:
-                        await self.remove_user_from_additional_channels_async(self.application.bot, user_id, invite_links_json)
-                    
-                    # إرسال رسالة للمستخدم
-                    if self.application and self.application.bot:
-                        try:
-                            await self.safe_send_message(
-                                self.application.bot,
-                                user_id,
-                                f"⏰ انتهت الفترة التجريبية الخاصة بك\n\n🎫 الكود: {code_used}\n📅 انتهى في: {expires_at.split()[0]}\n\nللاستمرار في الوصول للقنوات المميزة، يرجى شراء اشتراك."
-                            )
-                        except Exception as e:
-                            logger.error(f"❌ لا يمكن إرسال رسالة للمستخدم {user_id}: {e}")
-                    
-                    logger.info(f"✅ تم إنهاء الفترة التجريبية للمستخدم {user_id} ({username})")
-                    
-                except Exception as e:
-                    logger.error(f"❌ خطأ في معالجة المستخدم {user_id}: {e}")
-            
-            self.conn.commit()
-            cursor.close()
-            
+            if self.application:
+                self.run_coroutine(self.process_task_queue())
+                self.task_queue.purge_done()
         except Exception as e:
-            logger.error(f"❌ خطأ في التحقق من الفترات التجريبية المنتهية: {e}")
+            sweep_logger.error("❌ خطأ في تفريغ طابور المهام: %s", e)
 
-    def check_expired_trials_wrapper(self):
+    async def task_expire_subscription(self, payload):
+        """مهمة: تعطيل اشتراك منتهي ثم جدولة إخراج المستخدم وإبلاغه كمهام منفصلة"""
+        user_id = payload['user_id']
+        expires_at = payload['expires_at']
+        
+        row = await self.store.expire_subscriber(user_id, expires_at)
+        self.subscriber_cache.invalidate(user_id)
+        
+        # تم تجديد الاشتراك أو تعطيله مسبقاً (أو تعالجه نسخة أخرى الآن)
+        if not row:
+            return
+        
+        code_used, invite_links_json, is_trial = row
+        
+        self.task_queue.enqueue_many(self.revoke_tasks(user_id, expires_at, invite_links_json) + [
+            ('notify_expired', {'user_id': user_id, 'code_used': code_used, 'expires_at': expires_at, 'is_trial': bool(is_trial)}, f"notify_expired:{user_id}:{expires_at}"),
+        ])
+        sweep_logger.debug("✅ تم تعطيل اشتراك المستخدم %s", user_id)
+
+    async def task_revoke_access(self, payload):
+        """مهمة من إصدار سابق لكل المستخدم: تقسم لمهمة revoke_channel لكل قناة"""
+        user_id = payload['user_id']
+        self.task_queue.enqueue_many(self.revoke_tasks(user_id, payload.get('expires_at', 'legacy'), payload['invite_links']))
+
+    async def task_revoke_channel(self, payload):
+        """مهمة: إخراج المستخدم من قناة إضافية واحدة، والخطأ يصل للطابور فيعيد المحاولة بتأخير متزايد"""
+        if not (self.application and self.application.bot):
+            raise RuntimeError("تطبيق البوت غير معين")
+        await self.application.bot.ban_chat_member(chat_id=payload['channel_id'], user_id=payload['user_id'])
+        sweep_logger.debug("✅ تم إخراج المستخدم %s من القناة الإضافية %s", payload['user_id'], payload['channel_id'])
+        # الانتظار قليلاً لتجنب حظر API
+        await rate_limited_sleep(0.5, "pacing")
+
+    async def task_notify_expired(self, payload):
+        """مهمة: إبلاغ المستخدم بانتهاء اشتراكه"""
+        if not (self.application and self.application.bot):
+            return
+        
+        expires_at = payload['expires_at']
+        if payload['is_trial']:
+            message_text = f"⏰ انتهت الفترة التجريبية الخاصة بك\n\n🎫 الكود: {payload['code_used']}\n📅 انتهى في: {format_date(expires_at)}\n\nللاستمرار في الوصول للقنوات المميزة، يرجى شراء اشتراك."
+        else:
+            message_text = f"❌ انتهت صلاحية اشتراكك\n\n🎫 الكود: {payload['code_used']}\n📅 انتهى في: {format_date(expires_at)}\n\nللاستمرار في الوصول للقنوات المميزة، يرجى تجديد الاشتراك."
+        
+        await self.safe_send_message(self.application.bot, payload['user_id'], message_text)
+
+    def check_expired_subscriptions_wrapper(self):
         """غلاف للدالة غير المتزامنة للاستخدام مع المهام المجدولة"""
         try:
             if self.application:
-                # إنشاء حلقة أحداث جديدة وتشغيل المهمة
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                try:
-                    loop.run_until_complete(self.check_expired_trials_async())
-                finally:
-                    loop.close()
+                self.run_leader_job('check_expired_subscriptions', self.check_expired_subscriptions_async)
             else:
-                logger.warning("⚠️ تطبيق البوت غير معين للمهام المجدولة")
+                sweep_logger.warning("⚠️ تطبيق البوت غير معين للمهام المجدولة")
         except Exception as e:
-            logger.error(f"❌ خطأ في غلاف التحقق من الفترات التجريبية: {e}")
+            sweep_logger.error("❌ خطأ في غلاف التحقق من الاشتراكات المنتهية: %s", e)
+
+    async def check_expired_trials_async(self, lease=None):
+        """التحقق من انتهاء الفترات التجريبية (إصدار async) عبر الطابور الدائم"""
+        queued = await self.enqueue_expired_subscribers(trial_only=True)
+        if queued:
+            sweep_logger.info("🔄 تمت إضافة %s فترة تجريبية منتهية للطابور", queued)
+        else:
+            sweep_logger.info("✅ لا توجد فترات تجريبية منتهية جديدة")
 
-    async def send_expiry_notifications_async(self):
-        """إرسال تنبيهات قبل انتهاء الاشتراك بيوم (إصدار async)"""
+        await self.process_task_queue(lease)
+
+    def check_expired_trials_wrapper(self):
+        """غلاف للدالة غير المتزامنة للاستخدام مع المهام المجدولة"""
         try:
-            cursor = self.get_cursor()
-            tomorrow = (datetime.now() + timedelta(days=1)).isoformat()
-            today = datetime.now().isoformat()
-            
-            # الحصول على المشتركين الذين ستنتهي اشتراكاتهم خلال 24 ساعة
-            cursor.execute('''
-                SELECT user_id, username, first_name, code_used, expires_at, last_notification, is_trial
-                FROM subscribers 
-                WHERE expires_at BETWEEN ? AND ? 
-                AND is_active = TRUE
-                AND (last_notification IS NULL OR last_notification < ?)
-            ''', (today, tomorrow, today))
-            
-            expiring_subscribers = cursor.fetchall()
-            
-            if not expiring_subscribers:
-                logger.info("✅ لا توجد اشتراكات قريبة من الانتهاء")
-                return
-            
-            logger.info(f"🔄 إرسال تنبيهات لـ {len(expiring_subscribers)} مشترك")
-            
-            for subscriber in expiring_subscribers:
-                user_id, username, first_name, code_used, expires_at, last_notification, is_trial = subscriber
-                
-                try:
-                    if self.application and self.application.bot:
-                        trial_text = "تجريبية" if is_trial else ""
-                        # إرسال رسالة تنبيه
-                        await self.safe_send_message(
-                            self.application.bot,
-                            user_id,
-                            f"⚠️ تنبيه: اشتراكك {trial_text} سينتهي قريباً!\n\n🎫 الكود: {code_used}\n📅 ينتهي في: {expires_at.split()[0]}\n⏰ المتبقي: أقل من 24 ساعة\n\nللتجديد، يرجى التواصل مع الإدارة."
-                        )
-                    
-                    # تحديث وقت آخر إشعار
-                    cursor.execute('''
-                        UPDATE subscribers 
-                        SET last_notification = ? 
-                        WHERE user_id = ?
-                    ''', (datetime.now().isoformat(), user_id))
-                    
-                    logger.info(f"✅ تم إرسال تنبيه للمستخدم {user_id}")
-                    
-                except Exception as e:
-                    logger.error(f"❌ خطأ في إرسال تنبيه للمستخدم {user_id}: {e}")
-            
-            self.conn.commit()
-            cursor.close()
-            
+            if self.application:
+                self.run_leader_job('check_expired_trials', self.check_expired_trials_async)
+            else:
+                sweep_logger.warning("⚠️ تطبيق البوت غير معين للمهام المجدولة")
         except Exception as e:
-            logger.error(f"❌ خطأ في إرسال التنبيهات: {e}")
+            sweep_logger.error("❌ خطأ في غلاف التحقق من الفترات التجريبية: %s", e)
+
+    async def send_expiry_notifications_async(self, lease=None):
+        """إرسال تنبيهات قبل انتهاء الاشتراك حسب أوقات التنبيه المحددة (إصدار async)"""
+        if not NOTIFICATION_LEAD_TIMES:
+            return
+
+        now = epoch_now()
+        horizon = now + int(NOTIFICATION_LEAD_TIMES[0][1].total_seconds())
+
+        # استعلام نطاق واحد على الفهرس يغطي كل أوقات التنبيه
+        expiring_subscribers = await self.store.expiring_subscribers(now, horizon)
+
+        if not expiring_subscribers:
+            sweep_logger.info("✅ لا توجد اشتراكات قريبة من الانتهاء")
+            return
+
+        # تحديد التنبيهات المستحقة لكل مشترك
+        pending = []
+        for user_id, code_used, expires_at, is_trial in expiring_subscribers:
+            remaining = timedelta(seconds=expires_at - now)
+            due_kinds = [label for label, lead in NOTIFICATION_LEAD_TIMES if remaining <= lead]
+            if due_kinds:
+                keys = [f"{user_id}:{expires_at}:{label}" for label in due_kinds]
+                pending.append((user_id, code_used, expires_at, is_trial, due_kinds, keys))
+
+        already_sent = await self.store.sent_notification_keys([key for item in pending for key in item[5]])
+
+        sent_count = 0
+        for start in range(0, len(pending), NOTIFICATION_BATCH_SIZE):
+            # التوقف إذا انتقلت القيادة لعقدة أخرى أثناء التنفيذ
+            if lease and not lease.still_valid():
+                sweep_logger.warning("⚠️ تم فقدان عقد القيادة، إيقاف المهمة")
+                break
+
+            batch = []
+            for user_id, code_used, expires_at, is_trial, due_kinds, keys in pending[start:start + NOTIFICATION_BATCH_SIZE]:
+                new_keys = [key for key in keys if key not in already_sent]
+                # إرسال رسالة واحدة بأقرب موعد مستحق حتى لو فات أكثر من موعد (مثلاً بعد توقف البوت)
+                if new_keys:
+                    batch.append((user_id, code_used, expires_at, is_trial, due_kinds[-1], new_keys))
+
+            if batch:
+                sent_count += await self.send_notification_batch(batch)
+
+        sweep_logger.info("✅ تم إرسال %s تنبيه", sent_count)
+
+    async def send_notification_batch(self, batch):
+        """حجز مفاتيح الدفعة قبل الإرسال (لا تكرار حتى عند التوقف المفاجئ) ثم الإرسال وتسجيل النتيجة"""
+        reserved = await self.store.reserve_notifications([
+            (key, user_id, expires_at, key.rsplit(":", 1)[1])
+            for user_id, _, expires_at, _, _, keys in batch for key in keys
+        ])
+        
+        sent_users = []
+        sent_keys = []
+        failed_keys = []
+        for user_id, code_used, expires_at, is_trial, kind, keys in batch:
+            # المفاتيح التي حجزها تشغيل آخر يرسلها ويسجل نتيجتها ذلك التشغيل فقط
+            keys = [key for key in keys if key in reserved]
+            if not keys:
+                continue
+            try:
+                if self.application and self.application.bot:
+                    trial_text = "تجريبية" if is_trial else ""
+                    await self.safe_send_message(
+                        self.application.bot,
+                        user_id,
+                        f"⚠️ تنبيه: اشتراكك {trial_text} سينتهي قريباً!\n\n🎫 الكود: {code_used}\n📅 ينتهي في: {format_date(expires_at)}\n⏰ المتبقي: أقل من {self.format_lead_time(kind)}\n\nللتجديد، يرجى التواصل مع الإدارة."
+                    )
+                    # الحفاظ على معدل إرسال ثابت بعيداً عن حدود API
+                    await rate_limited_sleep(0.05, "pacing")
+                sent_users.append(user_id)
+                sent_keys.extend(keys)
+            except Exception as e:
+                sweep_logger.error("❌ خطأ في إرسال تنبيه للمستخدم %s: %s", user_id, e)
+                failed_keys.extend(keys)
+        
+        # تسجيل نتيجة الدفعة كاملة في معاملة واحدة، والمفاتيح الفاشلة تحذف لتعاد المحاولة لاحقاً
+        await self.store.finish_notifications(failed_keys, sent_keys, sent_users, time.time())
+        return len(sent_users)
+
+    @staticmethod
+    def format_lead_time(label):
+        """تحويل وسم وقت التنبيه إلى نص (1d -> 1 يوم)"""
+        units = {'d': 'يوم', 'h': 'ساعة', 'm': 'دقيقة'}
+        return f"{label[:-1]} {units[label[-1]]}"
 
     def send_expiry_notifications_wrapper(self):
         """غلاف للدالة غير المتزامنة للاستخدام مع المهام المجدولة"""
         try:
             if self.application:
-                # إنشاء حلقة أحداث جديدة وتشغيل المهمة
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                try:
-                    loop.run_until_complete(self.send_expiry_notifications_async())
-                finally:
-                    loop.close()
+                self.run_leader_job('send_expiry_notifications', self.send_expiry_notifications_async)
             else:
-                logger.warning("⚠️ تطبيق البوت غير معين للمهام المجدولة")
+                sweep_logger.warning("⚠️ تطبيق البوت غير معين للمهام المجدولة")
         except Exception as e:
-            logger.error(f"❌ خطأ في غلاف إرسال التنبيهات: {e}")
+            sweep_logger.error("❌ خطأ في غلاف إرسال التنبيهات: %s", e)
 
     def get_cursor(self):
         """الحصول على مؤشر جديد"""
         return self.conn.cursor()
 
-    def is_admin(self, user_id):
+    async def is_admin(self, user_id):
         """التحقق إذا كان المستخدم مشرفاً"""
         try:
-            cursor = self.get_cursor()
-            cursor.execute('SELECT id FROM admins WHERE user_id = ? AND is_active = TRUE', (user_id,))
-            result = cursor.fetchone() is not None
-            cursor.close()
-            return result
+            return await self.store.is_admin(user_id)
         except Exception as e:
             logger.error(f"❌ خطأ في التحقق من المشرف: {e}")
             return False
 
-    def add_admin(self, user_id, username, first_name, last_name, added_by):
+    async def add_admin(self, user_id, username, first_name, last_name, added_by):
         """إضافة مشرف جديد"""
         try:
-            cursor = self.get_cursor()
-            cursor.execute('''
-                INSERT OR REPLACE INTO admins (user_id, username, first_name, last_name, added_by, is_active)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (user_id, username, first_name, last_name, added_by, True))
-            self.conn.commit()
-            cursor.close()
+            await self.store.add_admin(user_id, username, first_name, last_name, added_by)
             return True, "✅ تم إضافة المشرف بنجاح"
         except Exception as e:
             return False, f"❌ خطأ في إضافة المشرف: {e}"
 
-    def remove_admin(self, user_id):
+    async def remove_admin(self, user_id):
         """إزالة مشرف"""
         try:
             if user_id == ADMIN_IDS[0]:
                 return False, "❌ لا يمكن حذف المشرف الرئيسي"
             
-            cursor = self.get_cursor()
-            cursor.execute('DELETE FROM admins WHERE user_id = ?', (user_id,))
-            self.conn.commit()
-            cursor.close()
+            await self.store.remove_admin(user_id)
             return True, "✅ تم حذف المشرف بنجاح"
         except Exception as e:
             return False, f"❌ خطأ في حذف المشرف: {e}"
 
-    def get_all_admins(self):
+    async def get_all_admins(self):
         """الحصول على جميع المشرفين"""
         try:
-            cursor = self.get_cursor()
-            cursor.execute('''
-                SELECT user_id, username, first_name, last_name, added_at 
-                FROM admins WHERE is_active = TRUE ORDER BY added_at DESC
-            ''')
-            result = cursor.fetchall()
-            cursor.close()
-            return result
+            return await self.store.list_admins()
         except Exception as e:
             logger.error(f"❌ خطأ في الحصول على المشرفين: {e}")
             return []
@@ -668,37 +4313,47 @@ class SubscriptionManagementSystem:
         alphabet = string.ascii_uppercase + string.digits
         return ''.join(secrets.choice(alphabet) for _ in range(length))
 
-    def create_subscription_code(self, duration_days, price=0.0, created_by="system", batch_id=None, channels=None, excluded_channels=None, apply_to_all_channels=True, max_uses=1, is_trial=False):
+    def code_row(self, code, duration_days, price, created_by, batch_id, channels, excluded_channels, apply_to_all_channels, max_uses, is_trial=False):
+        """صف جدول codes لكود جديد"""
+        expires_at = epoch_now() + 30 * 86400
+        return (code, duration_days, price, created_by, expires_at, batch_id,
+                json.dumps(channels or []), json.dumps(excluded_channels or []), apply_to_all_channels, max_uses, is_trial)
+
+    async def create_subscription_code(self, duration_days, price=0.0, created_by="system", batch_id=None, channels=None, excluded_channels=None, apply_to_all_channels=True, max_uses=1, is_trial=False, prefix=CODE_PREFIX):
         """إنشاء كود اشتراك جديد"""
-        code = self.generate_code()
-        expires_at = (datetime.now() + timedelta(days=30)).isoformat()
-        
-        channels_json = json.dumps(channels or [])
-        excluded_json = json.dumps(excluded_channels or [])
+        code = generate_checked_codes(1, prefix)[0]
         
         try:
-            cursor = self.get_cursor()
-            cursor.execute('''
-                INSERT INTO codes (code, duration_days, price, created_by, expires_at, batch_id, channels, excluded_channels, apply_to_all_channels, max_uses, is_active, is_trial)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (code, duration_days, price, created_by, expires_at, batch_id, channels_json, excluded_json, apply_to_all_channels, max_uses, True, is_trial))
-            self.conn.commit()
-            cursor.close()
+            await self.store.insert_codes([
+                self.code_row(code, duration_days, price, created_by, batch_id, channels, excluded_channels, apply_to_all_channels, max_uses, is_trial)
+            ])
             
-            logger.info(f"✅ تم إنشاء كود جديد: {code} لمدة {duration_days} يوم")
+            logger.debug("✅ تم إنشاء كود جديد: %s لمدة %s يوم", code, duration_days)
             return True, code
         except Exception as e:
             logger.error(f"❌ خطأ في إنشاء الكود: {e}")
             return False, f"❌ خطأ في إنشاء الكود: {e}"
 
-    def create_multiple_codes(self, count, duration_days, price=0.0, created_by="system", batch_id=None, channels=None, excluded_channels=None, apply_to_all_channels=True, max_uses=1):
-        """إنشاء عدة أكواد دفعة واحدة"""
+    async def create_multiple_codes(self, count, duration_days, price=0.0, created_by="system", batch_id=None, channels=None, excluded_channels=None, apply_to_all_channels=True, max_uses=1, prefix=CODE_PREFIX):
+        """إنشاء عدة أكواد دفعة واحدة: توليد الأكواد بالجملة ثم إدخالها في معاملة واحدة"""
         batch_id = batch_id or f"BATCH_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        generated = generate_checked_codes(count, prefix)
+        rows = [
+            self.code_row(code, duration_days, price, created_by, batch_id, channels, excluded_channels, apply_to_all_channels, max_uses)
+            for code in generated
+        ]
+        
+        try:
+            await self.store.insert_codes(rows)
+            return batch_id, generated, []
+        except Exception as e:
+            # تكرار كود موجود نادر جداً، لكنه يفشل الدفعة كاملة، لذا نعيد الإدخال كوداً كوداً
+            logger.warning(f"⚠️ فشل الإدخال الجماعي للدفعة {batch_id}، سيتم الإدخال فردياً: {e}")
+        
         codes = []
         failed_codes = []
-        
         for i in range(count):
-            success, code = self.create_subscription_code(duration_days, price, created_by, batch_id, channels, excluded_channels, apply_to_all_channels, max_uses)
+            success, code = await self.create_subscription_code(duration_days, price, created_by, batch_id, channels, excluded_channels, apply_to_all_channels, max_uses, prefix=prefix)
             if success:
                 codes.append(code)
             else:
@@ -706,18 +4361,26 @@ class SubscriptionManagementSystem:
         
         return batch_id, codes, failed_codes
 
-    def create_batch_codes(self, count, duration_days, price=0.0, created_by="system", batch_id=None, channels=None, excluded_channels=None, apply_to_all_channels=True, max_uses=1):
+    async def create_batch_codes(self, count, duration_days, price=0.0, created_by="system", batch_id=None, channels=None, excluded_channels=None, apply_to_all_channels=True, max_uses=1, prefix=CODE_PREFIX):
         """إنشاء دفعة أكواد"""
-        batch_id = batch_id or f"BATCH_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-        codes = []
-        
-        for i in range(count):
-            success, code = self.create_subscription_code(duration_days, price, created_by, batch_id, channels, excluded_channels, apply_to_all_channels, max_uses)
-            if success:
-                codes.append(code)
-        
+        batch_id, codes, _ = await self.create_multiple_codes(count, duration_days, price, created_by, batch_id, channels, excluded_channels, apply_to_all_channels, max_uses, prefix)
         return batch_id, codes
 
+    async def get_or_create_channel_set(self, channel_ids, created_by):
+        """رقم مجموعة القنوات للأكواد الموقعة (0 يعني كل القنوات الإضافية)"""
+        if not channel_ids:
+            return 0
+        set_id = await self.store.get_or_create_channel_set(json.dumps(sorted(set(channel_ids))), created_by)
+        if set_id > 0xFFFF:
+            raise ValueError("تم تجاوز الحد الأقصى لعدد مجموعات القنوات")
+        return set_id
+
+    async def get_channel_set(self, set_id):
+        """قائمة قنوات المجموعة بصيغة JSON، أو None إذا لم تكن موجودة"""
+        if set_id == 0:
+            return "[]"
+        return await self.store.get_channel_set(set_id)
+
     def validate_channel_id(self, channel_id):
         """التحقق من صحة معرف القناة"""
         try:
@@ -735,38 +4398,23 @@ class SubscriptionManagementSystem:
             logger.error(f"❌ خطأ في التحقق من معرف القناة: {e}")
             return None
 
-    def add_additional_channel(self, channel_id, channel_username, channel_name, added_by, channel_type="premium", require_subscription=True, is_main_channel=False):
+    async def add_additional_channel(self, channel_id, channel_username, channel_name, added_by, channel_type="premium", require_subscription=True, is_main_channel=False):
         """إضافة قناة إضافية"""
         try:
             validated_channel_id = self.validate_channel_id(channel_id)
             if not validated_channel_id:
                 return False, "❌ معرف القناة غير صحيح"
             
-            cursor = self.get_cursor()
-            cursor.execute('''
-                INSERT OR REPLACE INTO additional_channels 
-                (channel_id, channel_username, channel_name, added_by, is_active, channel_type, require_subscription, is_main_channel)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (validated_channel_id, channel_username, channel_name, added_by, True, channel_type, require_subscription, is_main_channel))
-            self.conn.commit()
-            cursor.close()
+            await self.store.add_channel(validated_channel_id, channel_username, channel_name, added_by,
+                                         channel_type, require_subscription, is_main_channel)
             return True, f"✅ تم إضافة القناة بنجاح! المعرف: {validated_channel_id}"
         except Exception as e:
             return False, f"❌ خطأ في إضافة القناة: {e}"
 
-    def get_active_channels(self):
+    async def get_active_channels(self):
         """الحصول على القنوات النشطة"""
         try:
-            cursor = self.get_cursor()
-            cursor.execute('''
-                SELECT id, channel_id, channel_username, channel_name, added_at, is_active, is_main_channel
-                FROM additional_channels 
-                WHERE is_active = TRUE
-                ORDER BY is_main_channel DESC, added_at DESC
-            ''')
-            result = cursor.fetchall()
-            cursor.close()
-            return result
+            return await self.store.active_channels()
         except Exception as e:
             logger.error(f"❌ خطأ في الحصول على القنوات: {e}")
             return []
@@ -774,33 +4422,28 @@ class SubscriptionManagementSystem:
     async def activate_trial_subscription(self, user_id, username, first_name, last_name, context=None):
         """تفعيل فترة تجريبية تلقائية لمدة 48 ساعة"""
         try:
-            cursor = self.get_cursor()
+            record = await self.get_subscriber_record(user_id)
+            trial_used = bool(record and record[6])
+            has_active = bool(record and record[3])
+            # المستخدم الذي أرشف سجله بعد انتهاء فترته التجريبية لا يحصل على فترة جديدة
+            if not record:
+                trial_used = await self.store.has_archived_trial(user_id)
             
             # التحقق إذا كان المستخدم قد استخدم الفترة التجريبية مسبقاً
-            cursor.execute('''
-                SELECT id FROM subscribers 
-                WHERE user_id = ? AND trial_used = TRUE
-            ''', (user_id,))
-            
-            if cursor.fetchone():
+            if trial_used:
                 return False, "❌ لقد استخدمت الفترة التجريبية مسبقاً ولا يمكنك استخدامها مرة أخرى.", []
 
             # التحقق إذا كان المستخدم لديه اشتراك فعال حالياً
-            cursor.execute('''
-                SELECT id FROM subscribers 
-                WHERE user_id = ? AND is_active = TRUE
-            ''', (user_id,))
-            
-            if cursor.fetchone():
+            if has_active:
                 return False, "❌ لديك اشتراك فعال حالياً، لا يمكنك استخدام الفترة التجريبية.", []
 
             # إنشاء كود تجريبي
             trial_code = f"TRIAL_{self.generate_code(8)}"
             trial_duration = 2  # يومين (48 ساعة)
-            subscription_expires = datetime.now() + timedelta(days=trial_duration)
+            subscription_expires = epoch_now() + trial_duration * 86400
             
             # الحصول على القنوات الإضافية (غير الرئيسية)
-            additional_channels = self.get_additional_channels_only()
+            additional_channels = await self.get_additional_channels_only()
             
             # إنشاء روابط الدعوة للقنوات الإضافية
             invite_links = []
@@ -823,7 +4466,7 @@ class SubscriptionManagementSystem:
                                 'invite_link': invite_link.invite_link
                             })
                             
-                            logger.info(f"✅ تم إنشاء رابط دعوة تجريبي للقناة: {channel['name']}")
+                            logger.debug("✅ تم إنشاء رابط دعوة تجريبي للقناة: %s", channel['name'])
                             
                         except Exception as e:
                             logger.error(f"❌ خطأ في إنشاء رابط دعوة تجريبي للقناة {channel['id']}: {e}")
@@ -838,26 +4481,18 @@ class SubscriptionManagementSystem:
                 except Exception as e:
                     logger.error(f"❌ خطأ في إنشاء روابط الدعوة التجريبية: {e}")
 
-            # حفظ الاشتراك التجريبي
-            cursor.execute('''
-                INSERT INTO subscribers 
-                (user_id, username, first_name, last_name, code_used, expires_at, is_active, 
-                 channels, excluded_channels, apply_to_all_channels, invite_links, is_trial, trial_used)
-                VALUES (?, ?, ?, ?, ?, ?, TRUE, ?, ?, ?, ?, TRUE, FALSE)
-            ''', (user_id, username, first_name, last_name, trial_code, 
-                  subscription_expires.isoformat(), json.dumps([]), json.dumps([]), 
-                  True, json.dumps(invite_links)))
-
-            # حفظ الكود التجريبي
-            cursor.execute('''
-                INSERT INTO codes (code, duration_days, price, created_by, is_trial, is_active)
-                VALUES (?, ?, ?, ?, TRUE, FALSE)
-            ''', (trial_code, trial_duration, 0.0, "system"))
-
-            self.conn.commit()
-            cursor.close()
+            # حفظ الاشتراك التجريبي والكود التجريبي في معاملة واحدة
+            await self.store.create_trial({
+                'user_id': user_id,
+                'username': username,
+                'first_name': first_name,
+                'last_name': last_name,
+                'expires_at': subscription_expires,
+                'invite_links': json.dumps(invite_links)
+            }, trial_code, trial_duration)
+            self.subscriber_cache.invalidate(user_id)
 
-            message = f"✅ تم تفعيل الفترة التجريبية بنجاح!\n\n🎫 الكود: {trial_code}\n⏰ المدة: 48 ساعة\n📅 ينتهي في: {subscription_expires.strftime('%Y-%m-%d %H:%M')}\n\n⚠️ هذه الفترة تجريبية ولا يمكن استخدامها مرة أخرى"
+            message = f"✅ تم تفعيل الفترة التجريبية بنجاح!\n\n🎫 الكود: {trial_code}\n⏰ المدة: 48 ساعة\n📅 ينتهي في: {format_timestamp(subscription_expires)}\n\n⚠️ هذه الفترة تجريبية ولا يمكن استخدامها مرة أخرى"
 
             return True, message, invite_links
 
@@ -865,18 +4500,10 @@ class SubscriptionManagementSystem:
             logger.error(f"❌ خطأ في تفعيل الفترة التجريبية: {e}")
             return False, f"❌ حدث خطأ أثناء تفعيل الفترة التجريبية: {str(e)}", []
 
-    def get_additional_channels_only(self):
+    async def get_additional_channels_only(self):
         """الحصول على القنوات الإضافية فقط (غير الرئيسية)"""
         try:
-            cursor = self.get_cursor()
-            cursor.execute('''
-                SELECT channel_id, channel_username, channel_name 
-                FROM additional_channels 
-                WHERE is_active = TRUE AND is_main_channel = FALSE
-            ''')
-            
-            result = cursor.fetchall()
-            cursor.close()
+            result = await self.store.additional_channels()
             
             channels = []
             for row in result:
@@ -890,18 +4517,10 @@ class SubscriptionManagementSystem:
             logger.error(f"❌ خطأ في الحصول على القنوات الإضافية: {e}")
             return []
 
-    def get_main_channel_info(self):
+    async def get_main_channel_info(self):
         """الحصول على معلومات القناة الرئيسية"""
         try:
-            cursor = self.get_cursor()
-            cursor.execute('''
-                SELECT channel_id, channel_username, channel_name 
-                FROM additional_channels 
-                WHERE is_main_channel = TRUE AND is_active = TRUE
-            ''')
-            
-            result = cursor.fetchone()
-            cursor.close()
+            result = await self.store.main_channel()
             
             if result:
                 return {
@@ -917,45 +4536,43 @@ class SubscriptionManagementSystem:
     async def use_code(self, code, user_id, username, first_name, last_name, context=None):
         """استخدام كود اشتراك - محدث لاستبعاد القناة الرئيسية من الإخراج"""
         try:
-            cursor = self.get_cursor()
-            cursor.execute('''
-                SELECT id, duration_days, is_used, expires_at, channels, excluded_channels, apply_to_all_channels, max_uses, current_uses, is_trial
-                FROM codes 
-                WHERE code = ? AND is_used = FALSE AND is_active = TRUE
-            ''', (code,))
-            
-            result = cursor.fetchone()
-            
-            if not result:
-                cursor.close()
+            # الكود الذي يخالف الصيغة أو حرف التحقق أو التوقيع مرفوض قبل أي استعلام
+            if not self.is_valid_code_format(code):
                 return False, "❌ الكود غير صالح أو منتهي الصلاحية", []
+            
+            signed = verify_signed_code(code)
+            if signed:
+                # كود موقع: الصلاحيات من الكود نفسه، والقاعدة تسجل الاستخدام فقط
+                if await self.store.is_nonce_redeemed(signed['nonce']):
+                    return False, "❌ تم استخدام هذا الكود مسبقاً", []
+                channels_json = await self.get_channel_set(signed['channel_set'])
+                if channels_json is None:
+                    return False, "❌ الكود غير صالح أو منتهي الصلاحية", []
+                duration_days = signed['duration_days']
+                excluded_json = None
+                apply_to_all = signed['channel_set'] == 0
+                is_trial = False
+            else:
+                result = await self.store.get_redeemable_code(code)
+                
+                if not result:
+                    return False, "❌ الكود غير صالح أو منتهي الصلاحية", []
 
-            code_id, duration_days, is_used, expires_at, channels_json, excluded_json, apply_to_all, max_uses, current_uses, is_trial = result
+                code_id, duration_days, is_used, expires_at, channels_json, excluded_json, apply_to_all, max_uses, current_uses, is_trial = result
 
-            if expires_at:
-                expires_date = datetime.fromisoformat(expires_at)
-                if expires_date < datetime.now():
-                    cursor.close()
-                    return False, "❌ الكود منتهي الصلاحية", []
+                if expires_at:
+                    if expires_at < time.time():
+                        return False, "❌ الكود منتهي الصلاحية", []
 
-            if current_uses >= max_uses:
-                cursor.execute('UPDATE codes SET is_used = TRUE WHERE id = ?', (code_id,))
-                self.conn.commit()
-                cursor.close()
-                return False, "❌ تم استخدام هذا الكود للعدد الأقصى المسموح", []
+                if current_uses >= max_uses:
+                    await self.store.exhaust_code(code_id)
+                    return False, "❌ تم استخدام هذا الكود للعدد الأقصى المسموح", []
 
-            subscription_expires = datetime.now() + timedelta(days=duration_days)
+            subscription_expires = epoch_now() + duration_days * 86400
             
             channels = json.loads(channels_json) if channels_json else []
             excluded_channels = json.loads(excluded_json) if excluded_json else []
 
-            cursor.execute('''
-                UPDATE codes 
-                SET current_uses = current_uses + 1,
-                    is_used = CASE WHEN current_uses + 1 >= max_uses THEN TRUE ELSE FALSE END
-                WHERE id = ?
-            ''', (code_id,))
-
             # إنشاء روابط الدعوة للقنوات الإضافية فقط
             invite_links = []
             if context and context.bot:
@@ -963,7 +4580,7 @@ class SubscriptionManagementSystem:
                     # الحصول على القنوات الإضافية التي يجب إضافة المستخدم إليها
                     target_channels = []
                     if apply_to_all:
-                        all_channels = self.get_additional_channels_only()  # القنوات الإضافية فقط
+                        all_channels = await self.get_additional_channels_only()  # القنوات الإضافية فقط
                         for channel in all_channels:
                             channel_info = {
                                 'id': channel['id'],
@@ -974,7 +4591,7 @@ class SubscriptionManagementSystem:
                                 target_channels.append(channel_info)
                     else:
                         for channel_id in channels:
-                            channel_info = self.get_channel_by_id(channel_id)
+                            channel_info = await self.get_channel_by_id(channel_id)
                             if channel_info and channel_id != CHANNEL_ID:  # استبعاد القناة الرئيسية
                                 target_channels.append(channel_info)
                     
@@ -996,7 +4613,7 @@ class SubscriptionManagementSystem:
                                 'invite_link': invite_link.invite_link
                             })
                             
-                            logger.info(f"✅ تم إنشاء رابط دعوة للقناة الإضافية: {channel['name']}")
+                            logger.debug("✅ تم إنشاء رابط دعوة للقناة الإضافية: %s", channel['name'])
                             
                         except Exception as e:
                             logger.error(f"❌ خطأ في إنشاء رابط دعوة للقناة {channel['id']}: {e}")
@@ -1011,19 +4628,31 @@ class SubscriptionManagementSystem:
                 except Exception as e:
                     logger.error(f"❌ خطأ في إنشاء روابط الدعوة: {e}")
 
-            cursor.execute('''
-                INSERT OR REPLACE INTO subscribers 
-                (user_id, username, first_name, last_name, code_used, expires_at, is_active, channels, excluded_channels, apply_to_all_channels, invite_links, last_notification, is_trial, trial_used)
-                VALUES (?, ?, ?, ?, ?, ?, TRUE, ?, ?, ?, ?, ?, ?, ?)
-            ''', (user_id, username, first_name, last_name, code, 
-                  subscription_expires.isoformat(), json.dumps(channels), json.dumps(excluded_channels), 
-                  apply_to_all, json.dumps(invite_links), None, is_trial, is_trial))
-
-            self.conn.commit()
-            cursor.close()
+            subscriber = {
+                'user_id': user_id,
+                'username': username,
+                'first_name': first_name,
+                'last_name': last_name,
+                'code_used': code,
+                'expires_at': subscription_expires,
+                'channels': json.dumps(channels),
+                'excluded_channels': json.dumps(excluded_channels),
+                'apply_to_all_channels': apply_to_all,
+                'invite_links': json.dumps(invite_links),
+                'is_trial': is_trial
+            }
+            if signed:
+                # تسجيل الرقم العشوائي وحفظ المشترك في معاملة واحدة، ويفشل إذا سبقنا طلب آخر بنفس الكود
+                if not await self.store.redeem_signed_code(signed['nonce'], signed['plan'], subscriber):
+                    return False, "❌ تم استخدام هذا الكود مسبقاً", []
+            else:
+                # زيادة استخدامات الكود وحفظ المشترك في معاملة واحدة، ويفشل إذا استنفد طلب آخر الكود أثناء إنشاء الروابط
+                if not await self.store.redeem_code(code_id, subscriber):
+                    return False, "❌ تم استخدام هذا الكود للعدد الأقصى المسموح", []
+            self.subscriber_cache.invalidate(user_id)
 
             trial_text = "تجريبية" if is_trial else "عادية"
-            message = f"✅ تم تفعيل الاشتراك {trial_text} بنجاح!\n\n🎫 الكود: {code}\n⏰ المدة: {duration_days} يوم\n📅 ينتهي في: {subscription_expires.strftime('%Y-%m-%d %H:%M')}"
+            message = f"✅ تم تفعيل الاشتراك {trial_text} بنجاح!\n\n🎫 الكود: {code}\n⏰ المدة: {duration_days} يوم\n📅 ينتهي في: {format_timestamp(subscription_expires)}"
 
             return True, message, invite_links
 
@@ -1031,18 +4660,10 @@ class SubscriptionManagementSystem:
             logger.error(f"❌ خطأ في استخدام الكود: {e}")
             return False, f"❌ حدث خطأ أثناء تفعيل الكود: {str(e)}", []
 
-    def get_channel_by_id(self, channel_id):
+    async def get_channel_by_id(self, channel_id):
         """الحصول على معلومات القناة بواسطة المعرف"""
         try:
-            cursor = self.get_cursor()
-            cursor.execute('''
-                SELECT channel_id, channel_username, channel_name 
-                FROM additional_channels 
-                WHERE channel_id = ? AND is_active = TRUE
-            ''', (channel_id,))
-            
-            result = cursor.fetchone()
-            cursor.close()
+            result = await self.store.channel_by_id(channel_id)
             
             if result:
                 return {
@@ -1055,230 +4676,588 @@ class SubscriptionManagementSystem:
             logger.error(f"❌ خطأ في الحصول على معلومات القناة: {e}")
             return None
 
-    def get_subscription_info(self, user_id):
+    async def get_subscriber_record(self, user_id):
+        """سجل المشترك كاملاً (مع trial_used) عبر الذاكرة المؤقتة"""
+        return await self.subscriber_cache.get(user_id, self.store.get_subscriber)
+
+    async def get_subscription_info(self, user_id):
         """الحصول على معلومات اشتراك المستخدم"""
         try:
-            cursor = self.get_cursor()
-            cursor.execute('''
-                SELECT code_used, subscribed_at, expires_at, is_active, invite_links, is_trial
-                FROM subscribers 
-                WHERE user_id = ?
-            ''', (user_id,))
-            
-            result = cursor.fetchone()
-            cursor.close()
-            return result
+            record = await self.get_subscriber_record(user_id)
+            return record[:6] if record else None
         except Exception as e:
             logger.error(f"❌ خطأ في الحصول على معلومات الاشتراك: {e}")
             return None
 
-    def get_available_codes(self):
+    async def get_available_codes(self):
         """الحصول على الأكواد المتاحة"""
         try:
-            current_time = datetime.now().isoformat()
-            cursor = self.get_cursor()
-            cursor.execute('''
-                SELECT code, duration_days, price, created_at, expires_at, is_trial
-                FROM codes 
-                WHERE is_used = FALSE AND is_active = TRUE AND (expires_at IS NULL OR expires_at > ?)
-                ORDER BY created_at DESC
-            ''', (current_time,))
-            
-            result = cursor.fetchall()
-            cursor.close()
-            return result
+            return await self.store.list_available_codes(epoch_now())
         except Exception as e:
             logger.error(f"❌ خطأ في الحصول على الأكواد المتاحة: {e}")
             return []
 
-    def get_all_subscribers(self):
+    async def get_all_subscribers(self):
         """الحصول على جميع المشتركين"""
         try:
-            cursor = self.get_cursor()
-            cursor.execute('''
-                SELECT user_id, username, first_name, last_name, code_used, 
-                       subscribed_at, expires_at, is_active, is_trial
-                FROM subscribers 
-                ORDER BY subscribed_at DESC
-            ''')
-            
-            result = cursor.fetchall()
-            cursor.close()
-            return result
+            return await self.store.list_subscribers()
         except Exception as e:
             logger.error(f"❌ خطأ في الحصول على المشتركين: {e}")
             return []
 
-    def get_system_stats(self):
+    async def find_archived(self, query):
+        """البحث في الأرشيف: رقم يعني معرف مستخدم، وغيره كود"""
+        try:
+            if query.isdigit():
+                return 'subscriber', await self.store.archived_subscriber(int(query))
+            return 'code', await self.store.archived_code(query.upper())
+        except Exception as e:
+            logger.error(f"❌ خطأ في البحث في الأرشيف: {e}")
+            return None, None
+
+    async def get_system_stats(self):
         """الحصول على إحصائيات النظام"""
         try:
-            cursor = self.get_cursor()
-            
-            cursor.execute('SELECT COUNT(*) FROM subscribers WHERE is_active = TRUE')
-            active_subscribers = cursor.fetchone()[0]
-            
-            cursor.execute('SELECT COUNT(*) FROM codes WHERE is_used = FALSE AND is_active = TRUE')
-            available_codes = cursor.fetchone()[0]
-            
-            cursor.execute('SELECT COUNT(*) FROM codes WHERE is_used = TRUE')
-            used_codes = cursor.fetchone()[0]
-            
-            cursor.execute('SELECT COUNT(*) FROM additional_channels WHERE is_active = TRUE')
-            active_channels = cursor.fetchone()[0]
-            
-            cursor.execute('SELECT SUM(price) FROM codes WHERE is_used = TRUE')
-            total_revenue = cursor.fetchone()[0] or 0
-            
-            cursor.close()
-            
-            return {
-                'active_subscribers': active_subscribers,
-                'available_codes': available_codes,
-                'used_codes': used_codes,
-                'active_channels': active_channels,
-                'total_revenue': total_revenue
-            }
+            return await self.store.stats()
         except Exception as e:
             logger.error(f"❌ خطأ في الحصول على إحصائيات النظام: {e}")
             return {}
 
-    def add_dynamic_button(self, button_text, button_command, button_response, created_by):
+    async def add_dynamic_button(self, button_text, button_command, button_response, created_by):
         """إضافة زر ديناميكي جديد"""
         try:
-            cursor = self.get_cursor()
-            cursor.execute('''
-                INSERT INTO dynamic_buttons (button_text, button_command, button_response, created_by, is_active)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (button_text, button_command, button_response, created_by, True))
-            self.conn.commit()
-            cursor.close()
+            if not await self.store.add_button(button_text, button_command, button_response, created_by):
+                return False, "❌ هذا الأمر موجود مسبقاً"
+            await self.bump_buttons_version()
             return True, "✅ تم إضافة الزر بنجاح"
-        except sqlite3.IntegrityError:
-            return False, "❌ هذا الأمر موجود مسبقاً"
         except Exception as e:
             return False, f"❌ خطأ في إضافة الزر: {str(e)}"
 
-    def get_dynamic_buttons(self):
+    async def get_dynamic_buttons(self):
         """الحصول على الأزرار الديناميكية"""
         try:
-            cursor = self.get_cursor()
-            cursor.execute('SELECT * FROM dynamic_buttons WHERE is_active = TRUE ORDER BY created_at DESC')
-            result = cursor.fetchall()
-            cursor.close()
-            return result
+            return await self.store.list_buttons(active_only=True)
         except Exception as e:
             logger.error(f"❌ خطأ في الحصول على الأزرار: {e}")
             return []
 
-    def get_all_dynamic_buttons(self):
+    async def get_all_dynamic_buttons(self):
         """الحصول على جميع الأزرار بما فيها المعطلة"""
         try:
-            cursor = self.get_cursor()
-            cursor.execute('SELECT * FROM dynamic_buttons ORDER BY created_at DESC')
-            result = cursor.fetchall()
-            cursor.close()
-            return result
+            return await self.store.list_buttons(active_only=False)
         except Exception as e:
             logger.error(f"❌ خطأ في الحصول على الأزرار: {e}")
             return []
 
-    def delete_dynamic_button(self, button_command):
+    async def delete_dynamic_button(self, button_command):
         """حذف زر ديناميكي"""
         try:
-            cursor = self.get_cursor()
-            cursor.execute('DELETE FROM dynamic_buttons WHERE button_command = ?', (button_command,))
-            self.conn.commit()
-            cursor.close()
+            await self.store.delete_button(button_command)
+            await self.bump_buttons_version()
             return True, "✅ تم حذف الزر بنجاح"
         except Exception as e:
             return False, f"❌ خطأ في حذف الزر: {str(e)}"
 
-    def toggle_dynamic_button(self, button_command):
+    async def toggle_dynamic_button(self, button_command):
         """تفعيل/تعطيل زر ديناميكي"""
         try:
-            cursor = self.get_cursor()
-            # الحصول على الحالة الحالية
-            cursor.execute('SELECT is_active FROM dynamic_buttons WHERE button_command = ?', (button_command,))
-            result = cursor.fetchone()
-            
-            if not result:
+            new_state = await self.store.toggle_button(button_command)
+            if new_state is None:
                 return False, "❌ الزر غير موجود"
             
-            current_state = result[0]
-            new_state = not current_state
+            status = "مفعل" if new_state else "معطل"
+            await self.bump_buttons_version()
+            return True, f"✅ تم {status} الزر بنجاح"
+        except Exception as e:
+            return False, f"❌ خطأ في تعديل حالة الزر: {str(e)}"
+
+    async def edit_dynamic_button(self, button_command, new_text=None, new_response=None):
+        """تعديل زر ديناميكي"""
+        try:
+            await self.store.edit_button(button_command, new_text, new_response)
+            await self.bump_buttons_version()
+            return True, "✅ تم تعديل الزر بنجاح"
+        except Exception as e:
+            return False, f"❌ خطأ في تعديل الزر: {str(e)}"
+
+    async def get_buttons_version(self, max_age=5.0):
+        """رقم إصدار سجل الأزرار، يقرأ من القاعدة كل بضع ثوان لالتقاط تعديلات العمليات الأخرى"""
+        now = time.monotonic()
+        cached = getattr(self, '_buttons_version', None)
+        if cached and now - cached[1] < max_age:
+            return cached[0]
+        try:
+            version = await self.store.registry_version('dynamic_buttons')
+        except Exception as e:
+            logger.error(f"❌ خطأ في قراءة إصدار الأزرار: {e}")
+            version = cached[0] if cached else 0
+        self._buttons_version = (version, now)
+        return version
+
+    async def get_subscribers_version(self):
+        """رقم إصدار سجلات المشتركين المشترك بين العمليات، تقرؤه ذاكرة المشتركين المؤقتة كل ثانية"""
+        try:
+            return await self.store.registry_version('subscribers')
+        except Exception as e:
+            logger.error(f"❌ خطأ في قراءة إصدار المشتركين: {e}")
+            return self.subscriber_cache.synced_version
+
+    async def bump_subscribers_version(self):
+        """زيادة رقم إصدار المشتركين بعد كتابة قد تمس مستخدمين يخدمهم عامل آخر (دفعة الفحص أو الأرشفة).
+        التفعيل والفترة التجريبية يكتبان في عامل المستخدم نفسه، فيكفيهما invalidate المحلي"""
+        try:
+            await self.store.bump_registry_version('subscribers')
+        except Exception as e:
+            sweep_logger.error("❌ خطأ في تحديث إصدار المشتركين: %s", e)
+
+    async def bump_buttons_version(self):
+        """زيادة رقم إصدار سجل الأزرار بعد أي تعديل"""
+        try:
+            await self.store.bump_registry_version('dynamic_buttons')
+            self._buttons_version = None
+        except Exception as e:
+            logger.error(f"❌ خطأ في تحديث إصدار الأزرار: {e}")
+
+    async def get_dynamic_button_by_command(self, button_command):
+        """الحصول على معلومات زر بواسطة الأمر"""
+        try:
+            return await self.store.get_button(button_command)
+        except Exception as e:
+            logger.error(f"❌ خطأ في الحصول على معلومات الزر: {e}")
+            return None
+
+    def is_valid_code_format(self, text):
+        """التحقق من صحة تنسيق الكود: كود بحرف تحقق صحيح، أو كود موقع بتوقيع صحيح، أو كود قديم من 12 حرفاً"""
+        return (has_valid_checksum(text) or verify_signed_code(text) is not None
+                or LEGACY_CODE_PATTERN.match(text) is not None)
+
+    async def find_code_in_text(self, text):
+        """البحث عن كود في النص، الكلمات التي لا تطابق الصيغة أو حرف التحقق ترفض بدون استعلام"""
+        for match in CODE_TOKEN_PATTERN.findall(text.upper()):
+            if not self.is_valid_code_format(match):
+                continue
+            # الكود الموقع يكفي توقيعه، واستخدامه السابق يظهر عند التفعيل
+            if verify_signed_code(match) or await self.store.is_code_available(match):
+                return match
+        
+        return None
+
+# =============================================
+# قوالب الرسائل والقوائم المجهزة مسبقاً
+# =============================================
+WELCOME_TEMPLATE = """
+مرحباً {first_name}!
+
+أهلاً بك في صالة روبوت سباكس 🤖
+
+مميزات النظام الاحترافية:
+🧠 تحليل بالذكاء الاصطناعي
+⚡ تنفيذ فوري للإشارات
+📊 مراقبة مستمرة من خبراء التحليل
+🎯 دقة عالية في الأداء
+🔄 تحديث وتطوير مستمر
+📈 تحليلات تنبؤية متقدمة
+✨ مؤشرات حصرية للمشتركين
+🎓 دورات تدريبية متخصصة
+🔒 أداء ثابت وموثوق
+🤖 تداول آلي بالكامل
+👨‍💼 إشراف مباشر من محترفين
+
+انظم إلى قناتنا الرئيسية:
+📢 @SPX53
+
+لطلب الدعم او الاشتراك:
+📩 @SPX_47
+
+أو من خلال موقعنا الإلكتروني:
+🌐 جاري التنفيذ 🚧
+
+اختر من الخيارات أدناه للبدء:
+        """
+
+MAIN_MENU_TEMPLATE = """
+القائمة الرئيسية
+
+مرحباً {first_name}!
+
+اختر من الخيارات:
+        """
+
+USER_HELP_TEXT = """
+🛠️ أوامر البوت المتاحة:
+
+👤 للمستخدمين:
+• /start - بدء استخدام البوت
+• /use [الكود] - تفعيل كود اشتراك
+• /trial - تفعيل فترة تجريبية مجانية (48 ساعة)
+• /mainchannel - رابط القناة الرئيسية
+• /mysubscription - عرض معلومات الاشتراك
+• /channels - عرض القنوات المتاحة
+• /help - عرض هذه الرسالة
+
+🎯 **الميزات الجديدة:**
+• 🆓 فترة تجريبية مجانية لمدة 48 ساعة
+• 📢 البقاء في القناة الرئيسية دائماً
+• 🔗 إخراج من القنوات المميزة فقط عند انتهاء الاشتراك
+
+💡 ملاحظة: يمكنك إرسال الكود مباشرة دون استخدام الأمر /use
+        """
+
+# نص المشرفين يضاف مرة واحدة عند التحميل بدلاً من كل طلب
+ADMIN_HELP_TEXT = USER_HELP_TEXT + """
+
+👑 للمشرفين:
+• /createcode [المدة] [السعر] - إنشاء كود جديد
+• /createmultiple [العدد] [المدة] [السعر] - إنشاء عدة أكواد دفعة واحدة
+• /createbatch [عدد] [مدة] [سعر] - إنشاء دفعة أكواد
+• /signcodes [العدد] [المدة] [الخطة] [قنوات...] - إنشاء أكواد موقعة
+• /codes - عرض الأكواد المتاحة
+• /subscribers - عرض المشتركين
+• /stats - إحصائيات النظام
+• /addadmin [معرف] - إضافة مشرف
+• /admins - عرض المشرفين
+• /addchannel [معرف] [معرف_عام] [اسم] - إضافة قناة
+• /channelslist - عرض القنوات
+• /buttons - عرض الأزرار
+• /addbutton [نص] [أمر] [رد] - إضافة زر
+• /checkexpired - التحقق من الاشتراكات المنتهية يدوياً
+• /sendnotifications - إرسال التنبيهات يدوياً
+• /profiler [on|off|report|reset] - محلل المعالجات البطيئة
+• /archived [معرف|كود] - البحث في الأرشيف
+• /backup - إنشاء نسخة احتياطية الآن
+            """
+
+ADMIN_DASHBOARD_TEMPLATE = """
+👑 لوحة تحكم المشرفين
+
+📊 الإحصائيات:
+• 👥 المشتركين النشطين: {active_subscribers}
+• 🎫 الأكواد المتاحة: {available_codes}
+• ✅ الأكواد المستخدمة: {used_codes}
+• 📢 القنوات النشطة: {active_channels}
+• 💰 الإيرادات: ${total_revenue:.2f}
+
+🛠️ أدوات الإدارة:
+        """
+
+NO_SUBSCRIPTION_TEXT = """
+❌ لا يوجد اشتراك فعال
+
+للاستفادة من خدماتنا:
+1. احصل على كود اشتراك من الإدارة
+2. أو استخدم الفترة التجريبية المجانية
+3. أرسل الكود مباشرة أو استخدم الأمر /use
+
+💡 يمكنك إرسال الكود مباشرة دون استخدام الأمر
+            """
+
+SUBSCRIPTION_TEMPLATE = """
+📋 معلومات اشتراكك
+
+🎫 الكود المستخدم: {code_used}
+📅 تاريخ البدء: {subscribed_at}
+⏰ تاريخ الانتهاء: {expires_at}
+🔰 الحالة: {status}
+🎯 النوع: {kind}
+        """
+
+class MenuRenderer:
+    """تجهيز القوائم الثابتة مرة واحدة وتخزين لوحات الأزرار حسب (الدور، إصدار سجل الأزرار)"""
+    def __init__(self, system):
+        self.system = system
+        self._keyboards = {}
+        self._dynamic_buttons = (None, [])
+        
+        self.back_to_main = InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔙 الرجوع إلى القائمة الرئيسية", callback_data="main_back")]
+        ])
+        self.back = InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔙 رجوع", callback_data="main_back")]
+        ])
+        self.no_subscription = InlineKeyboardMarkup([
+            [InlineKeyboardButton("🎫 تفعيل كود", callback_data="user_activate_code")],
+            [InlineKeyboardButton("🆓 فترة تجريبية", callback_data="user_trial")],
+            [InlineKeyboardButton("🔙 رجوع", callback_data="main_back")]
+        ])
+        self.admin_dashboard = InlineKeyboardMarkup([
+            [
+                InlineKeyboardButton("🎫 إنشاء كود", callback_data="admin_create_code"),
+                InlineKeyboardButton("📦 إنشاء دفعة", callback_data="admin_create_batch")
+            ],
+            [
+                InlineKeyboardButton("🎫 إنشاء عدة أكواد", callback_data="admin_create_multiple"),
+                InlineKeyboardButton("📋 الأكواد", callback_data="admin_list_codes")
+            ],
+            [
+                InlineKeyboardButton("👥 المشتركين", callback_data="admin_list_subs"),
+                InlineKeyboardButton("📢 إدارة القنوات", callback_data="admin_manage_channels")
+            ],
+            [
+                InlineKeyboardButton("🎯 إدارة الأزرار", callback_data="admin_manage_buttons"),
+                InlineKeyboardButton("📊 إحصائيات", callback_data="admin_stats")
+            ],
+            [
+                InlineKeyboardButton("🔄 فحص المنتهية", callback_data="admin_check_expired"),
+                InlineKeyboardButton("🔔 إرسال تنبيهات", callback_data="admin_send_notifications")
+            ],
+            [InlineKeyboardButton("🔙 رجوع", callback_data="main_back")]
+        ])
+
+    async def dynamic_buttons(self):
+        """الأزرار الديناميكية النشطة، تقرأ من القاعدة فقط عند تغير الإصدار"""
+        version = await self.system.get_buttons_version()
+        cached_version, buttons = self._dynamic_buttons
+        if cached_version != version:
+            buttons = await self.system.get_dynamic_buttons()
+            self._dynamic_buttons = (version, buttons)
+        return buttons
+
+    async def main_menu_keyboard(self, is_admin):
+        """لوحة القائمة الرئيسية لكل دور"""
+        version = await self.system.get_buttons_version()
+        key = ('admin' if is_admin else 'user', version)
+        keyboard = self._keyboards.get(key)
+        if keyboard is None:
+            rows = [
+                [InlineKeyboardButton("🎫 تفعيل كود اشتراك", callback_data="user_activate_code")],
+                [InlineKeyboardButton("🆓 فترة تجريبية مجانية", callback_data="user_trial")],
+                [InlineKeyboardButton("📢 القناة الرئيسية", callback_data="user_main_channel")],
+                [InlineKeyboardButton("📋 معلومات اشتراكي", callback_data="user_my_subscription")],
+                [InlineKeyboardButton("🛠️ الأوامر المتاحة", callback_data="main_help")]
+            ]
+            
+            # إضافة الأزرار الديناميكية
+            for button in await self.dynamic_buttons():
+                rows.append([InlineKeyboardButton(button[1], callback_data=f"dynamic_{button[2]}")])
             
-            cursor.execute('UPDATE dynamic_buttons SET is_active = ? WHERE button_command = ?', (new_state, button_command))
-            self.conn.commit()
-            cursor.close()
+            if is_admin:
+                rows.append([InlineKeyboardButton("👑 لوحة المشرفين", callback_data="admin_dashboard")])
             
-            status = "مفعل" if new_state else "معطل"
-            return True, f"✅ تم {status} الزر بنجاح"
-        except Exception as e:
-            return False, f"❌ خطأ في تعديل حالة الزر: {str(e)}"
+            # حذف لوحات الإصدارات القديمة
+            self._keyboards = {k: v for k, v in self._keyboards.items() if k[1] == version}
+            keyboard = self._keyboards[key] = InlineKeyboardMarkup(rows)
+        return keyboard
+
+    @staticmethod
+    def help_text(is_admin):
+        return ADMIN_HELP_TEXT if is_admin else USER_HELP_TEXT
+
+    @staticmethod
+    def admin_dashboard_text(stats):
+        return ADMIN_DASHBOARD_TEMPLATE.format(
+            active_subscribers=stats.get('active_subscribers', 0),
+            available_codes=stats.get('available_codes', 0),
+            used_codes=stats.get('used_codes', 0),
+            active_channels=stats.get('active_channels', 0),
+            total_revenue=stats.get('total_revenue', 0)
+        )
 
-    def edit_dynamic_button(self, button_command, new_text=None, new_response=None):
-        """تعديل زر ديناميكي"""
-        try:
-            cursor = self.get_cursor()
-            
-            if new_text and new_response:
-                cursor.execute('''
-                    UPDATE dynamic_buttons 
-                    SET button_text = ?, button_response = ? 
-                    WHERE button_command = ?
-                ''', (new_text, new_response, button_command))
-            elif new_text:
-                cursor.execute('''
-                    UPDATE dynamic_buttons 
-                    SET button_text = ? 
-                    WHERE button_command = ?
-                ''', (new_text, button_command))
-            elif new_response:
-                cursor.execute('''
-                    UPDATE dynamic_buttons 
-                    SET button_response = ? 
-                    WHERE button_command = ?
-                ''', (new_response, button_command))
-            
-            self.conn.commit()
-            cursor.close()
-            return True, "✅ تم تعديل الزر بنجاح"
-        except Exception as e:
-            return False, f"❌ خطأ في تعديل الزر: {str(e)}"
+    @staticmethod
+    def subscription_text(subscription_info):
+        """نص معلومات الاشتراك مع روابط القنوات"""
+        code_used, subscribed_at, expires_at, is_active, invite_links_json, is_trial = subscription_info
+        
+        text = SUBSCRIPTION_TEMPLATE.format(
+            code_used=code_used,
+            subscribed_at=format_date(subscribed_at),
+            expires_at=format_date(expires_at),
+            status='🟢 نشط' if is_active else '🔴 منتهي',
+            kind="تجريبية" if is_trial else "عادية"
+        )
+        
+        # عرض روابط الدعوة إذا كانت موجودة
+        if invite_links_json:
+            invite_links = json.loads(invite_links_json)
+            if invite_links:
+                text += "\n🔗 روابط القنوات:\n"
+                for link_info in invite_links:
+                    text += f"• {link_info['channel_name']}: {link_info['invite_link']}\n"
+        return text
 
-    def get_dynamic_button_by_command(self, button_command):
-        """الحصول على معلومات زر بواسطة الأمر"""
-        try:
-            cursor = self.get_cursor()
-            cursor.execute('SELECT * FROM dynamic_buttons WHERE button_command = ?', (button_command,))
-            result = cursor.fetchone()
-            cursor.close()
-            return result
-        except Exception as e:
-            logger.error(f"❌ خطأ في الحصول على معلومات الزر: {e}")
+# =============================================
+# موجه استعلامات الأزرار
+# =============================================
+CALLBACK_DENIED = metrics.counter(
+    "bot_callback_denied_total", "ضغطات أزرار المشرفين من مستخدمين بدون صلاحية", ("route",))
+
+class CallbackRoute:
+    """مسار زر: دالة البوت المنفذة، وهل يتطلب مشرفاً، وفئة معدله، واسمه في المقاييس"""
+    __slots__ = ("data", "handler", "admin_only", "rate_class", "metric", "denied_text", "prefix")
+
+    def __init__(self, data, handler, admin_only=False, rate_class="menu", metric=None, denied_text=None, prefix=False):
+        self.data = data
+        self.handler = handler
+        self.admin_only = admin_only
+        # menu: عرض القوائم، action: عمليات تكتب في القاعدة أو ترسل لعدة مستخدمين
+        self.rate_class = rate_class
+        # مسارات البادئات تجمع تحت اسم واحد حتى لا يزيد عدد سلاسل المقاييس مع كل زر
+        self.metric = metric or (f"{data}*" if prefix else data)
+        # رسالة رفض غير المشرف، وبدونها يتجاهل الضغط بصمت
+        self.denied_text = denied_text
+        # بادئة تحمل بعدها جزءاً متغيراً، تستدعى دالتها مع بيانات الزر كاملة
+        self.prefix = prefix
+
+class CallbackRouter:
+    """مطابقة تامة عبر dict، والبادئات عبر شجرة حروف تعيد أطول بادئة مطابقة"""
+    def __init__(self, routes=()):
+        self.exact = {}
+        self.trie = {}
+        for route in routes:
+            self.add(route)
+
+    def add(self, route):
+        if not route.prefix:
+            self.exact[route.data] = route
+            return
+        node = self.trie
+        for char in route.data:
+            node = node.setdefault(char, {})
+        # المفتاح None يحدد نهاية بادئة مسجلة
+        node[None] = route
+
+    def resolve(self, data):
+        """المسار المطابق لبيانات الزر أو None"""
+        route = self.exact.get(data)
+        if route is not None:
+            return route
+        node = self.trie
+        found = None
+        for char in data:
+            node = node.get(char)
+            if node is None:
+                break
+            found = node.get(None, found)
+        return found
+
+# جدول الأزرار: أي شاشة جديدة تضاف هنا فقط، وصلاحية المشرف يتحقق منها الموجه
+CALLBACK_ROUTES = (
+    CallbackRoute("user_activate_code", "activate_code_menu"),
+    CallbackRoute("user_trial", "activate_trial_callback", rate_class="action"),
+    CallbackRoute("user_main_channel", "show_main_channel_callback"),
+    CallbackRoute("user_my_subscription", "show_user_subscription"),
+    CallbackRoute("user_list_channels", "show_available_channels"),
+    CallbackRoute("main_help", "show_help_menu"),
+    CallbackRoute("main_back", "show_main_menu"),
+    CallbackRoute("admin_dashboard", "show_admin_dashboard", admin_only=True,
+                  denied_text="❌ ليس لديك صلاحية الوصول إلى لوحة المشرفين"),
+    CallbackRoute("admin_stats", "show_detailed_stats", admin_only=True,
+                  denied_text="❌ ليس لديك صلاحية الوصول إلى الإحصائيات"),
+    CallbackRoute("admin_create_code", "show_create_code_menu", admin_only=True),
+    CallbackRoute("admin_list_codes", "show_codes_list", admin_only=True),
+    CallbackRoute("admin_list_subs", "show_subscribers_list", admin_only=True),
+    CallbackRoute("admin_manage_channels", "show_channels_management", admin_only=True),
+    CallbackRoute("admin_check_expired", "check_expired_manually_callback", admin_only=True, rate_class="action"),
+    CallbackRoute("admin_send_notifications", "send_notifications_manually_callback", admin_only=True,
+                  rate_class="action"),
+    CallbackRoute("admin_create_multiple", "create_multiple_codes_callback", admin_only=True, rate_class="action"),
+    CallbackRoute("admin_manage_buttons", "show_buttons_management", admin_only=True),
+    CallbackRoute("admin_add_button", "add_button_start_callback", admin_only=True),
+    CallbackRoute("admin_delete_button", "delete_button_start_callback", admin_only=True),
+    CallbackRoute("admin_edit_button", "edit_button_start_callback", admin_only=True),
+    CallbackRoute("edit_text_", "handle_edit_callback", admin_only=True, prefix=True),
+    CallbackRoute("edit_response_", "handle_edit_callback", admin_only=True, prefix=True),
+    CallbackRoute("edit_both_", "handle_edit_callback", admin_only=True, prefix=True),
+    CallbackRoute("dynamic_", "show_dynamic_button_callback", prefix=True),
+)
+
+CALLBACK_ROUTER = CallbackRouter(CALLBACK_ROUTES)
+
+# =============================================
+# حد التحديثات الواردة لكل مستخدم
+# =============================================
+INBOUND_THROTTLED = metrics.counter(
+    "bot_inbound_throttled_total", "تحديثات واردة تجاوزت حد المستخدم حسب التصرف", ("policy",))
+INBOUND_TRACKED_USERS = metrics.gauge("bot_inbound_tracked_users", "عدد المستخدمين المتتبعين في حد الرسائل الواردة")
+
+class ThrottleState:
+    """حالة مستخدم واحد: رصيد token bucket وعدادا النافذة الحالية والسابقة"""
+    __slots__ = ("tokens", "updated", "window_start", "current", "previous", "notified")
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated = now
+        self.window_start = now
+        self.current = 0.0
+        self.previous = 0.0
+        self.notified = False
+
+class InboundThrottle:
+    """حد التحديثات الواردة لكل مستخدم في الذاكرة: token bucket للدفعات القصيرة، ونافذة منزلقة للحد المستمر.
+    النافذة تقريبية (عداد النافذة الحالية وجزء من السابقة) فتكفيها ثلاثة أرقام بدلاً من تخزين وقت كل رسالة"""
+    def __init__(self, rate=INBOUND_RATE, burst=INBOUND_BURST, window=INBOUND_WINDOW, window_max=INBOUND_WINDOW_MAX):
+        self.rate = rate
+        self.burst = burst
+        self.window = window
+        self.window_max = window_max
+        self.states = {}
+        self.checks = 0
+
+    def acquire(self, user_id, cost=1, now=None):
+        """0 إذا سمح بالتحديث، أو مدة الانتظار حتى يكفي الرصيد، أو None إذا تجاوز حد النافذة"""
+        now = time.monotonic() if now is None else now
+        self.checks += 1
+        if self.checks % 1000 == 0:
+            self.prune(now)
+
+        state = self.states.get(user_id)
+        if state is None:
+            state = self.states[user_id] = ThrottleState(self.burst, now)
+
+        elapsed = now - state.window_start
+        if elapsed >= self.window:
+            # النافذة السابقة تحسب فقط إذا كانت ملاصقة للحالية
+            state.previous = state.current if elapsed < 2 * self.window else 0.0
+            state.current = 0.0
+            state.window_start = now - elapsed % self.window
+            elapsed = now - state.window_start
+        if state.previous * (1 - elapsed / self.window) + state.current + cost > self.window_max:
             return None
 
-    def is_valid_code_format(self, text):
-        """التحقق من صحة تنسيق الكود"""
-        pattern = r'^[A-Z0-9]{12}$'
-        return re.match(pattern, text) is not None
-
-    def find_code_in_text(self, text):
-        """البحث عن كود في النص"""
-        pattern = r'[A-Z0-9]{12}'
-        matches = re.findall(pattern, text.upper())
-        
-        for match in matches:
-            if self.is_valid_code_format(match):
-                cursor = self.get_cursor()
-                cursor.execute('SELECT id FROM codes WHERE code = ? AND is_used = FALSE AND is_active = TRUE', (match,))
-                result = cursor.fetchone() is not None
-                cursor.close()
-                
-                if result:
-                    return match
-        
-        return None
+        state.tokens = min(self.burst, state.tokens + (now - state.updated) * self.rate)
+        state.updated = now
+        if state.tokens < cost:
+            return (cost - state.tokens) / self.rate
+
+        state.tokens -= cost
+        state.current += cost
+        state.notified = False
+        return 0
+
+    def delay(self, user_id, cost=1, now=None):
+        """مدة الانتظار حتى يكفي الرصيد دون استهلاكه (لسياسة delay)، 0 إذا كفى الرصيد أو تجاوز حد النافذة فلا يفيد الانتظار"""
+        now = time.monotonic() if now is None else now
+        state = self.states.get(user_id)
+        if state is None:
+            return 0
+        
+        elapsed = now - state.window_start
+        previous, current = state.previous, state.current
+        if elapsed >= self.window:
+            previous = current if elapsed < 2 * self.window else 0.0
+            current = 0.0
+            elapsed %= self.window
+        if previous * (1 - elapsed / self.window) + current + cost > self.window_max:
+            return 0
+        
+        tokens = min(self.burst, state.tokens + (now - state.updated) * self.rate)
+        return max(0.0, (cost - tokens) / self.rate)
+
+    def first_notice(self, user_id):
+        """True مرة واحدة فقط في كل فترة تجاوز، لسياسة reply_once"""
+        state = self.states.get(user_id)
+        if state is None or state.notified:
+            return False
+        state.notified = True
+        return True
+
+    def prune(self, now):
+        """حذف المستخدمين الذين امتلأ رصيدهم وانتهت نافذتهم، فحالتهم تساوي حالة مستخدم جديد"""
+        idle = now - 2 * self.window
+        self.states = {
+            user_id: state for user_id, state in self.states.items()
+            if state.window_start > idle or state.tokens + (now - state.updated) * self.rate < self.burst
+        }
+        INBOUND_TRACKED_USERS.set(len(self.states))
 
 # =============================================
 # بوت التلجرام - الإصدار المحدث والمصحح
@@ -1290,12 +5269,20 @@ class TelegramSubscriptionBot:
         self.main_admin = MAIN_ADMIN
         self.system = system
         self.application = None
-        self.user_data = {}
+        self.renderer = MenuRenderer(system)
+        # حد الإرسال العام لهذه العملية (في وضع العمال المتعددين يقسم الحد عليهم)
+        self.rate_limit = BOT_RATE_LIMIT
+        self.throttle = InboundThrottle()
         
     def setup_handlers(self, application):
         """إعداد معالجات الأوامر - تم التصحيح"""
         self.application = application
         
+        # قبل كل المعالجات: تجاهل التحديث الذي عولج قبل إعادة التشغيل وأعاد Telegram إرساله
+        application.add_handler(TypeHandler(Update, self.skip_processed_update), group=-2)
+        # ثم حد التحديثات الواردة لكل مستخدم، قبل أي بحث عن كود أو رد
+        application.add_handler(TypeHandler(Update, self.throttle_update), group=-1)
+        
         # الأوامر الأساسية
         application.add_handler(CommandHandler("start", self.start))
         application.add_handler(CommandHandler("help", self.help_command))
@@ -1320,18 +5307,20 @@ class TelegramSubscriptionBot:
         # الأوامر الجديدة للإدارة
         application.add_handler(CommandHandler("checkexpired", self.check_expired_manually))
         application.add_handler(CommandHandler("sendnotifications", self.send_notifications_manually))
+        application.add_handler(CommandHandler("profiler", self.profiler_command))
+        application.add_handler(CommandHandler("archived", self.archived_command))
+        application.add_handler(CommandHandler("backup", self.backup_command))
         
         # الأمر الجديد لإنشاء عدة أكواد
         application.add_handler(CommandHandler("createmultiple", self.create_multiple_codes))
+        application.add_handler(CommandHandler("signcodes", self.sign_codes_command))
         
         # نظام الأزرار الديناميكية المتكامل
+        # أوامر addbutton و deletebutton و editbutton نقاط دخول المحادثة أدناه
         application.add_handler(CommandHandler("buttons", self.list_buttons))
-        application.add_handler(CommandHandler("addbutton", self.add_button_start))
-        application.add_handler(CommandHandler("deletebutton", self.delete_button_start))
-        application.add_handler(CommandHandler("editbutton", self.edit_button_start))
         application.add_handler(CommandHandler("togglebutton", self.toggle_button))
         
-        # معالجات المحادثة للأزرار
+        # معالجات المحادثة للأزرار، حالتها محفوظة في القاعدة فتستمر بعد إعادة التشغيل
         conversation_handler = ConversationHandler(
             entry_points=[
                 CommandHandler('addbutton', self.add_button_start),
@@ -1356,7 +5345,9 @@ class TelegramSubscriptionBot:
                 ]
             },
             fallbacks=[CommandHandler('cancel', self.cancel_operation)],
-            allow_reentry=True
+            allow_reentry=True,
+            name="button_management",
+            persistent=True
         )
         
         application.add_handler(conversation_handler)
@@ -1370,17 +5361,79 @@ class TelegramSubscriptionBot:
         # معالج الأخطاء
         application.add_error_handler(self.error_handler)
         
-        # إعداد معالجات الأزرار الديناميكية
-        self.setup_dynamic_handlers(application)
+        # معالجات الأزرار الديناميكية تضاف بعد فتح طبقة التخزين (setup_dynamic_handlers)
+        for handlers in application.handlers.values():
+            register_command_labels(handlers)
+
+    async def skip_processed_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        persistence = context.application.persistence
+        if persistence is not None and not persistence.claim_update(update.update_id):
+            DUPLICATE_UPDATES.inc()
+            logger.info(f"⏭️ تجاهل التحديث {update.update_id} لأنه عولج من قبل")
+            raise ApplicationHandlerStop
+
+    @staticmethod
+    def update_cost(update):
+        """تكلفة التحديث من رصيد المستخدم: أزرار الإجراءات أغلى من التصفح"""
+        if update.callback_query:
+            route = CALLBACK_ROUTER.resolve(update.callback_query.data or "")
+            if route is not None and route.rate_class == "action":
+                return INBOUND_ACTION_COST
+        return 1
+
+    async def delay_update(self, update):
+        """سياسة delay: انتظار رصيد المستخدم قبل حجز مقعد تنفيذ في OrderedUpdateProcessor.
+        تحديثات نفس المحادثة تنتظر دورها خلفه، فلا يتجاوز المستخدم حده بالتوازي"""
+        user = update.effective_user if isinstance(update, Update) else None
+        if INBOUND_RATE <= 0 or user is None or user.id in ADMIN_IDS:
+            return
+        
+        cost = self.update_cost(update)
+        deadline = time.monotonic() + INBOUND_MAX_DELAY
+        delayed = False
+        while True:
+            wait = self.throttle.delay(user.id, cost)
+            if wait <= 0:
+                break
+            if time.monotonic() + wait > deadline:
+                # يتجاهله throttle_update ويحسبه هناك
+                return
+            delayed = True
+            await asyncio.sleep(wait)
+        if delayed:
+            INBOUND_THROTTLED.inc(policy="delay")
+
+    async def throttle_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """تطبيق INBOUND_POLICY على المستخدم الذي تجاوز حده، المشرفون في ADMIN_IDS مستثنون"""
+        user = update.effective_user
+        if INBOUND_RATE <= 0 or user is None or user.id in ADMIN_IDS:
+            return
+        
+        # سياسة delay انتظرت مسبقاً في delay_update قبل حجز مقعد التنفيذ، فما لا يكفيه الرصيد الآن يتجاهل
+        if self.throttle.acquire(user.id, self.update_cost(update)) == 0:
+            return
+        
+        INBOUND_THROTTLED.inc(policy=INBOUND_POLICY)
+        if INBOUND_POLICY == "reply_once" and self.throttle.first_notice(user.id):
+            notice = "⏳ أنت ترسل بسرعة كبيرة، انتظر قليلاً ثم حاول مرة أخرى"
+            try:
+                if update.callback_query:
+                    await update.callback_query.answer(notice)
+                elif update.effective_message:
+                    await update.effective_message.reply_text(notice)
+            except Exception as e:
+                logger.warning(f"⚠️ تعذر تنبيه المستخدم {user.id} بتجاوز الحد: {e}")
+        raise ApplicationHandlerStop
 
-    def setup_dynamic_handlers(self, application):
-        """إعداد معالجات الأزرار الديناميكية - تم التصحيح"""
+    async def setup_dynamic_handlers(self, application):
+        """إعداد معالجات الأزرار الديناميكية، بعد فتح طبقة التخزين لأن الأزرار تقرأ منها"""
         try:
-            buttons = self.system.get_dynamic_buttons()
+            buttons = await self.system.get_dynamic_buttons()
             for button in buttons:
                 command = button[2]  # button_command
                 # إضافة معالج لكل زر ديناميكي
                 application.add_handler(CommandHandler(command, self.handle_dynamic_command))
+            register_command_labels(application.handlers[0])
         except Exception as e:
             logger.error(f"❌ خطأ في إعداد معالجات الأزرار الديناميكية: {e}")
 
@@ -1390,20 +5443,14 @@ class TelegramSubscriptionBot:
             command = update.message.text.split()[0][1:]  # إزالة /
             button = None
             
-            buttons = self.system.get_dynamic_buttons()
-            for btn in buttons:
+            for btn in await self.renderer.dynamic_buttons():
                 if btn[2] == command:
                     button = btn
                     break
             
             if button:
                 # إضافة زر الرجوع إلى القائمة الرئيسية
-                keyboard = [
-                    [InlineKeyboardButton("🔙 الرجوع إلى القائمة الرئيسية", callback_data="main_back")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                await update.message.reply_text(button[3], reply_markup=reply_markup)
+                await update.message.reply_text(button[3], reply_markup=self.renderer.back_to_main)
             else:
                 await update.message.reply_text("❌ هذا الأمر غير متوفر حالياً")
                 
@@ -1414,7 +5461,7 @@ class TelegramSubscriptionBot:
     # نظام إدارة الأزرار الديناميكية - البدء
     async def add_button_start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """بدء عملية إضافة زر جديد"""
-        if not self.system.is_admin(update.effective_user.id):
+        if not await self.system.is_admin(update.effective_user.id):
             await update.message.reply_text("❌ ليس لديك صلاحية هذا الأمر")
             return ConversationHandler.END
         
@@ -1455,7 +5502,7 @@ class TelegramSubscriptionBot:
             return WAITING_FOR_BUTTON_COMMAND
         
         # التحقق من عدم وجود الأمر مسبقاً
-        existing_button = self.system.get_dynamic_button_by_command(command)
+        existing_button = await self.system.get_dynamic_button_by_command(command)
         if existing_button:
             await update.message.reply_text(
                 "❌ **هذا الأمر موجود مسبقاً**\n\n"
@@ -1481,13 +5528,13 @@ class TelegramSubscriptionBot:
         button_command = context.user_data['button_command']
         button_response = update.message.text
         
-        success, message = self.system.add_dynamic_button(
+        success, message = await self.system.add_dynamic_button(
             button_text, button_command, button_response, update.effective_user.id
         )
         
         if success:
             # إعادة تحميل المعالجات لتشمل الزر الجديد
-            self.setup_dynamic_handlers(self.application)
+            await self.setup_dynamic_handlers(self.application)
             
             keyboard = [
                 [InlineKeyboardButton("🔙 الرجوع إلى القائمة الرئيسية", callback_data="main_back")],
@@ -1512,11 +5559,11 @@ class TelegramSubscriptionBot:
 
     async def delete_button_start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """بدء عملية حذف زر"""
-        if not self.system.is_admin(update.effective_user.id):
+        if not await self.system.is_admin(update.effective_user.id):
             await update.message.reply_text("❌ ليس لديك صلاحية هذا الأمر")
             return ConversationHandler.END
         
-        buttons = self.system.get_all_dynamic_buttons()
+        buttons = await self.system.get_all_dynamic_buttons()
         
         if not buttons:
             await update.message.reply_text("📭 لا توجد أزرار متاحة للحذف")
@@ -1540,7 +5587,7 @@ class TelegramSubscriptionBot:
         command = update.message.text.strip().lower()
         
         # التحقق من وجود الزر
-        button = self.system.get_dynamic_button_by_command(command)
+        button = await self.system.get_dynamic_button_by_command(command)
         if not button:
             await update.message.reply_text(
                 "❌ **الزر غير موجود**\n\n"
@@ -1549,11 +5596,11 @@ class TelegramSubscriptionBot:
             return WAITING_FOR_BUTTON_DELETE
         
         # حذف الزر
-        success, message = self.system.delete_dynamic_button(command)
+        success, message = await self.system.delete_dynamic_button(command)
         
         if success:
             # إعادة تحميل المعالجات
-            self.setup_dynamic_handlers(self.application)
+            await self.setup_dynamic_handlers(self.application)
             
             keyboard = [
                 [InlineKeyboardButton("🔙 الرجوع إلى القائمة الرئيسية", callback_data="main_back")],
@@ -1574,11 +5621,11 @@ class TelegramSubscriptionBot:
 
     async def edit_button_start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """بدء عملية تعديل زر"""
-        if not self.system.is_admin(update.effective_user.id):
+        if not await self.system.is_admin(update.effective_user.id):
             await update.message.reply_text("❌ ليس لديك صلاحية هذا الأمر")
             return ConversationHandler.END
         
-        buttons = self.system.get_all_dynamic_buttons()
+        buttons = await self.system.get_all_dynamic_buttons()
         
         if not buttons:
             await update.message.reply_text("📭 لا توجد أزرار متاحة للتعديل")
@@ -1602,7 +5649,7 @@ class TelegramSubscriptionBot:
         command = update.message.text.strip().lower()
         
         # التحقق من وجود الزر
-        button = self.system.get_dynamic_button_by_command(command)
+        button = await self.system.get_dynamic_button_by_command(command)
         if not button:
             await update.message.reply_text(
                 "❌ **الزر غير موجود**\n\n"
@@ -1632,7 +5679,7 @@ class TelegramSubscriptionBot:
 
     async def toggle_button(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """تفعيل/تعطيل زر"""
-        if not self.system.is_admin(update.effective_user.id):
+        if not await self.system.is_admin(update.effective_user.id):
             await update.message.reply_text("❌ ليس لديك صلاحية هذا الأمر")
             return
         
@@ -1645,21 +5692,21 @@ class TelegramSubscriptionBot:
             return
         
         command = context.args[0].lower()
-        success, message = self.system.toggle_dynamic_button(command)
+        success, message = await self.system.toggle_dynamic_button(command)
         
         if success:
             # إعادة تحميل المعالجات
-            self.setup_dynamic_handlers(self.application)
+            await self.setup_dynamic_handlers(self.application)
         
         await update.message.reply_text(message)
 
     async def list_buttons(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """عرض جميع الأزرار الديناميكية"""
-        if not self.system.is_admin(update.effective_user.id):
+        if not await self.system.is_admin(update.effective_user.id):
             await update.message.reply_text("❌ ليس لديك صلاحية هذا الأمر")
             return
         
-        buttons = self.system.get_all_dynamic_buttons()
+        buttons = await self.system.get_all_dynamic_buttons()
         
         if not buttons:
             await update.message.reply_text("📭 لا توجد أزرار ديناميكية مضافة")
@@ -1729,7 +5776,7 @@ class TelegramSubscriptionBot:
 
     async def main_channel_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """رابط القناة الرئيسية"""
-        main_channel = self.system.get_main_channel_info()
+        main_channel = await self.system.get_main_channel_info()
         
         if not main_channel:
             await update.message.reply_text("❌ لم يتم العثور على معلومات القناة الرئيسية")
@@ -1759,144 +5806,55 @@ class TelegramSubscriptionBot:
         """بدء المحادثة مع الأزرار الجديدة"""
         user = update.effective_user
         
-        # الحصول على الأزرار الديناميكية النشطة
-        dynamic_buttons = self.system.get_dynamic_buttons()
-        
-        keyboard = [
-            [InlineKeyboardButton("🎫 تفعيل كود اشتراك", callback_data="user_activate_code")],
-            [InlineKeyboardButton("🆓 فترة تجريبية مجانية", callback_data="user_trial")],
-            [InlineKeyboardButton("📢 القناة الرئيسية", callback_data="user_main_channel")],
-            [InlineKeyboardButton("📋 معلومات اشتراكي", callback_data="user_my_subscription")],
-            [InlineKeyboardButton("🛠️ الأوامر المتاحة", callback_data="main_help")]
-        ]
-        
-        # إضافة الأزرار الديناميكية
-        for button in dynamic_buttons:
-            keyboard.append([InlineKeyboardButton(button[1], callback_data=f"dynamic_{button[2]}")])
-        
-        if self.system.is_admin(user.id):
-            keyboard.append([InlineKeyboardButton("👑 لوحة المشرفين", callback_data="admin_dashboard")])
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        welcome_text = f"""
-مرحباً {user.first_name}!
-
-أهلاً بك في صالة روبوت سباكس 🤖
-
-مميزات النظام الاحترافية:
-🧠 تحليل بالذكاء الاصطناعي
-⚡ تنفيذ فوري للإشارات
-📊 مراقبة مستمرة من خبراء التحليل
-🎯 دقة عالية في الأداء
-🔄 تحديث وتطوير مستمر
-📈 تحليلات تنبؤية متقدمة
-✨ مؤشرات حصرية للمشتركين
-🎓 دورات تدريبية متخصصة
-🔒 أداء ثابت وموثوق
-🤖 تداول آلي بالكامل
-👨‍💼 إشراف مباشر من محترفين
-
-انظم إلى قناتنا الرئيسية:
-📢 @SPX53
-
-لطلب الدعم او الاشتراك:
-📩 @SPX_47
-
-أو من خلال موقعنا الإلكتروني:
-🌐 جاري التنفيذ 🚧
-
-اختر من الخيارات أدناه للبدء:
-        """
+        reply_markup = await self.renderer.main_menu_keyboard(await self.system.is_admin(user.id))
+        welcome_text = WELCOME_TEMPLATE.format(first_name=user.first_name)
         
         await update.message.reply_text(welcome_text, reply_markup=reply_markup)
 
     async def handle_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """معالجة استعلامات الأزرار مع الإضافات الجديدة"""
+        """توجيه ضغطة الزر حسب جدول CALLBACK_ROUTES بعد التحقق من الصلاحية مرة واحدة"""
         query = update.callback_query
         await query.answer()
         
-        data = query.data
-        user = query.from_user
+        data = query.data or ""
+        route = CALLBACK_ROUTER.resolve(data)
+        if route is None:
+            logger.debug("⏭️ زر غير معروف: %s", data)
+            return
         
         try:
-            if data == "user_activate_code":
-                await self.activate_code_menu(query, context)
-            elif data == "user_trial":
-                await self.activate_trial_callback(query, context)
-            elif data == "user_main_channel":
-                await self.show_main_channel_callback(query, context)
-            elif data == "user_my_subscription":
-                await self.show_user_subscription(query, context)
-            elif data == "user_list_channels":
-                await self.show_available_channels(query, context)
-            elif data == "main_help":
-                await self.show_help_menu(query, context)
-            elif data == "admin_dashboard":
-                if self.system.is_admin(user.id):
-                    await self.show_admin_dashboard(query, context)
-                else:
-                    await query.edit_message_text("❌ ليس لديك صلاحية الوصول إلى لوحة المشرفين")
-            elif data == "admin_stats":
-                if self.system.is_admin(user.id):
-                    await self.show_detailed_stats(query, context)
-                else:
-                    await query.edit_message_text("❌ ليس لديك صلاحية الوصول إلى الإحصائيات")
-            elif data == "admin_create_code":
-                if self.system.is_admin(user.id):
-                    await self.show_create_code_menu(query, context)
-            elif data == "admin_list_codes":
-                if self.system.is_admin(user.id):
-                    await self.show_codes_list(query, context)
-            elif data == "admin_list_subs":
-                if self.system.is_admin(user.id):
-                    await self.show_subscribers_list(query, context)
-            elif data == "admin_manage_channels":
-                if self.system.is_admin(user.id):
-                    await self.show_channels_management(query, context)
-            elif data == "admin_check_expired":
-                if self.system.is_admin(user.id):
-                    await self.check_expired_manually_callback(query, context)
-            elif data == "admin_send_notifications":
-                if self.system.is_admin(user.id):
-                    await self.send_notifications_manually_callback(query, context)
-            elif data == "admin_create_multiple":
-                if self.system.is_admin(user.id):
-                    await self.create_multiple_codes_callback(query, context)
-            elif data == "admin_manage_buttons":
-                if self.system.is_admin(user.id):
-                    await self.show_buttons_management(query, context)
-            elif data == "admin_add_button":
-                if self.system.is_admin(user.id):
-                    await self.add_button_start_callback(query, context)
-            elif data == "admin_delete_button":
-                if self.system.is_admin(user.id):
-                    await self.delete_button_start_callback(query, context)
-            elif data == "admin_edit_button":
-                if self.system.is_admin(user.id):
-                    await self.edit_button_start_callback(query, context)
-            elif data.startswith("edit_text_") or data.startswith("edit_response_") or data.startswith("edit_both_"):
-                if self.system.is_admin(user.id):
-                    await self.handle_edit_callback(query, context, data)
-            elif data == "main_back":
-                await self.show_main_menu(query, context)
-            elif data.startswith("dynamic_"):
-                command = data.replace("dynamic_", "")
-                button = self.system.get_dynamic_button_by_command(command)
-                if button:
-                    keyboard = [
-                        [InlineKeyboardButton("🔙 الرجوع إلى القائمة الرئيسية", callback_data="main_back")]
-                    ]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    await query.edit_message_text(button[3], reply_markup=reply_markup)
+            if route.admin_only and not await self.caller_is_admin(query.from_user.id, context):
+                CALLBACK_DENIED.inc(route=route.metric)
+                if route.denied_text:
+                    await query.edit_message_text(route.denied_text)
+                return
+            
+            handler = getattr(self, route.handler)
+            if route.prefix:
+                await handler(query, context, data)
+            else:
+                await handler(query, context)
                 
         except Exception as e:
             logger.error(f"❌ خطأ في معالجة الاستعلام: {e}")
             await query.edit_message_text("❌ حدث خطأ في معالجة الطلب")
 
+    async def caller_is_admin(self, user_id, context):
+        """صلاحية صاحب التحديث تقرأ من القاعدة مرة واحدة وتحفظ في سياق التحديث لباقي المعالجات"""
+        is_admin = getattr(context, "caller_is_admin", None)
+        if is_admin is None:
+            is_admin = context.caller_is_admin = await self.system.is_admin(user_id)
+        return is_admin
+
+    async def show_dynamic_button_callback(self, query, context, data):
+        """عرض رد زر ديناميكي"""
+        button = await self.system.get_dynamic_button_by_command(data[len("dynamic_"):])
+        if button:
+            await query.edit_message_text(button[3], reply_markup=self.renderer.back_to_main)
+
     async def show_buttons_management(self, query, context):
         """عرض لوحة إدارة الأزرار"""
-        buttons = self.system.get_all_dynamic_buttons()
+        buttons = await self.system.get_all_dynamic_buttons()
         
         active_count = len([b for b in buttons if b[4]])
         inactive_count = len([b for b in buttons if not b[4]])
@@ -1934,7 +5892,7 @@ class TelegramSubscriptionBot:
 
     async def delete_button_start_callback(self, query, context):
         """بدء حذف زر من خلال الاستعلام"""
-        buttons = self.system.get_all_dynamic_buttons()
+        buttons = await self.system.get_all_dynamic_buttons()
         
         if not buttons:
             await query.edit_message_text("📭 لا توجد أزرار متاحة للحذف")
@@ -1956,7 +5914,7 @@ class TelegramSubscriptionBot:
 
     async def edit_button_start_callback(self, query, context):
         """بديل لتعديل زر من خلال الاستعلام"""
-        buttons = self.system.get_all_dynamic_buttons()
+        buttons = await self.system.get_all_dynamic_buttons()
         
         if not buttons:
             await query.edit_message_text("📭 لا توجد أزرار متاحة للتعديل")
@@ -2028,7 +5986,7 @@ class TelegramSubscriptionBot:
 
     async def show_main_channel_callback(self, query, context):
         """عرض رابط القناة الرئيسية من خلال الاستعلام"""
-        main_channel = self.system.get_main_channel_info()
+        main_channel = await self.system.get_main_channel_info()
         
         if not main_channel:
             await query.edit_message_text("❌ لم يتم العثور على معلومات القناة الرئيسية")
@@ -2061,239 +6019,88 @@ class TelegramSubscriptionBot:
         """عرض القائمة الرئيسية"""
         user = query.from_user
         
-        # الحصول على الأزرار الديناميكية النشطة
-        dynamic_buttons = self.system.get_dynamic_buttons()
-        
-        keyboard = [
-            [InlineKeyboardButton("🎫 تفعيل كود اشتراك", callback_data="user_activate_code")],
-            [InlineKeyboardButton("🆓 فترة تجريبية مجانية", callback_data="user_trial")],
-            [InlineKeyboardButton("📢 القناة الرئيسية", callback_data="user_main_channel")],
-            [InlineKeyboardButton("📋 معلومات اشتراكي", callback_data="user_my_subscription")],
-            [InlineKeyboardButton("🛠️ الأوامر المتاحة", callback_data="main_help")]
-        ]
-        
-        # إضافة الأزرار الديناميكية
-        for button in dynamic_buttons:
-            keyboard.append([InlineKeyboardButton(button[1], callback_data=f"dynamic_{button[2]}")])
-        
-        if self.system.is_admin(user.id):
-            keyboard.append([InlineKeyboardButton("👑 لوحة المشرفين", callback_data="admin_dashboard")])
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        text = f"""
-القائمة الرئيسية
-
-مرحباً {user.first_name}!
-
-اختر من الخيارات:
-        """
-        
-        await query.edit_message_text(text, reply_markup=reply_markup)
-
-    async def activate_code_menu(self, query, context):
-        """قائمة تفعيل الكود"""
-        keyboard = [
-            [InlineKeyboardButton("🔙 رجوع", callback_data="main_back")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        text = """
-🎫 تفعيل كود اشتراك
-
-يمكنك تفعيل الاشتراك بطريقتين:
-
-1. استخدم الأمر:
-   /use [الكود]
-
-2. أو أرسل الكود مباشرة:
-   فقط اكتب الكود وأرسله
-
-💡 مثال: ABCDEF123456
-
-✅ بعد التفعيل، سيتم إرسال روابط الانضمام إلى القنوات لك تلقائياً.
-        """
-        
-        await query.edit_message_text(text, reply_markup=reply_markup)
-
-    async def show_user_subscription(self, query, context):
-        """عرض معلومات اشتراك المستخدم"""
-        user = query.from_user
-        subscription_info = self.system.get_subscription_info(user.id)
-        
-        if not subscription_info or not subscription_info[3]:  # is_active
-            keyboard = [
-                [InlineKeyboardButton("🎫 تفعيل كود", callback_data="user_activate_code")],
-                [InlineKeyboardButton("🆓 فترة تجريبية", callback_data="user_trial")],
-                [InlineKeyboardButton("🔙 رجوع", callback_data="main_back")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            text = """
-❌ لا يوجد اشتراك فعال
-
-للاستفادة من خدماتنا:
-1. احصل على كود اشتراك من الإدارة
-2. أو استخدم الفترة التجريبية المجانية
-3. أرسل الكود مباشرة أو استخدم الأمر /use
-
-💡 يمكنك إرسال الكود مباشرة دون استخدام الأمر
-            """
-            await query.edit_message_text(text, reply_markup=reply_markup)
-            return
-        
-        code_used, subscribed_at, expires_at, is_active, invite_links_json, is_trial = subscription_info
-        
-        trial_text = "تجريبية" if is_trial else "عادية"
-        
-        text = f"""
-📋 معلومات اشتراكك
-
-🎫 الكود المستخدم: {code_used}
-📅 تاريخ البدء: {subscribed_at.split()[0]}
-⏰ تاريخ الانتهاء: {expires_at.split()[0]}
-🔰 الحالة: {'🟢 نشط' if is_active else '🔴 منتهي'}
-🎯 النوع: {trial_text}
-        """
-        
-        # عرض روابط الدعوة إذا كانت موجودة
-        if invite_links_json:
-            invite_links = json.loads(invite_links_json)
-            if invite_links:
-                text += "\n🔗 روابط القنوات:\n"
-                for link_info in invite_links:
-                    text += f"• {link_info['channel_name']}: {link_info['invite_link']}\n"
-        
-        keyboard = [
-            [InlineKeyboardButton("🔙 رجوع", callback_data="main_back")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(text, reply_markup=reply_markup)
-
-    async def show_available_channels(self, query, context):
-        """عرض القنوات المتاحة"""
-        channels = self.system.get_active_channels()
-        
-        if not channels:
-            text = "📭 لا توجد قنوات متاحة حالياً"
-        else:
-            text = "📢 القنوات المتاحة:\n\n"
-            for i, channel in enumerate(channels, 1):
-                channel_id, username, name, added_at, is_active, is_main_channel = channel[1:7]
-                main_text = " (رئيسية)" if is_main_channel else ""
-                text += f"{i}. {name}{main_text}"
-                if username:
-                    text += f" - {username}"
-                text += "\n"
-        
-        keyboard = [
-            [InlineKeyboardButton("🎫 تفعيل كود", callback_data="user_activate_code")],
-            [InlineKeyboardButton("🆓 فترة تجريبية", callback_data="user_trial")],
-            [InlineKeyboardButton("🔙 رجوع", callback_data="main_back")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(text, reply_markup=reply_markup)
-
-    async def show_help_menu(self, query, context):
-        """عرض قائمة المساعدة"""
-        user = query.from_user
-        
-        text = """
-🛠️ أوامر البوت المتاحة:
-
-👤 للمستخدمين:
-• /start - بدء استخدام البوت
-• /use [الكود] - تفعيل كود اشتراك
-• /trial - تفعيل فترة تجريبية مجانية (48 ساعة)
-• /mainchannel - رابط القناة الرئيسية
-• /mysubscription - عرض معلومات الاشتراك
-• /channels - عرض القنوات المتاحة
-• /help - عرض هذه الرسالة
-
-🎯 **الميزةوات الجديدة:**
-• 🆓 فترة تجريبية مجانية لمدة 48 ساعة
-• 📢 البقاء في القناة الرئيسية دائماً
-• 🔗 إخراج من القنوات المميزة فقط عند انتهاء الاشتراك
-
-💡 ملاحظة: يمكنك إرسال الكود مباشرة دون استخدام الأمر /use
-        """
-        
-        if self.system.is_admin(user.id):
-            text += """
-
-👑 للمشرفين:
-• /createcode [المدة] [السعر] - إنشاء كود جديد
-• /createmultiple [العدد] [المدة] [السعر] - إنشاء عدة أكواد دفعة واحدة
-• /createbatch [عدد] [مدة] [سعر] - إنشاء دفعة أكواد
-• /codes - عرض الأكواد المتاحة
-• /subscribers - عرض المشتركين
-• /stats - إحصائيات النظام
-• /addadmin [معرف] - إضافة مشرف
-• /admins - عرض المشرفين
-• /addchannel [معرف] [معرف_عام] [اسم] - إضافة قناة
-• /channelslist - عرض القنوات
-• /buttons - عرض الأزرار
-• /addbutton [نص] [أمر] [رد] - إضافة زر
-• /checkexpired - التحقق من الاشتراكات المنتهية يدوياً
-• /sendnotifications - إرسال التنبيهات يدوياً
-            """
+        reply_markup = await self.renderer.main_menu_keyboard(await self.caller_is_admin(user.id, context))
+        text = MAIN_MENU_TEMPLATE.format(first_name=user.first_name)
         
+        await query.edit_message_text(text, reply_markup=reply_markup)
+
+    async def activate_code_menu(self, query, context):
+        """قائمة تفعيل الكود"""
         keyboard = [
             [InlineKeyboardButton("🔙 رجوع", callback_data="main_back")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        await query.edit_message_text(text, reply_markup=reply_markup)
+        text = """
+🎫 تفعيل كود اشتراك
 
-    async def show_admin_dashboard(self, query, context):
-        """لوحة تحكم المشرفين"""
-        stats = self.system.get_system_stats()
-        
-        text = f"""
-👑 لوحة تحكم المشرفين
+يمكنك تفعيل الاشتراك بطريقتين:
 
-📊 الإحصائيات:
-• 👥 المشتركين النشطين: {stats.get('active_subscribers', 0)}
-• 🎫 الأكواد المتاحة: {stats.get('available_codes', 0)}
-• ✅ الأكواد المستخدمة: {stats.get('used_codes', 0)}
-• 📢 القنوات النشطة: {stats.get('active_channels', 0)}
-• 💰 الإيرادات: ${stats.get('total_revenue', 0):.2f}
+1. استخدم الأمر:
+   /use [الكود]
 
-🛠️ أدوات الإدارة:
+2. أو أرسل الكود مباشرة:
+   فقط اكتب الكود وأرسله
+
+💡 مثال: ABCDEF123456
+
+✅ بعد التفعيل، سيتم إرسال روابط الانضمام إلى القنوات لك تلقائياً.
         """
         
+        await query.edit_message_text(text, reply_markup=reply_markup)
+
+    async def show_user_subscription(self, query, context):
+        """عرض معلومات اشتراك المستخدم"""
+        user = query.from_user
+        subscription_info = await self.system.get_subscription_info(user.id)
+        
+        if not subscription_info or not subscription_info[3]:  # is_active
+            await query.edit_message_text(NO_SUBSCRIPTION_TEXT, reply_markup=self.renderer.no_subscription)
+            return
+        
+        text = self.renderer.subscription_text(subscription_info)
+        await query.edit_message_text(text, reply_markup=self.renderer.back)
+
+    async def show_available_channels(self, query, context):
+        """عرض القنوات المتاحة"""
+        channels = await self.system.get_active_channels()
+        
+        if not channels:
+            text = "📭 لا توجد قنوات متاحة حالياً"
+        else:
+            text = "📢 القنوات المتاحة:\n\n"
+            for i, channel in enumerate(channels, 1):
+                channel_id, username, name, added_at, is_active, is_main_channel = channel[1:7]
+                main_text = " (رئيسية)" if is_main_channel else ""
+                text += f"{i}. {name}{main_text}"
+                if username:
+                    text += f" - {username}"
+                text += "\n"
+        
         keyboard = [
-            [
-                InlineKeyboardButton("🎫 إنشاء كود", callback_data="admin_create_code"),
-                InlineKeyboardButton("📦 إنشاء دفعة", callback_data="admin_create_batch")
-            ],
-            [
-                InlineKeyboardButton("🎫 إنشاء عدة أكواد", callback_data="admin_create_multiple"),
-                InlineKeyboardButton("📋 الأكواد", callback_data="admin_list_codes")
-            ],
-            [
-                InlineKeyboardButton("👥 المشتركين", callback_data="admin_list_subs"),
-                InlineKeyboardButton("📢 إدارة القنوات", callback_data="admin_manage_channels")
-            ],
-            [
-                InlineKeyboardButton("🎯 إدارة الأزرار", callback_data="admin_manage_buttons"),
-                InlineKeyboardButton("📊 إحصائيات", callback_data="admin_stats")
-            ],
-            [
-                InlineKeyboardButton("🔄 فحص المنتهية", callback_data="admin_check_expired"),
-                InlineKeyboardButton("🔔 إرسال تنبيهات", callback_data="admin_send_notifications")
-            ],
+            [InlineKeyboardButton("🎫 تفعيل كود", callback_data="user_activate_code")],
+            [InlineKeyboardButton("🆓 فترة تجريبية", callback_data="user_trial")],
             [InlineKeyboardButton("🔙 رجوع", callback_data="main_back")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
         await query.edit_message_text(text, reply_markup=reply_markup)
 
+    async def show_help_menu(self, query, context):
+        """عرض قائمة المساعدة"""
+        user = query.from_user
+        text = self.renderer.help_text(await self.caller_is_admin(user.id, context))
+        await query.edit_message_text(text, reply_markup=self.renderer.back)
+
+    async def show_admin_dashboard(self, query, context):
+        """لوحة تحكم المشرفين"""
+        stats = await self.system.get_system_stats()
+        text = self.renderer.admin_dashboard_text(stats)
+        await query.edit_message_text(text, reply_markup=self.renderer.admin_dashboard)
+
     async def show_detailed_stats(self, query, context):
         """عرض إحصائيات مفصلة"""
-        stats = self.system.get_system_stats()
+        stats = await self.system.get_system_stats()
         
         text = f"""
 📊 إحصائيات النظام التفصيلية
@@ -2343,7 +6150,7 @@ class TelegramSubscriptionBot:
 
     async def show_codes_list(self, query, context):
         """عرض قائمة الأكواد"""
-        codes = self.system.get_available_codes()
+        codes = await self.system.get_available_codes()
         
         if not codes:
             text = "📭 لا توجد أكواد متاحة حالياً"
@@ -2363,7 +6170,7 @@ class TelegramSubscriptionBot:
 
     async def show_subscribers_list(self, query, context):
         """عرض قائمة المشتركين"""
-        subscribers = self.system.get_all_subscribers()
+        subscribers = await self.system.get_all_subscribers()
         
         if not subscribers:
             text = "📭 لا توجد مشتركين حالياً"
@@ -2385,7 +6192,7 @@ class TelegramSubscriptionBot:
 
     async def show_channels_management(self, query, context):
         """عرض إدارة القنوات"""
-        channels = self.system.get_active_channels()
+        channels = await self.system.get_active_channels()
         
         text = "📢 إدارة القنوات\n\n"
         text += "استخدم الأمر:\n"
@@ -2414,7 +6221,10 @@ class TelegramSubscriptionBot:
         """إرسال التنبيهات من خلال الاستعلام"""
         await query.edit_message_text("🔄 جاري إرسال التنبيهات...")
         try:
-            await self.system.send_expiry_notifications_async()
+            # عبر عقد القيادة، فلا يتزامن مع المهمة الدورية ويرسل نفس التنبيهات مرتين
+            if not await self.system.run_leader_job_async('send_expiry_notifications', self.system.send_expiry_notifications_async, min_interval=0):
+                await query.edit_message_text("⏳ إرسال التنبيهات جارٍ الآن في مهمة أخرى، حاول بعد قليل")
+                return
             await query.edit_message_text("✅ تم إرسال التنبيهات بنجاح")
         except Exception as e:
             await query.edit_message_text(f"❌ حدث خطأ أثناء إرسال التنبيهات: {e}")
@@ -2442,48 +6252,7 @@ class TelegramSubscriptionBot:
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """عرض رسالة المساعدة المحدثة"""
         user = update.effective_user
-        
-        text = """
-🛠️ أوامر البوت المتاحة:
-
-👤 للمستخدمين:
-• /start - بدء استخدام البوت
-• /use [الكود] - تفعيل كود اشتراك
-• /trial - تفعيل فترة تجريبية مجانية (48 ساعة)
-• /mainchannel - رابط القناة الرئيسية
-• /mysubscription - عرض معلومات الاشتراك
-• /channels - عرض القنوات المتاحة
-• /help - عرض هذه الرسالة
-
-🎯 **الميزووات الجديدة:**
-• 🆓 فترة تجريبية مجانية لمدة 48 ساعة
-• 📢 البقاء في القناة الرئيسية دائماً
-• 🔗 إخراج من القنوات المميزة فقط عند انتهاء الاشتراك
-
-💡 ملاحظة: يمكنك إرسال الكود مباشرة دون استخدام الأمر /use
-        """
-        
-        if self.system.is_admin(user.id):
-            text += """
-
-👑 للمشرفين:
-• /createcode [المدة] [السعر] - إنشاء كود جديد
-• /createmultiple [العدد] [المدة] [السعر] - إنشاء عدة أكواد دفعة واحدة
-• /createbatch [عدد] [مدة] [سعر] - إنشاء دفعة أكواد
-• /codes - عرض الأكواد المتاحة
-• /subscribers - عرض المشتركين
-• /stats - إحصائيات النظام
-• /addadmin [معرف] - إضافة مشرف
-• /admins - عرض المشرفين
-• /addchannel [معرف] [معرف_عام] [اسم] - إضافة قناة
-• /channelslist - عرض القنوات
-• /buttons - عرض الأزرار
-• /addbutton [نص] [أمر] [رد] - إضافة زر
-• /checkexpired - التحقق من الاشتراكات المنتهية يدوياً
-• /sendnotifications - إرسال التنبيهات يدوياً
-            """
-        
-        await update.message.reply_text(text)
+        await update.message.reply_text(self.renderer.help_text(await self.system.is_admin(user.id)))
 
     async def use_code_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """استخدام كود عبر الأمر"""
@@ -2514,39 +6283,17 @@ class TelegramSubscriptionBot:
     async def my_subscription(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """عرض الاشتراك عبر الأمر"""
         user = update.effective_user
-        subscription_info = self.system.get_subscription_info(user.id)
+        subscription_info = await self.system.get_subscription_info(user.id)
         
         if not subscription_info or not subscription_info[3]:
             await update.message.reply_text("❌ ليس لديك اشتراك فعال")
             return
         
-        code_used, subscribed_at, expires_at, is_active, invite_links_json, is_trial = subscription_info
-        
-        trial_text = "تجريبية" if is_trial else "عادية"
-        
-        text = f"""
-📋 معلومات اشتراكك
-
-🎫 الكود المستخدم: {code_used}
-📅 تاريخ البدء: {subscribed_at.split()[0]}
-⏰ تاريخ الانتهاء: {expires_at.split()[0]}
-🔰 الحالة: {'🟢 نشط' if is_active else '🔴 منتهي'}
-🎯 النوع: {trial_text}
-        """
-        
-        # عرض روابط الدعوة إذا كانت موجودة
-        if invite_links_json:
-            invite_links = json.loads(invite_links_json)
-            if invite_links:
-                text += "\n🔗 روابط القنوات:\n"
-                for link_info in invite_links:
-                    text += f"• {link_info['channel_name']}: {link_info['invite_link']}\n"
-        
-        await update.message.reply_text(text)
+        await update.message.reply_text(self.renderer.subscription_text(subscription_info))
 
     async def list_channels(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """عرض القنوات عبر الأمر"""
-        channels = self.system.get_active_channels()
+        channels = await self.system.get_active_channels()
         
         if not channels:
             await update.message.reply_text("📭 لا توجد قنوات متاحة حالياً")
@@ -2565,7 +6312,7 @@ class TelegramSubscriptionBot:
 
     async def create_code(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """إنشاء كود جديد"""
-        if not self.system.is_admin(update.effective_user.id):
+        if not await self.system.is_admin(update.effective_user.id):
             await update.message.reply_text("❌ ليس لديك صلاحية هذا الأمر")
             return
         
@@ -2577,7 +6324,7 @@ class TelegramSubscriptionBot:
             duration = int(context.args[0])
             price = float(context.args[1])
             
-            success, code = self.system.create_subscription_code(duration, price, update.effective_user.id)
+            success, code = await self.system.create_subscription_code(duration, price, update.effective_user.id)
             
             if success:
                 await update.message.reply_text(f"✅ تم إنشاء الكود: {code}\n⏰ المدة: {duration} يوم\n💰 السعر: ${price:.2f}")
@@ -2589,7 +6336,7 @@ class TelegramSubscriptionBot:
 
     async def create_batch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """إنشاء دفعة أكواد"""
-        if not self.system.is_admin(update.effective_user.id):
+        if not await self.system.is_admin(update.effective_user.id):
             await update.message.reply_text("❌ ليس لديك صلاحية هذا الأمر")
             return
         
@@ -2606,7 +6353,7 @@ class TelegramSubscriptionBot:
                 await update.message.reply_text("❌ الحد الأقصى للدفعة هو 100 كود")
                 return
             
-            batch_id, codes = self.system.create_batch_codes(count, duration, price, update.effective_user.id)
+            batch_id, codes = await self.system.create_batch_codes(count, duration, price, update.effective_user.id)
             
             filename = f"batch_{batch_id}.txt"
             with open(filename, 'w', encoding='utf-8') as f:
@@ -2632,11 +6379,11 @@ class TelegramSubscriptionBot:
 
     async def list_codes(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """عرض الأكواد المتاحة"""
-        if not self.system.is_admin(update.effective_user.id):
+        if not await self.system.is_admin(update.effective_user.id):
             await update.message.reply_text("❌ ليس لديك صلاحية هذا الأمر")
             return
         
-        codes = self.system.get_available_codes()
+        codes = await self.system.get_available_codes()
         
         if not codes:
             await update.message.reply_text("📭 لا توجد أكواد متاحة حالياً")
@@ -2652,11 +6399,11 @@ class TelegramSubscriptionBot:
 
     async def list_subscribers(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """عرض المشتركين"""
-        if not self.system.is_admin(update.effective_user.id):
+        if not await self.system.is_admin(update.effective_user.id):
             await update.message.reply_text("❌ ليس لديك صلاحية هذا الأمر")
             return
         
-        subscribers = self.system.get_all_subscribers()
+        subscribers = await self.system.get_all_subscribers()
         
         if not subscribers:
             await update.message.reply_text("📭 لا توجد مشتركين حالياً")
@@ -2674,11 +6421,11 @@ class TelegramSubscriptionBot:
 
     async def show_stats_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """عرض الإحصائيات عبر الأمر"""
-        if not self.system.is_admin(update.effective_user.id):
+        if not await self.system.is_admin(update.effective_user.id):
             await update.message.reply_text("❌ ليس لديك صلاحية هذا الأمر")
             return
         
-        stats = self.system.get_system_stats()
+        stats = await self.system.get_system_stats()
         
         text = f"""
 📊 إحصائيات النظام
@@ -2694,7 +6441,7 @@ class TelegramSubscriptionBot:
 
     async def add_admin(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """إضافة مشرف"""
-        if not self.system.is_admin(update.effective_user.id):
+        if not await self.system.is_admin(update.effective_user.id):
             await update.message.reply_text("❌ ليس لديك صلاحية هذا الأمر")
             return
         
@@ -2704,14 +6451,14 @@ class TelegramSubscriptionBot:
         
         try:
             new_admin_id = int(context.args[0])
-            success, message = self.system.add_admin(new_admin_id, "", "", "", update.effective_user.id)
+            success, message = await self.system.add_admin(new_admin_id, "", "", "", update.effective_user.id)
             await update.message.reply_text(message)
         except ValueError:
             await update.message.reply_text("❌ يرجى إدخال معرف صحيح")
 
     async def remove_admin(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """إزالة مشرف"""
-        if not self.system.is_admin(update.effective_user.id):
+        if not await self.system.is_admin(update.effective_user.id):
             await update.message.reply_text("❌ ليس لديك صلاحية هذا الأمر")
             return
         
@@ -2721,18 +6468,18 @@ class TelegramSubscriptionBot:
         
         try:
             admin_id = int(context.args[0])
-            success, message = self.system.remove_admin(admin_id)
+            success, message = await self.system.remove_admin(admin_id)
             await update.message.reply_text(message)
         except ValueError:
             await update.message.reply_text("❌ يرجى إدخال معرف صحيح")
 
     async def list_admins(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """عرض المشرفين"""
-        if not self.system.is_admin(update.effective_user.id):
+        if not await self.system.is_admin(update.effective_user.id):
             await update.message.reply_text("❌ ليس لديك صلاحية هذا الأمر")
             return
         
-        admins = self.system.get_all_admins()
+        admins = await self.system.get_all_admins()
         
         if not admins:
             await update.message.reply_text("📭 لا توجد مشرفين مضافين حالياً")
@@ -2748,7 +6495,7 @@ class TelegramSubscriptionBot:
 
     async def add_channel(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """إضافة قناة جديدة"""
-        if not self.system.is_admin(update.effective_user.id):
+        if not await self.system.is_admin(update.effective_user.id):
             await update.message.reply_text("❌ ليس لديك صلاحية هذا الأمر")
             return
         
@@ -2760,7 +6507,7 @@ class TelegramSubscriptionBot:
         channel_username = context.args[1]
         channel_name = ' '.join(context.args[2:])
 
-        success, message = self.system.add_additional_channel(
+        success, message = await self.system.add_additional_channel(
             channel_id, channel_username, channel_name, update.effective_user.id
         )
 
@@ -2768,11 +6515,11 @@ class TelegramSubscriptionBot:
 
     async def admin_channels_list(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """عرض قائمة القنوات للمشرفين"""
-        if not self.system.is_admin(update.effective_user.id):
+        if not await self.system.is_admin(update.effective_user.id):
             await update.message.reply_text("❌ ليس لديك صلاحية هذا الأمر")
             return
         
-        channels = self.system.get_active_channels()
+        channels = await self.system.get_active_channels()
         
         if not channels:
             await update.message.reply_text("📭 لا توجد قنوات مضافين حالياً")
@@ -2792,7 +6539,7 @@ class TelegramSubscriptionBot:
 
     async def check_expired_manually(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """التحقق من الاشتراكات المنتهية يدوياً"""
-        if not self.system.is_admin(update.effective_user.id):
+        if not await self.system.is_admin(update.effective_user.id):
             await update.message.reply_text("❌ ليس لديك صلاحية هذا الأمر")
             return
         
@@ -2804,23 +6551,49 @@ class TelegramSubscriptionBot:
         except Exception as e:
             await processing_msg.edit_text(f"❌ حدث خطأ أثناء الفحص: {e}")
 
+    async def profiler_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """تفعيل أو إيقاف محلل المعالجات وعرض تقريره"""
+        if not await self.system.is_admin(update.effective_user.id):
+            await update.message.reply_text("❌ ليس لديك صلاحية هذا الأمر")
+            return
+        
+        action = context.args[0].lower() if context.args else "report"
+        if action == "on":
+            handler_profiler.enable()
+            await update.message.reply_text("🔬 تم تفعيل المحلل، استخدم /profiler report لعرض النتائج")
+        elif action == "off":
+            handler_profiler.disable()
+            await update.message.reply_text("🔬 تم إيقاف المحلل")
+        elif action == "reset":
+            handler_profiler.reset()
+            await update.message.reply_text("🔬 تم مسح نتائج المحلل")
+        elif action == "report":
+            # التقرير الكامل مع عينات المكدس يكتب في السجل لأنه يتجاوز حد طول الرسالة
+            logger.info(handler_profiler.report(with_stacks=True))
+            await update.message.reply_text(handler_profiler.report()[:4000])
+        else:
+            await update.message.reply_text("❌ الاستخدام: /profiler [on|off|report|reset]")
+
     async def send_notifications_manually(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """إرسال التنبيهات يدوياً"""
-        if not self.system.is_admin(update.effective_user.id):
+        if not await self.system.is_admin(update.effective_user.id):
             await update.message.reply_text("❌ ليس لديك صلاحية هذا الأمر")
             return
         
         processing_msg = await update.message.reply_text("🔄 جاري إرسال التنبيهات...")
         
         try:
-            await self.system.send_expiry_notifications_async()
+            # عبر عقد القيادة، فلا يتزامن مع المهمة الدورية ويرسل نفس التنبيهات مرتين
+            if not await self.system.run_leader_job_async('send_expiry_notifications', self.system.send_expiry_notifications_async, min_interval=0):
+                await processing_msg.edit_text("⏳ إرسال التنبيهات جارٍ الآن في مهمة أخرى، حاول بعد قليل")
+                return
             await processing_msg.edit_text("✅ تم إرسال التنبيهات بنجاح")
         except Exception as e:
             await processing_msg.edit_text(f"❌ حدث خطأ أثناء إرسال التنبيهات: {e}")
 
     async def create_multiple_codes(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """إنشاء عدة أكواد دفعة واحدة"""
-        if not self.system.is_admin(update.effective_user.id):
+        if not await self.system.is_admin(update.effective_user.id):
             await update.message.reply_text("❌ ليس لديك صلاحية هذا الأمر")
             return
         
@@ -2849,7 +6622,7 @@ class TelegramSubscriptionBot:
             processing_msg = await update.message.reply_text(f"🔄 جاري إنشاء {count} كود...")
             
             # إنشاء الأكواد
-            batch_id, codes, failed_codes = self.system.create_multiple_codes(
+            batch_id, codes, failed_codes = await self.system.create_multiple_codes(
                 count, duration, price, update.effective_user.id
             )
             
@@ -2902,6 +6675,122 @@ class TelegramSubscriptionBot:
         except Exception as e:
             await update.message.reply_text(f"❌ حدث خطأ أثناء إنشاء الأكواد: {e}")
 
+    async def backup_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """إنشاء نسخة احتياطية يدوياً"""
+        if not await self.system.is_admin(update.effective_user.id):
+            await update.message.reply_text("❌ ليس لديك صلاحية هذا الأمر")
+            return
+
+        processing_msg = await update.message.reply_text("💾 جاري إنشاء النسخة الاحتياطية...")
+        try:
+            path, size = await self.system.backup_database_async()
+        except Exception as e:
+            sweep_logger.error("❌ خطأ في إنشاء النسخة الاحتياطية: %s", e)
+            await processing_msg.edit_text("❌ فشل إنشاء النسخة الاحتياطية، راجع السجلات")
+            return
+
+        await processing_msg.edit_text(
+            f"✅ تم إنشاء النسخة الاحتياطية\n\n"
+            f"📁 {os.path.basename(path)}\n"
+            f"📦 الحجم: {size / 1024:.0f} KB\n"
+            f"🗂️ النسخ المحفوظة: {len(self.system.backups.list_backups())}"
+        )
+
+    async def archived_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """عرض سجلات مشترك أو كود من الأرشيف"""
+        if not await self.system.is_admin(update.effective_user.id):
+            await update.message.reply_text("❌ ليس لديك صلاحية هذا الأمر")
+            return
+
+        if not context.args:
+            await update.message.reply_text(
+                "❌ صيغة غير صحيحة\n"
+                "استخدم: /archived [معرف المستخدم أو الكود]"
+            )
+            return
+
+        kind, result = await self.system.find_archived(context.args[0])
+        if not result:
+            await update.message.reply_text("📭 لا يوجد في الأرشيف")
+            return
+
+        if kind == 'subscriber':
+            text = f"🗄️ اشتراكات المستخدم {context.args[0]} المؤرشفة:\n\n"
+            for i, (code_used, subscribed_at, expires_at, is_trial, archived_at) in enumerate(result[:10], 1):
+                trial_text = " (تجريبي)" if is_trial else ""
+                text += f"{i}. {code_used}{trial_text}\n   📅 {format_date(subscribed_at)} ← {format_date(expires_at)}\n"
+        else:
+            code, duration, price, is_used, created_at, archived_at = result
+            status = "✅ مستخدم" if is_used else "⌛ منتهي أو معطل"
+            text = (
+                f"🗄️ الكود {code}\n\n"
+                f"⏰ المدة: {duration} يوم\n💰 السعر: ${price:.2f}\n{status}\n"
+                f"📅 أنشئ في: {format_date(created_at)}\n📦 أرشف في: {format_date(archived_at)}"
+            )
+
+        await update.message.reply_text(text)
+
+    async def sign_codes_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """إنشاء أكواد موقعة بالجملة، لا تضاف لجدول الأكواد"""
+        if not await self.system.is_admin(update.effective_user.id):
+            await update.message.reply_text("❌ ليس لديك صلاحية هذا الأمر")
+            return
+        
+        if not CODE_SIGNING_KEY:
+            await update.message.reply_text("❌ الأكواد الموقعة غير مفعلة، يرجى تعيين CODE_SIGNING_KEY")
+            return
+        
+        if len(context.args) < 3:
+            await update.message.reply_text(
+                "❌ صيغة غير صحيحة\n"
+                "استخدم: /signcodes [العدد] [المدة] [الخطة] [معرفات القنوات...]\n\n"
+                "💡 مثال: /signcodes 10000 30 1\n"
+                "(10000 كود لمدة 30 يوم للخطة رقم 1، لكل القنوات الإضافية)"
+            )
+            return
+        
+        try:
+            count = int(context.args[0])
+            duration = int(context.args[1])
+            plan = int(context.args[2])
+            channel_ids = context.args[3:]
+            
+            if not 0 < count <= 100000:
+                await update.message.reply_text("❌ العدد يجب أن يكون بين 1 و 100000")
+                return
+            if not 0 < duration <= 0xFFFF or not 0 <= plan <= 0xFF:
+                await update.message.reply_text("❌ المدة بين 1 و 65535 يوم، والخطة بين 0 و 255")
+                return
+            for channel_id in channel_ids:
+                if not await self.system.get_channel_by_id(channel_id):
+                    await update.message.reply_text(f"❌ القناة {channel_id} غير موجودة")
+                    return
+            
+            channel_set = await self.system.get_or_create_channel_set(channel_ids, update.effective_user.id)
+            codes = generate_signed_codes(count, plan, duration, channel_set)
+            
+            filename = f"signed_codes_{plan}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
+            with open(filename, 'w', encoding='utf-8') as f:
+                f.write(f"أكواد موقعة - الخطة: {plan}\n")
+                f.write(f"العدد: {count} كود\n")
+                f.write(f"المدة: {duration} يوم\n")
+                f.write(f"مجموعة القنوات: {channel_set or 'كل القنوات الإضافية'}\n")
+                f.write(f"التاريخ: {datetime.now().strftime('%Y-%m-%d %H:%M')}\n")
+                f.write("=" * 50 + "\n\n")
+                f.write("\n".join(codes))
+                f.write("\n")
+            
+            await update.message.reply_document(
+                document=open(filename, 'rb'),
+                caption=f"✅ تم إنشاء {count} كود موقع\n\n🏷️ الخطة: {plan}\n⏰ المدة: {duration} يوم"
+            )
+            os.remove(filename)
+            
+        except ValueError as e:
+            await update.message.reply_text(f"❌ يرجى إدخال أرقام صحيحة ({e})")
+        except Exception as e:
+            await update.message.reply_text(f"❌ حدث خطأ أثناء إنشاء الأكواد: {e}")
+
     @retry_async(max_retries=2, delay=0.5)
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """معالجة الرسائل العامة - تم التطوير للتعرف التلقائي على الأكواد"""
@@ -2915,7 +6804,7 @@ class TelegramSubscriptionBot:
             return
         
         # التحقق إذا كان النص عبارة عن كود صالح
-        code = self.system.find_code_in_text(text)
+        code = await self.system.find_code_in_text(text)
         
         if code:
             # تم العثور على كود صالح، نقوم بتفعيله
@@ -2967,26 +6856,63 @@ class TelegramSubscriptionBot:
 
     async def error_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """معالجة الأخطاء"""
+        # Application.process_update يلتقط أخطاء المعالجات ويمررها هنا، فتحسب في المقياس من هنا
+        HANDLER_ERRORS.inc(route=OrderedUpdateProcessor.route_label(update))
         logger.error(f"❌ خطأ في البوت: {context.error}", exc_info=context.error)
 
+    def build_application(self):
+        """بناء تطبيق البوت مع إعدادات HTTP محسنة"""
+        # استخدام HTTPXRequest مع إعدادات محسنة وقياس طلبات API
+        request = InstrumentedHTTPXRequest(
+            connection_pool_size=50,  # زيادة حجم pool الاتصالات
+            read_timeout=60.0,
+            write_timeout=60.0,
+            connect_timeout=60.0,
+            pool_timeout=120.0
+        )
+        
+        persistence = SQLitePersistence(self.system.db_path)
+        # getUpdates يشارك نفس الطبقة: عميل HTTP واحد بدلاً من اثنين عند البدء، ويسجل الاستطلاع في المقاييس وفحص الصحة
+        builder = (
+            Application.builder()
+            .token(self.token)
+            .request(request)
+            .get_updates_request(request)
+            .concurrent_updates(OrderedUpdateProcessor(
+                MAX_CONCURRENT_UPDATES, on_processed=persistence.mark_processed,
+                admission=self.delay_update if INBOUND_POLICY == "delay" else None
+            ))
+            .persistence(persistence)
+            .post_init(self.on_post_init)
+            .post_shutdown(self.on_post_shutdown)
+        )
+        if TELEGRAM_API_URL:
+            builder = builder.base_url(TELEGRAM_API_URL)
+        if self.rate_limit > 0:
+            builder = builder.rate_limiter(BotRateLimiter(self.rate_limit))
+        application = builder.build()
+        self.setup_handlers(application)
+        self.system.set_application(application)
+        return application
+
+    async def on_post_init(self, application):
+        """ربط المهام المجدولة وطبقة التخزين بحلقة أحداث البوت بعد التهيئة (وضع run_polling)"""
+        self.system.bind_loop(asyncio.get_running_loop())
+        await self.system.open_store()
+        await self.setup_dynamic_handlers(application)
+        if PROFILER_ENABLED:
+            handler_profiler.enable()
+        # run_polling يبدأ الاستطلاع بعد هذه الدالة، فيؤجل المجدول لما بعد ذلك
+        asyncio.get_running_loop().call_soon(self.system.start_scheduler)
+
+    async def on_post_shutdown(self, application):
+        """إغلاق طبقة التخزين عند إيقاف run_polling"""
+        await self.system.store.close()
+
     def run_bot(self):
         """تشغيل البوت مع إعدادات HTTP محسنة - تم التصحيح"""
         try:
-            # إعدادات HTTP محسنة
-            from telegram.request import HTTPXRequest
-            
-            # استخدام HTTPXRequest مع إعدادات محسنة
-            request = HTTPXRequest(
-                connection_pool_size=50,  # زيادة حجم pool الاتصالات
-                read_timeout=60.0,
-                write_timeout=60.0,
-                connect_timeout=60.0,
-                pool_timeout=120.0
-            )
-            
-            application = Application.builder().token(self.token).request(request).build()
-            self.setup_handlers(application)
-            self.system.set_application(application)
+            application = self.build_application()
             
             logger.info("🚀 بدء تشغيل بوت إدارة الاشتراكات...")
             print("=" * 60)
@@ -2994,12 +6920,12 @@ class TelegramSubscriptionBot:
             print("✅ الإصدار المطور - نظام الفترات التجريبية والبقاء في القناة الرئيسية")
             print("=" * 60)
             
-            # إعدادات Polling محسنة
+            # الاستعلام الطويل يعود فور وصول تحديث، لذلك لا حاجة لانتظار إضافي بين الاستعلامات
             application.run_polling(
-                poll_interval=2.0,  # زيادة الفترة بين الاستعلامات
+                poll_interval=0.0,
                 timeout=60,
-                drop_pending_updates=True,
-                allowed_updates=['message', 'callback_query']
+                drop_pending_updates=not CATCH_UP_UPDATES,
+                allowed_updates=ALLOWED_UPDATES
             )
             
         except Exception as e:
@@ -3007,44 +6933,404 @@ class TelegramSubscriptionBot:
             print(f"❌ فشل تشغيل البوت: {e}")
 
     async def run_bot_async(self):
-        """تشغيل البوت بشكل غير متزامن (للاستخدام مع Render)"""
+        """تشغيل البوت بشكل غير متزامن (للاستخدام مع Render) في وضع webhook أو polling"""
+        mode = BOT_MODE
+        if mode == "webhook" and (not HAS_AIOHTTP or not WEBHOOK_URL):
+            logger.warning("⚠️ وضع Webhook غير متاح (aiohttp أو WEBHOOK_URL مفقود)، سيتم استخدام Polling")
+            mode = "polling"
+        
+        web_server = None
         try:
-            from telegram.request import HTTPXRequest
+            application = self.build_application()
+            startup_timer.mark("build_application")
             
-            request = HTTPXRequest(
-                connection_pool_size=50,
-                read_timeout=60.0,
-                write_timeout=60.0,
-                connect_timeout=60.0,
-                pool_timeout=120.0
-            )
-            
-            application = Application.builder().token(self.token).request(request).build()
-            self.setup_handlers(application)
-            self.system.set_application(application)
-            
-            logger.info("🚀 بدء تشغيل بوت إدارة الاشتراكات على Render...")
+            logger.info(f"🚀 بدء تشغيل بوت إدارة الاشتراكات على Render (الوضع: {mode})...")
             print("=" * 60)
             print("🤖 بوت إدارة اشتراكات ")
             print("✅ الإصدار المعدل للعمل على Render")
             print("=" * 60)
             
             await application.initialize()
-            await application.start()
+            startup_timer.mark("initialize")
+            self.system.bind_loop(asyncio.get_running_loop())
+            await self.system.open_store()
+            await self.setup_dynamic_handlers(application)
+            startup_timer.mark("open_store")
+            health_monitor.bind(system=self.system, application=application, mode=mode)
+            health_monitor.start()
+            if PROFILER_ENABLED:
+                handler_profiler.enable()
             
-            # البقاء قيد التشغيل
-            while True:
-                await asyncio.sleep(3600)  # الانتظار لمدة ساعة
+            # في وضع webhook يجب أن يعمل الخادم قبل أن يرسل Telegram أول تحديث
+            if HAS_AIOHTTP:
+                web_server = BotWebServer(application, mode=mode)
+            if mode == "webhook":
+                await application.start()
+                await web_server.start()
+                startup_timer.mark("web_server")
+                await application.bot.set_webhook(
+                    url=f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+                    secret_token=WEBHOOK_SECRET,
+                    allowed_updates=ALLOWED_UPDATES,
+                    drop_pending_updates=not CATCH_UP_UPDATES,
+                    max_connections=min(MAX_CONCURRENT_UPDATES, 100)
+                )
+                logger.info(f"✅ تم تعيين Webhook على {WEBHOOK_URL}{WEBHOOK_PATH}")
+                startup_timer.mark("set_webhook")
+            else:
+                await application.bot.delete_webhook()
+                await application.start()
+                await application.updater.start_polling(
+                    poll_interval=0.0,
+                    timeout=60,
+                    drop_pending_updates=not CATCH_UP_UPDATES,
+                    allowed_updates=ALLOWED_UPDATES
+                )
+                startup_timer.mark("start_polling")
+                # خادم HTTP يخدم نقاط الصحة دائماً، ويبدأ بعد الاستطلاع لأنه ليس في طريق أول تحديث
+                if web_server:
+                    await web_server.start()
+                    startup_timer.mark("web_server")
+            startup_timer.ready()
+            
+            # المهام المجدولة ليست مطلوبة لأول تحديث
+            self.system.start_scheduler()
+            
+            # البقاء قيد التشغيل حتى وصول إشارة الإيقاف
+            stop_event = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                try:
+                    loop.add_signal_handler(sig, stop_event.set)
+                except (NotImplementedError, RuntimeError):
+                    pass
+            await stop_event.wait()
+            
+            logger.info("🛑 إيقاف البوت...")
+            if web_server:
+                await web_server.stop()
+            await health_monitor.stop()
+            handler_profiler.disable()
+            if application.updater and application.updater.running:
+                await application.updater.stop()
+            await application.stop()
+            await application.shutdown()
+            await self.system.store.close()
             
         except Exception as e:
             logger.error(f"❌ خطأ في تشغيل البوت: {e}")
             print(f"❌ فشل تشغيل البوت: {e}")
 
+# =============================================
+# خادم HTTP غير المتزامن (Webhook ونقاط الصحة)
+# =============================================
+class BotWebServer:
+    """خادم aiohttp يعمل في نفس حلقة أحداث البوت لاستقبال التحديثات وخدمة /health و /status"""
+    def __init__(self, application=None, mode="webhook", host="0.0.0.0", port=PORT,
+                 webhook_path=WEBHOOK_PATH, secret_token=WEBHOOK_SECRET, update_sink=None):
+        self.application = application
+        # الدالة التي تستلم جسم التحديث الخام، الافتراضية تضعه في طابور التطبيق المحلي
+        self.update_sink = update_sink or self.enqueue_update
+        self.mode = mode
+        self.host = host
+        self.port = port
+        self.webhook_path = webhook_path
+        self.secret_token = secret_token
+        self.start_time = datetime.now()
+        self.runner = None
+
+    def build_app(self):
+        """إنشاء تطبيق aiohttp وتسجيل المسارات"""
+        from aiohttp import web
+        app = web.Application()
+        app.router.add_get('/', self.home)
+        app.router.add_get('/health', self.health)
+        app.router.add_get('/ready', self.ready)
+        app.router.add_get('/status', self.status)
+        app.router.add_get('/metrics', self.handle_metrics)
+        if self.mode == "webhook":
+            app.router.add_post(self.webhook_path, self.handle_webhook)
+        return app
+
+    async def start(self):
+        """تشغيل الخادم"""
+        from aiohttp import web
+        self.runner = web.AppRunner(self.build_app(), access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        web_logger.info("✅ خادم HTTP يعمل على المنفذ %s", self.port)
+
+    async def stop(self):
+        """إيقاف الخادم"""
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def handle_webhook(self, request):
+        """استقبال تحديث من Telegram بعد التحقق من الرمز السري"""
+        from aiohttp import web
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not secrets.compare_digest(token, self.secret_token):
+            web_logger.warning("⚠️ طلب Webhook برمز سري غير صحيح من %s", request.remote)
+            return web.Response(status=403)
+        
+        body = await request.read()
+        try:
+            accepted = await self.update_sink(body)
+        except ValueError:
+            return web.Response(status=400)
+        
+        if accepted:
+            health_monitor.mark("webhook")
+        # 503 يجعل Telegram يعيد إرسال التحديث لاحقاً عند امتلاء الطوابير
+        return web.Response(status=200 if accepted else 503)
+
+    async def enqueue_update(self, body):
+        """تسليم التحديث لطابور التطبيق ليعالج بالتوازي دون تأخير الرد على Telegram"""
+        data = json.loads(body)
+        if not isinstance(data, dict):
+            raise ValueError("جسم التحديث ليس كائن JSON")
+        update = Update.de_json(data, self.application.bot)
+        await self.application.update_queue.put(update)
+        return True
+
+    async def home(self, request):
+        """صفحة البداية"""
+        from aiohttp import web
+        return web.Response(
+            text=f"🤖 بوت إدارة الاشتراكات يعمل منذ {self.start_time.strftime('%Y-%m-%d %H:%M:%S')}",
+            content_type='text/plain',
+            charset='utf-8'
+        )
+
+    async def health(self, request):
+        """فحص حيوية العملية: 503 إذا كانت الحلقة أو الاستطلاع أو القاعدة أو المجدول عالقة"""
+        return await self.health_response(readiness=False)
+
+    async def ready(self, request):
+        """فحص الجاهزية: الحيوية بالإضافة لتشغيل التطبيق وعمق الطوابير"""
+        return await self.health_response(readiness=True)
+
+    async def health_response(self, readiness):
+        from aiohttp import web
+        healthy, checks = await health_monitor.check(readiness=readiness)
+        if not healthy:
+            failed = [name for name, check in checks.items() if not check["ok"]]
+            web_logger.warning("⚠️ فشل فحص %s: %s", 'الجاهزية' if readiness else 'الصحة', ', '.join(failed))
+        return web.json_response({
+            "status": ("ready" if readiness else "healthy") if healthy else "unhealthy",
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "service": "telegram-subscription-bot",
+            "environment": "render" if os.environ.get('RENDER') else "local",
+            "uptime_seconds": int(time.time() - health_monitor.started_at),
+            "checks": checks
+        }, status=200 if healthy else 503)
+
+    async def handle_metrics(self, request):
+        """مقاييس العملية الحالية بصيغة Prometheus النصية"""
+        from aiohttp import web
+        return web.Response(
+            text=metrics.render(),
+            content_type='text/plain',
+            charset='utf-8'
+        )
+
+    async def status(self, request):
+        """حالة النظام"""
+        from aiohttp import web
+        return web.json_response({
+            "status": "running",
+            "start_time": self.start_time.strftime("%Y-%m-%d %H:%M:%S"),
+            "uptime_seconds": int((datetime.now() - self.start_time).total_seconds()),
+            "mode": self.mode,
+            "bot_token_set": bool(os.environ.get('BOT_TOKEN')),
+            "platform": "render" if os.environ.get('RENDER') else "local",
+            "python_version": os.environ.get('PYTHON_VERSION', '3.11.0'),
+            "startup": startup_timer.report()
+        })
+
+# =============================================
+# وضع العمال المتعددين: توزيع التحديثات حسب المستخدم
+# =============================================
+def shard_for_update(data, workers):
+    """اختيار العامل المسؤول عن التحديث حسب معرف المستخدم (أو المحادثة)"""
+    for field in ('message', 'edited_message', 'callback_query', 'my_chat_member', 'chat_member'):
+        payload = data.get(field)
+        if not payload:
+            continue
+        sender = payload.get('from') or payload.get('chat') or {}
+        if 'id' in sender:
+            return sender['id'] % workers
+    # التحديثات غير المرتبطة بمستخدم تذهب للعامل الأول
+    return 0
+
+def run_shard_worker(shard_index, update_queue, owns_scheduler):
+    """نقطة دخول عملية العامل: نظام وبوت كاملان يعالجان التحديثات القادمة من الواجهة"""
+    use_worker_log_file(f"bot-worker-{shard_index}")
+    
+    async def worker_loop():
+        system = SubscriptionManagementSystem(enable_scheduler=owns_scheduler)
+        bot = TelegramSubscriptionBot(system)
+        bot.rate_limit = BOT_RATE_LIMIT / BOT_WORKERS
+        application = bot.build_application()
+        await application.initialize()
+        system.bind_loop(asyncio.get_running_loop())
+        await system.open_store()
+        await bot.setup_dynamic_handlers(application)
+        await application.start()
+        system.start_scheduler()
+        logger.info(f"✅ العامل {shard_index} جاهز (المهام المجدولة: {'نعم' if owns_scheduler else 'لا'})")
+        
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop_event.set)
+            except (NotImplementedError, RuntimeError):
+                pass
+        
+        def next_body():
+            try:
+                return update_queue.get(timeout=1.0)
+            except queue.Empty:
+                return b""
+        
+        try:
+            while not stop_event.is_set():
+                body = await loop.run_in_executor(None, next_body)
+                if body is None:
+                    break
+                if not body:
+                    continue
+                try:
+                    update = Update.de_json(json.loads(body), application.bot)
+                    await application.update_queue.put(update)
+                except Exception as e:
+                    logger.error(f"❌ العامل {shard_index}: تحديث غير صالح: {e}")
+        finally:
+            await application.stop()
+            await application.shutdown()
+            await system.store.close()
+            system.close()
+            logger.info(f"🛑 تم إيقاف العامل {shard_index}")
+    
+    asyncio.run(worker_loop())
+
+class ShardedBotFront:
+    """عملية الواجهة: تستقبل Webhook وتوزع التحديثات على عدة عمليات عمال"""
+    def __init__(self, workers=BOT_WORKERS, queue_size=10000):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.ctx = multiprocessing.get_context("spawn")
+        self.queues = [self.ctx.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.processes = [None] * workers
+
+    def spawn_worker(self, index):
+        """تشغيل (أو إعادة تشغيل) عامل، كل العمال يشغلون المهام المجدولة وعقد القيادة يمنع التكرار"""
+        process = self.ctx.Process(
+            target=run_shard_worker,
+            args=(index, self.queues[index], True),
+            name=f"bot-worker-{index}",
+            daemon=False
+        )
+        process.start()
+        self.processes[index] = process
+        logger.info(f"🚀 تم تشغيل العامل {index} (PID: {process.pid})")
+
+    async def dispatch(self, body):
+        """إرسال جسم التحديث الخام للعامل المناسب دون إعادة تسلسله"""
+        data = json.loads(body)
+        if not isinstance(data, dict):
+            # يتحول لـ 400 في handle_webhook، فلا يعيد Telegram إرساله بلا نهاية
+            raise ValueError("جسم التحديث ليس كائن JSON")
+        index = shard_for_update(data, self.workers)
+        try:
+            self.queues[index].put_nowait(body)
+            return True
+        except queue.Full:
+            logger.warning(f"⚠️ طابور العامل {index} ممتلئ")
+            return False
+
+    def workers_check(self):
+        """فحص الواجهة: حالة العمال وعمق طوابيرهم"""
+        alive = [process is not None and process.is_alive() for process in self.processes]
+        depths = []
+        for worker_queue in self.queues:
+            try:
+                depths.append(worker_queue.qsize())
+            except NotImplementedError:
+                depths.append(None)
+        return "workers", any(alive), {"alive": alive, "queue_depths": depths}
+
+    async def supervise(self, stop_event):
+        """إعادة تشغيل أي عامل يتوقف بشكل غير متوقع"""
+        while not stop_event.is_set():
+            for index, process in enumerate(self.processes):
+                if process is not None and not process.is_alive():
+                    logger.error(f"❌ العامل {index} توقف (رمز الخروج: {process.exitcode})، إعادة التشغيل...")
+                    self.spawn_worker(index)
+            try:
+                await asyncio.wait_for(stop_event.wait(), timeout=5.0)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run(self):
+        """تشغيل الواجهة والعمال حتى وصول إشارة الإيقاف"""
+        from telegram import Bot
+        
+        # إنشاء الجداول مرة واحدة قبل تشغيل العمال لتجنب تعارض الترحيل
+        SubscriptionManagementSystem(enable_scheduler=False).close()
+        
+        for index in range(self.workers):
+            self.spawn_worker(index)
+        
+        async with Bot(BOT_TOKEN, base_url=TELEGRAM_API_URL or "https://api.telegram.org/bot") as bot:
+            await bot.set_webhook(
+                url=f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=ALLOWED_UPDATES,
+                drop_pending_updates=not CATCH_UP_UPDATES,
+                max_connections=min(MAX_CONCURRENT_UPDATES * self.workers, 100)
+            )
+        logger.info(f"✅ الواجهة توزع التحديثات على {self.workers} عمال")
+        
+        health_monitor.bind(mode="webhook")
+        health_monitor.extra_checks.append(self.workers_check)
+        health_monitor.start()
+        web_server = BotWebServer(mode="webhook", update_sink=self.dispatch)
+        await web_server.start()
+        
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop_event.set)
+            except (NotImplementedError, RuntimeError):
+                pass
+        
+        await self.supervise(stop_event)
+        
+        logger.info("🛑 إيقاف الواجهة والعمال...")
+        await web_server.stop()
+        await health_monitor.stop()
+        for worker_queue in self.queues:
+            worker_queue.put(None)
+        for process in self.processes:
+            await loop.run_in_executor(None, process.join, 30)
+            if process.is_alive():
+                process.terminate()
+
 # =============================================
 # الدالة الرئيسية المعدلة للعمل على Render
 # =============================================
 def main():
     """الدالة الرئيسية المعدلة للتشغيل على Render"""
+    # أوامر النسخ الاحتياطي لا تحتاج التوكن: python main.py backup | verify [ملف] | restore <ملف|latest>
+    if len(sys.argv) > 1 and sys.argv[1] in ("backup", "verify", "restore"):
+        sys.exit(run_backup_cli(sys.argv[1:]))
+
+    startup_timer.mark("imports")
     print("🚀 نظام إدارة مشتركين ")
     print("✅ الإصدار المعدل للعمل على Render")
     print("=" * 60)
@@ -3056,15 +7342,22 @@ def main():
         return
     
     try:
+        # وضع العمال المتعددين: الواجهة لا تنشئ بوتاً بنفسها
+        if BOT_WORKERS > 1:
+            if BOT_MODE == "webhook" and HAS_AIOHTTP and WEBHOOK_URL:
+                asyncio.run(ShardedBotFront(BOT_WORKERS).run())
+                return
+            logger.warning("⚠️ BOT_WORKERS يتطلب وضع Webhook، سيتم التشغيل بعملية واحدة")
+        
         # إنشاء مثيل النظام
         system = SubscriptionManagementSystem()
+        startup_timer.mark("database")
         print("✅ تم تهيئة نظام الإدارة بنجاح")
         
         # إنشاء وتشغيل البوت
         bot = TelegramSubscriptionBot(system)
         
         # استخدام run_bot_async إذا كان على Render، وإلا run_bot العادي
-        import asyncio
         asyncio.run(bot.run_bot_async())
             
     except Exception as e: